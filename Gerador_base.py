@@ -1,12 +1,41 @@
+import argparse
+import ast
+import base64
+import datetime
+import gzip
+import hashlib
+import hmac
+import json
 import os
+import random
 import re
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
 import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 
+import numpy as np
 import pandas as pd
 import mysql.connector
 
+try:
+    import pyarrow as pa  # opcional: exigido pela exportação paralela (fatias via Arrow IPC)
+except ImportError:
+    pa = None
+
 from openpyxl.utils import get_column_letter
 
 
@@ -27,6 +56,9 @@ TEL_LIMIT_FIXO = 7
 # No seu SQL original está como "his.cod_cli". Se no seu banco for diferente, ajuste aqui.
 HIST_CAD_REF_COL = "cod_cli"
 
+# Pasta local do app (índices, caches e históricos ficam fora do share de rede)
+LOCAL_DATA_DIR = os.path.join(os.path.expanduser("~"), ".gerador_base")
+
 
 # =========================
 # Credenciais (arquivo)
@@ -151,67 +183,4903 @@ def _write_excel_pretty(df: pd.DataFrame, path: str, sheet_name: str):
         for col_idx, col_name in enumerate(df.columns, start=1):
             col_lower = str(col_name).lower()
 
-            # Se a coluna parece monetária E é numérica, aplica formato #,##0.00
-            if any(k in col_lower for k in money_keywords) and pd.api.types.is_numeric_dtype(df[col_name]):
-                for row in range(2, ws.max_row + 1):
-                    ws.cell(row=row, column=col_idx).number_format = "#,##0.00"
+            # Se a coluna parece monetária E é numérica, aplica formato #,##0.00
+            if any(k in col_lower for k in money_keywords) and pd.api.types.is_numeric_dtype(df[col_name]):
+                for row in range(2, ws.max_row + 1):
+                    ws.cell(row=row, column=col_idx).number_format = "#,##0.00"
+
+
+# Backends de exportação (nome -> função(df, path, sheet_name)). bench_excel.py mede todos.
+EXCEL_WRITERS = {
+    "openpyxl": _write_excel_pretty,
+}
+
+
+# =========================
+# Exportação paralela (processos)
+# =========================
+# openpyxl segura o GIL: a thread do job usa um núcleo só. Aqui o resultado é fatiado
+# (por cod_cli ou por faixas de linhas) e cada fatia vira um .xlsx em um processo do pool.
+# As fatias chegam aos processos em Arrow IPC num bloco de memória compartilhada (pelo pool
+# só passa o nome do bloco) e o processo lê o bloco sem copiar. Por isso o modo paralelo
+# exige o pyarrow. Só há um bloco por processo do pool: a próxima fatia só é serializada
+# quando uma parte termina, então a memória extra fica em ~N processos x fatia.
+EXPORTACAO_OPCOES = [
+    ("Um arquivo", None),
+    ("Um arquivo por carteira (paralelo)", "carteira"),
+    ("Partes por faixa de linhas (paralelo)", "linhas"),
+]
+EXPORTACAO_LINHAS_POR_PARTE = 250_000
+EXPORTACAO_MAX_PROCESSOS = max(1, (os.cpu_count() or 2) - 1)
+
+
+def _fatias_exportacao(df: pd.DataFrame, path: str, modo: str) -> list[tuple[str, pd.DataFrame]]:
+    """(arquivo, fatia). Por carteira só quando a base tem cod_cli; senão cai em faixas de linhas."""
+    raiz, ext = os.path.splitext(path)
+    if modo == "carteira" and "cod_cli" in df.columns:
+        grupos = list(df.groupby("cod_cli", sort=True))
+        if len(grupos) > 1:
+            return [(f"{raiz}_{c}{ext}", g) for c, g in grupos]
+        return [(path, df)]
+    n = EXPORTACAO_LINHAS_POR_PARTE
+    if len(df) <= n:
+        return [(path, df)]
+    return [(f"{raiz}_parte{i // n + 1}{ext}", df.iloc[i:i + n]) for i in range(0, len(df), n)]
+
+
+def checar_exportacao(modo: str | None):
+    if modo and pa is None:
+        raise ValueError("A exportação paralela precisa do pyarrow (pip install pyarrow).")
+
+
+def _para_memoria_compartilhada(df: pd.DataFrame) -> tuple[shared_memory.SharedMemory, int]:
+    """Grava a fatia em Arrow IPC direto no bloco (o tamanho sai de uma passada que só conta bytes)."""
+    tabela = pa.Table.from_pandas(df, preserve_index=False)
+    medida = pa.MockOutputStream()
+    with pa.ipc.new_stream(medida, tabela.schema) as escritor:
+        escritor.write_table(tabela)
+    tamanho = medida.size()
+    shm = shared_memory.SharedMemory(create=True, size=max(tamanho, 1))
+    try:
+        with pa.ipc.new_stream(pa.FixedSizeBufferWriter(pa.py_buffer(shm.buf)), tabela.schema) as escritor:
+            escritor.write_table(tabela)
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    return shm, tamanho
+
+
+def _exportar_parte(nome_shm: str, tamanho: int, path: str, sheet_name: str) -> str:
+    """Roda no processo do pool: lê a fatia direto do bloco compartilhado e grava o .xlsx."""
+    shm = shared_memory.SharedMemory(name=nome_shm)
+    try:
+        _write_excel_pretty(pa.ipc.open_stream(pa.py_buffer(shm.buf[:tamanho])).read_pandas(), path, sheet_name)
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            pass  # após uma exceção o traceback ainda segura o DataFrame; o mapeamento sai com o processo
+    return path
+
+
+def _exportar_local(df: pd.DataFrame, path: str, sheet_name: str, modo: str | None = None) -> list[str]:
+    """Grava o resultado (um arquivo, ou fatias em paralelo conforme `modo`) e devolve os arquivos."""
+    fatias = _fatias_exportacao(df, path, modo) if modo else [(path, df)]
+    if len(fatias) == 1:
+        _write_excel_pretty(fatias[0][1], fatias[0][0], sheet_name)
+        return [fatias[0][0]]
+    checar_exportacao(modo)
+
+    processos = min(len(fatias), EXPORTACAO_MAX_PROCESSOS)
+    pendentes = list(reversed(fatias))
+    em_voo = {}  # futuro -> bloco compartilhado da fatia
+    try:
+        with ProcessPoolExecutor(max_workers=processos) as pool:
+            while pendentes or em_voo:
+                while pendentes and len(em_voo) < processos:
+                    caminho, parte = pendentes.pop()
+                    shm, tamanho = _para_memoria_compartilhada(parte)
+                    em_voo[pool.submit(_exportar_parte, shm.name, tamanho, caminho, sheet_name)] = shm
+                prontos, _ = wait(em_voo, return_when=FIRST_COMPLETED)
+                for futuro in prontos:
+                    shm = em_voo.pop(futuro)
+                    shm.close()
+                    shm.unlink()
+                    futuro.result()
+    finally:
+        for shm in em_voo.values():
+            shm.close()
+            shm.unlink()
+    return [caminho for caminho, _ in fatias]
+
+
+# =========================
+# Escrita local primeiro (cópia para o destino em segundo plano)
+# =========================
+# Gravar o .xlsx direto no \\fs01 são milhares de escritas pequenas pelo SMB. O Excel é
+# gravado em ESCRITA_LOCAL_DIR e o job termina aí; uma thread copia cada arquivo para o
+# destino em blocos grandes (ESCRITA_BUFFER_BYTES) num ".parcial", confere tamanho e sha256
+# relendo o destino e só então troca pelo nome final. Se a cópia falhar, o arquivo local
+# fica em ESCRITA_LOCAL_DIR (apagado depois de ESCRITA_MAX_IDADE_H) e o erro é avisado.
+# As threads de cópia não são daemon: o processo só sai depois que elas terminam.
+ESCRITA_LOCAL_DIR = os.path.join(LOCAL_DATA_DIR, "escrita")
+ESCRITA_BUFFER_BYTES = 16 * 1024 * 1024
+ESCRITA_MAX_IDADE_H = 72
+
+# destino -> {"local", "destino", "bytes", "estado", "sha256", "segundos", "erro"}; a entrada sai
+# quando o resultado final da cópia é mostrado (resumo_envios(..., descartar=True))
+_envios: dict[str, dict] = {}
+_envios_lock = threading.Lock()
+
+
+def _sha256_arquivo(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while bloco := f.read(ESCRITA_BUFFER_BYTES):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+def _limpar_escrita_antiga():
+    limite = time.time() - ESCRITA_MAX_IDADE_H * 3600
+    for nome in os.listdir(ESCRITA_LOCAL_DIR):
+        pasta = os.path.join(ESCRITA_LOCAL_DIR, nome)
+        try:
+            if os.path.getmtime(pasta) < limite:
+                shutil.rmtree(pasta, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def _enviar(envio: dict, ao_copiar=None):
+    t0 = time.perf_counter()
+    parcial = envio["destino"] + ".parcial"
+    try:
+        h = hashlib.sha256()
+        with open(envio["local"], "rb") as origem, open(parcial, "wb") as destino:
+            while bloco := origem.read(ESCRITA_BUFFER_BYTES):
+                h.update(bloco)
+                destino.write(bloco)
+        envio["sha256"] = h.hexdigest()
+        if os.path.getsize(parcial) != envio["bytes"] or _sha256_arquivo(parcial) != envio["sha256"]:
+            raise OSError("a cópia no destino não confere com o arquivo local (tamanho/sha256)")
+        os.replace(parcial, envio["destino"])
+        os.remove(envio["local"])
+        try:
+            os.rmdir(os.path.dirname(envio["local"]))  # a última parte do lote leva a pasta junto
+        except OSError:
+            pass
+        envio["estado"] = "ok"
+    except OSError as e:
+        envio.update(estado="erro", erro=str(e))
+        try:
+            os.remove(parcial)
+        except OSError:
+            pass
+    envio["segundos"] = time.perf_counter() - t0
+    if ao_copiar:
+        ao_copiar(envio)
+
+
+def exportar(df: pd.DataFrame, path: str, sheet_name: str, modo: str | None = None, ao_copiar=None) -> list[str]:
+    """
+    Grava o resultado localmente e devolve os caminhos de destino; a cópia de cada arquivo
+    para o destino segue em segundo plano e chama ao_copiar(envio) ao terminar (ok ou erro).
+    """
+    os.makedirs(ESCRITA_LOCAL_DIR, exist_ok=True)
+    _limpar_escrita_antiga()
+    pasta = tempfile.mkdtemp(prefix="export_", dir=ESCRITA_LOCAL_DIR)
+    locais = _exportar_local(df, os.path.join(pasta, os.path.basename(path)), sheet_name, modo)
+
+    destinos = []
+    for local in locais:
+        destino = os.path.join(os.path.dirname(os.path.abspath(path)), os.path.basename(local))
+        envio = {"local": local, "destino": destino, "bytes": os.path.getsize(local), "estado": "copiando",
+                 "sha256": None, "segundos": None, "erro": None}
+        envio["thread"] = threading.Thread(target=_enviar, args=(envio, ao_copiar), name=f"envio {destino}")
+        with _envios_lock:
+            _envios[destino] = envio
+        envio["thread"].start()
+        destinos.append(destino)
+    return destinos
+
+
+def _tamanho_exportado(caminho: str) -> int:
+    with _envios_lock:
+        envio = _envios.get(caminho)
+    return envio["bytes"] if envio else os.path.getsize(caminho)
+
+
+def envios_pendentes(caminhos: list[str]) -> bool:
+    with _envios_lock:
+        return any(_envios[c]["estado"] == "copiando" for c in caminhos if c in _envios)
+
+
+def aguardar_envios(caminhos: list[str] | None = None) -> list[dict]:
+    """Espera as cópias (de `caminhos`, ou todas) e devolve os envios."""
+    with _envios_lock:
+        envios = [e for d, e in _envios.items() if caminhos is None or d in caminhos]
+    for e in envios:
+        e["thread"].join()
+    return envios
+
+
+def resumo_envios(caminhos: list[str], descartar: bool = False) -> str:
+    """
+    Situação das cópias de `caminhos`. Com `descartar`, quando nenhuma está mais copiando,
+    as entradas saem de _envios (o resultado final já foi mostrado).
+    """
+    with _envios_lock:
+        envios = [_envios[c] for c in caminhos if c in _envios]
+        pendentes = sum(e["estado"] == "copiando" for e in envios)
+        if descartar and not pendentes:
+            for e in envios:
+                _envios.pop(e["destino"], None)
+    if not envios:
+        return ""
+    erros = [e for e in envios if e["estado"] == "erro"]
+    if erros:
+        return "\n".join(f"Falha ao copiar para {e['destino']}: {e['erro']}\nO arquivo ficou em: {e['local']}" for e in erros)
+    if pendentes:
+        return f"Copiando para o destino: {len(envios) - pendentes} de {len(envios)} arquivo(s) prontos..."
+    mb = sum(e["bytes"] for e in envios) / (1024 * 1024)
+    seg = max(e["segundos"] for e in envios)
+    return f"Cópia no destino verificada (tamanho + sha256): {len(envios)} arquivo(s), {mb:.1f} MB em {seg:.1f} s"
+
+
+# =========================
+# Runner SQL (IN multi-carteiras)
+# =========================
+def build_sql_and_params(sql_template: str, carteiras: list[int], extra: dict | None = None) -> tuple[str, list]:
+    """
+    (Opção 2) Montagem determinística dos parâmetros:
+      - Para cada ocorrência de {cod_cli} no template, adiciona a lista completa de carteiras
+        (e, na mesma ordem do texto, os valores de cada {_v_...} de _filtros/_amostra)
+      - Depois adiciona os parâmetros de cauda (_tail_params)
+    """
+    if not carteiras:
+        raise ValueError("Nenhuma carteira selecionada.")
+
+    extra = extra or {}
+    valores_filtro: dict[str, list] = {}
+    if _corta_na_origem(extra):
+        sql_template, valores_filtro = _template_com_filtros(sql_template, extra)
+
+    # Quantas vezes o template usa {cod_cli}
+    cod_cli_occurrences = sql_template.count("{cod_cli}")
+    if cod_cli_occurrences <= 0:
+        raise ValueError("SQL template não contém {cod_cli}.")
+
+    in_placeholders = ", ".join(["%s"] * len(carteiras))
+
+    sql = sql_template.format(
+        cod_cli=in_placeholders,
+        tel_limit=TEL_LIMIT_FIXO,
+        dt_ini_filter=extra.get("dt_ini_filter", ""),
+        dt_fim_filter=extra.get("dt_fim_filter", ""),
+        infoad_filter=extra.get("infoad_filter", ""),
+        vlrparc_having=extra.get("vlrparc_having", ""),
+        having_filter=extra.get("having_filter", ""),
+        hist_cad_ref_col=extra.get("hist_cad_ref_col", HIST_CAD_REF_COL),  # (Opção 1)
+        **{nome: ", ".join(["%s"] * len(v)) for nome, v in valores_filtro.items()},
+    )
+
+    tail_params = extra.get("_tail_params", None)
+    if tail_params is None:
+        tail_params = extra.get("_date_params", []) or []
+    else:
+        tail_params = tail_params or []
+
+    params: list = []
+    for m in _RE_PLACEHOLDER_POSICIONAL.finditer(sql_template):
+        if m.group(1) == "cod_cli":
+            params.extend(carteiras)
+        elif m.group(1) != "infoad_filter":
+            params.extend(valores_filtro[m.group(1)])
+    params.extend(tail_params)
+
+    _marcar_para_plano(sql)
+    return sql, params
+
+
+def _abrir_conexao():
+    if DRIVER_MODO == "replay":
+        return _ConexaoReplay(REPLAY_RITMO)
+    creds = parse_credentials_from_file(CRED_FILE_PATH)
+    conn = mysql.connector.connect(**creds)
+    return _ConexaoGravando(conn) if DRIVER_MODO == "gravar" else conn
+
+
+def _ler_sql_blocos(conn, sql: str, params: list | None = None, chunksize: int = 50_000):
+    """
+    Executa o SQL e devolve o resultado em DataFrames de até `chunksize` linhas
+    (fetchmany), sem materializar tudo de uma vez no cliente.
+    """
+    _capturar_plano(conn, sql, params)
+    cur = conn.cursor()
+    try:
+        t0 = time.perf_counter()
+        cur.execute(sql, params or ())
+        cols = [d[0] for d in cur.description]
+        while True:
+            rows = cur.fetchmany(chunksize)
+            _somar_etapa("banco", time.perf_counter() - t0)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(rows, columns=cols, coerce_float=True)
+            t0 = time.perf_counter()
+    finally:
+        cur.close()
+
+
+def _ler_sql(conn, sql: str, params: list | None = None) -> pd.DataFrame:
+    _capturar_plano(conn, sql, params)
+    cur = conn.cursor()
+    try:
+        with _etapa("banco"):
+            cur.execute(sql, params or ())
+            cols = [d[0] for d in cur.description]
+            rows = cur.fetchall()
+    finally:
+        cur.close()
+    return pd.DataFrame.from_records(rows, columns=cols, coerce_float=True)
+
+
+def run_query(sql_template: str, carteiras: list[int], extra: dict | None = None) -> pd.DataFrame:
+    extra = extra or {}
+
+    consulta = extra.get("_nome_consulta") or _nome_consulta(sql_template)
+    with _registrando_execucao(consulta, carteiras, extra) as reg, _etapa("consulta"):
+        if extra.get("_cache"):
+            df = _run_com_cache(sql_template, carteiras, extra)
+        else:
+            df = _run_query_direto(sql_template, carteiras, extra)
+        if extra.get("_colunas"):
+            df = _selecionar_colunas(df, extra["_colunas"])
+        reg["linhas"] = len(df)
+        return df
+
+
+def _run_query_direto(sql_template: str, carteiras: list[int], extra: dict) -> pd.DataFrame:
+    if extra.get("_replica"):
+        return _run_replica(sql_template, carteiras, extra)
+
+    # Rollup e índice de segmentos não sabem aplicar _filtros/_amostra: com eles, vai ao banco
+    if extra.get("_cpc_rollup") and sql_template == SQL_CPC_PERIODO and not _corta_na_origem(extra):
+        return cpc_periodo_rollup(carteiras, extra.get("_dt_ini"), extra.get("_dt_fim"))
+
+    if extra.get("_por_carteira") and len(carteiras) > 1 and _particionavel_por_carteira(sql_template):
+        return _run_por_carteira(sql_template, carteiras, extra)
+
+    # Daqui em diante a base vai ao banco: espera a vez no orçamento global (ver _admissao)
+    with _admissao(extra.get("_nome_consulta") or _nome_consulta(sql_template)):
+        chaves_segmento = segmentos = None
+        if extra.get("_indice_segmentos"):
+            expr = None if _corta_na_origem(extra) else _expr_segmentos_para(sql_template, carteiras)
+            chaves_segmento = _expr_chaves_segmentos(sql_template, carteiras)
+            if expr or chaves_segmento:
+                segmentos = _segmentos_para_uso(expr or chaves_segmento)
+            if segmentos is None:
+                chaves_segmento = None
+            elif expr:
+                return publico_por_segmentos(expr, segmentos)
+
+        if extra.get("_blocos") and _motivo_sem_blocos(sql_template) is None:
+            return _run_em_blocos(sql_template, carteiras, extra)
+
+        conn = _abrir_conexao()
+        try:
+            if extra.get("_superbase") and _superbase_alvo(sql_template):
+                return _run_superbase(conn, sql_template, carteiras, extra)
+
+            if chaves_segmento:
+                sql_template = _template_com_chaves_segmento(conn, sql_template, chaves_segmento, segmentos)
+
+            if extra.get("_antijoin") and _modo_antijoin(sql_template):
+                sql_template = _preparar_antijoin(
+                    conn, sql_template, extra["_antijoin"], extra.get("hist_cad_ref_col", HIST_CAD_REF_COL)
+                )
+
+            if extra.get("_staging") and _usa_staging(sql_template) and _garantir_staging(conn):
+                sql_template = _template_com_staging(sql_template, extra)
+
+            if extra.get("_valores_cliente") and _suporta_valores_cliente(sql_template):
+                return _run_valores_cliente(conn, sql_template, carteiras, extra)
+            sql, params = build_sql_and_params(_projetar(sql_template, extra), carteiras, extra=extra)
+            return _ler_sql(conn, sql, params)
+        finally:
+            conn.close()
+
+
+# =========================
+# Driver de gravação / replay (benchmarks offline)
+# =========================
+# DRIVER_MODO = "gravar": _abrir_conexao embrulha a conexão real e cada execute grava
+# description + lotes de linhas (com o tempo de cada fetch) em GRAVACAO_DIR, um .jsonl.gz
+# por SQL/parâmetros. Colunas com dados pessoais (_RE_COLUNA_PII) viram hash com sal local.
+# DRIVER_MODO = "replay": nenhuma conexão é aberta; os cursores devolvem o que foi gravado,
+# na velocidade máxima ("rapido") ou nos tempos gravados ("gravado"). Assim o lado Python
+# (DataFrame, Excel, UI) roda e é medido (histórico de execuções) sem acesso à produção.
+# A gravação tem de ser do mesmo SQL e dos mesmos parâmetros; usar a de outros parâmetros
+# (outras carteiras) só com REPLAY_SUBSTITUIR ligado, e cada troca é avisada no stderr.
+GRAVACAO_DIR = os.path.join(LOCAL_DATA_DIR, "gravacoes")
+GRAVACAO_SAL_PATH = os.path.join(LOCAL_DATA_DIR, "gravacao.sal")  # fora de GRAVACAO_DIR: não vai junto
+DRIVER_MODO = os.environ.get("GERADOR_DRIVER", "")  # "" | "gravar" | "replay"
+REPLAY_RITMO = os.environ.get("GERADOR_REPLAY_RITMO", "rapido")  # "rapido" | "gravado"
+REPLAY_RITMOS = ("rapido", "gravado")
+REPLAY_SUBSTITUIR = os.environ.get("GERADOR_REPLAY_SUBSTITUIR", "") == "1"
+
+_RE_COLUNA_PII = re.compile(
+    r"nome|cpf|cnpj|email|fone|telefone|obs|placa|nascto|nascimento|endereco|bindingid", re.IGNORECASE
+)
+_RE_SQL_COM_RESULTADO = re.compile(r"^\s*(SELECT|WITH|EXPLAIN|ANALYZE|SHOW|DESCRIBE)\b", re.IGNORECASE)
+
+
+def _sal_gravacao() -> bytes:
+    if not os.path.exists(GRAVACAO_SAL_PATH):
+        os.makedirs(LOCAL_DATA_DIR, exist_ok=True)
+        with open(GRAVACAO_SAL_PATH, "w", encoding="ascii") as f:
+            f.write(os.urandom(16).hex())
+    with open(GRAVACAO_SAL_PATH, "r", encoding="ascii") as f:
+        return bytes.fromhex(f.read().strip())
+
+
+def _anonimizar(v, sal: bytes):
+    """Hash determinístico que mantém tipo e tamanho (larguras do Excel continuam realistas)."""
+    if v is None:
+        return None
+    if isinstance(v, (datetime.date, datetime.datetime)):
+        return v.replace(month=1, day=1)
+    bruto = v.decode("utf-8", "replace") if isinstance(v, (bytes, bytearray)) else str(v)
+    h = hashlib.sha256(sal + bruto.encode("utf-8")).hexdigest()
+    if isinstance(v, int) or bruto.isdigit():
+        digitos = str(int(h, 16))[:len(bruto)].rjust(len(bruto), "0")
+        return int(digitos) if isinstance(v, int) else digitos
+    return (h * (len(bruto) // len(h) + 1))[:len(bruto)]
+
+
+def _codificar_valor(v):
+    if isinstance(v, Decimal):
+        return {"$dec": str(v)}
+    if isinstance(v, datetime.datetime):
+        return {"$dt": v.isoformat()}
+    if isinstance(v, datetime.date):
+        return {"$d": v.isoformat()}
+    if isinstance(v, datetime.timedelta):
+        return {"$td": v.total_seconds()}
+    if isinstance(v, (bytes, bytearray)):
+        return {"$b": base64.b64encode(bytes(v)).decode("ascii")}
+    if isinstance(v, (set, frozenset)):
+        return sorted(v)
+    raise TypeError(f"Tipo não gravável: {type(v).__name__}")
+
+
+def _decodificar_valor(o: dict):
+    if len(o) != 1:
+        return o
+    k, v = next(iter(o.items()))
+    if k == "$dec":
+        return Decimal(v)
+    if k == "$dt":
+        return datetime.datetime.fromisoformat(v)
+    if k == "$d":
+        return datetime.date.fromisoformat(v)
+    if k == "$td":
+        return datetime.timedelta(seconds=v)
+    if k == "$b":
+        return base64.b64decode(v)
+    return o
+
+
+def _arquivo_gravacao(sql: str, params) -> str:
+    h_sql = hashlib.sha1(sql.encode("utf-8")).hexdigest()[:16]
+    h_params = hashlib.sha1(json.dumps(list(params or ()), default=str).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(GRAVACAO_DIR, f"{h_sql}_{h_params}.jsonl.gz")
+
+
+def _localizar_gravacao(sql: str, params) -> str | None:
+    """
+    Gravação do mesmo SQL e parâmetros. Com REPLAY_SUBSTITUIR, na falta dela, usa a mais
+    recente do mesmo SQL (com outros parâmetros) e avisa a troca.
+    """
+    path = _arquivo_gravacao(sql, params)
+    if os.path.exists(path):
+        return path
+    if not REPLAY_SUBSTITUIR:
+        return None
+    prefixo = os.path.basename(path).split("_", 1)[0] + "_"
+    try:
+        cands = [os.path.join(GRAVACAO_DIR, n) for n in os.listdir(GRAVACAO_DIR) if n.startswith(prefixo)]
+    except FileNotFoundError:
+        return None
+    if not cands:
+        return None
+    subst = max(cands, key=os.path.getmtime)
+    print(
+        f"[replay] sem gravação para os parâmetros {list(params or ())}; "
+        f"usando {os.path.basename(subst)} (outros parâmetros)",
+        file=sys.stderr,
+    )
+    return subst
+
+
+class _CursorGravando:
+    def __init__(self, cur):
+        self._cur = cur
+        self._arq = None
+
+    def __getattr__(self, nome):
+        return getattr(self._cur, nome)
+
+    def execute(self, sql, params=()):
+        self._fechar_arquivo()
+        t0 = time.perf_counter()
+        self._cur.execute(sql, params)
+        dt = time.perf_counter() - t0
+
+        desc = self._cur.description
+        self._pii = [bool(_RE_COLUNA_PII.search(d[0])) for d in desc] if desc else []
+        self._sal = _sal_gravacao() if any(self._pii) else b""
+        os.makedirs(GRAVACAO_DIR, exist_ok=True)
+        self._path = _arquivo_gravacao(sql, params)
+        self._arq = gzip.open(self._path + ".tmp", "wt", encoding="utf-8", compresslevel=6)
+        self._arq.write(json.dumps({
+            "sql": sql,
+            "params": list(params or ()),
+            "description": [list(d) for d in desc] if desc else None,
+            "t": dt,
+            "gravado_em": _fmt_ts(pd.Timestamp.now()),
+        }, default=str) + "\n")
+        self._t = time.perf_counter()
+
+    def executemany(self, sql, seq_params):
+        return self._cur.executemany(sql, seq_params)  # só escrita (tabelas temporárias): não é gravado
+
+    def _gravar_lote(self, rows):
+        if self._arq is None:
+            return
+        if any(self._pii):
+            rows = [tuple(_anonimizar(v, self._sal) if p else v for p, v in zip(self._pii, r)) for r in rows]
+        agora = time.perf_counter()
+        self._arq.write(json.dumps({"t": agora - self._t, "rows": rows}, default=_codificar_valor) + "\n")
+        self._t = agora
+
+    def fetchmany(self, size=1):
+        rows = self._cur.fetchmany(size)
+        self._gravar_lote(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cur.fetchall()
+        self._gravar_lote(rows)
+        return rows
+
+    def _fechar_arquivo(self):
+        if self._arq is not None:
+            self._arq.close()
+            os.replace(self._path + ".tmp", self._path)
+            self._arq = None
+
+    def close(self):
+        try:
+            self._fechar_arquivo()
+        finally:
+            self._cur.close()
+
+
+class _ConexaoGravando:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, nome):
+        return getattr(self._conn, nome)
+
+    def cursor(self, *args, **kwargs):
+        return _CursorGravando(self._conn.cursor(*args, **kwargs))
+
+
+class _CursorReplay:
+    def __init__(self, ritmo: str):
+        self._ritmo = ritmo
+        self._lotes = iter(())
+        self._buffer: list = []
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, sql, params=()):
+        self._buffer, self._lotes, self.description = [], iter(()), None
+        path = _localizar_gravacao(sql, params)
+        if path is None:
+            if not _RE_SQL_COM_RESULTADO.match(sql):
+                return  # DDL/DML sem gravação (tabelas temporárias, staging): nada a devolver
+            raise LookupError(
+                f"Sem gravação para este SQL com estes parâmetros em {GRAVACAO_DIR} "
+                f"(parâmetros: {list(params or ())[:20]}). Grave de novo com --gravar para estas "
+                f"carteiras, ou use --replay-substituir para aceitar a de outros parâmetros:\n"
+                f"{sql.strip()[:300]}"
+            )
+
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            cab = json.loads(f.readline())
+            lotes = [json.loads(linha, object_hook=_decodificar_valor) for linha in f]
+        self.description = [tuple(d) for d in cab["description"]] if cab["description"] else None
+        self._lotes = iter(lotes)
+        self._esperar(cab["t"])
+
+    def executemany(self, sql, seq_params):
+        pass
+
+    def _esperar(self, segundos: float):
+        if self._ritmo == "gravado" and segundos > 0:
+            time.sleep(segundos)
+
+    def _encher(self, n: int | None):
+        while n is None or len(self._buffer) < n:
+            lote = next(self._lotes, None)
+            if lote is None:
+                break
+            self._esperar(lote["t"])
+            self._buffer.extend(tuple(r) for r in lote["rows"])
+
+    def fetchmany(self, size=1):
+        self._encher(size)
+        rows, self._buffer = self._buffer[:size], self._buffer[size:]
+        return rows
+
+    def fetchall(self):
+        self._encher(None)
+        rows, self._buffer = self._buffer, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class _ConexaoReplay:
+    def __init__(self, ritmo: str):
+        self._ritmo = ritmo
+
+    def cursor(self, *args, **kwargs):
+        return _CursorReplay(self._ritmo)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# =========================
+# Histórico de execuções e planos (EXPLAIN / ANALYZE FORMAT=JSON)
+# =========================
+# Toda chamada de run_query vira uma linha em `execucoes` (duração, linhas, erro).
+# Com a opção de plano ligada, cada SQL montado por build_sql_and_params tem o plano
+# capturado na mesma conexão, logo antes de rodar, e guardado junto da execução.
+# relatorio_planos() compara os planos entre execuções de cada base.
+HISTORICO_DB_PATH = os.path.join(LOCAL_DATA_DIR, "historico.sqlite")
+PLANOS_OPCOES = [
+    ("Não capturar plano", None),
+    ("EXPLAIN FORMAT=JSON", "explain"),
+    ("ANALYZE FORMAT=JSON (executa a consulta 2x)", "analyze"),
+]
+PLANOS_FATOR_LINHAS = 2.0  # variação de estimativa de linhas que aparece no relatório
+PLANOS_ACESSOS_FULL_SCAN = ("ALL", "index")
+
+_HISTORICO_SCHEMA = """
+CREATE TABLE IF NOT EXISTS execucoes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    consulta TEXT NOT NULL,
+    carteiras TEXT NOT NULL,
+    iniciado_em TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS planos (
+    execucao_id INTEGER NOT NULL REFERENCES execucoes (id),
+    seq INTEGER NOT NULL,
+    modo TEXT NOT NULL,
+    sql_hash TEXT NOT NULL,
+    sql TEXT NOT NULL,
+    plano TEXT NOT NULL,
+    PRIMARY KEY (execucao_id, seq)
+);
+CREATE INDEX IF NOT EXISTS ix_execucoes_consulta ON execucoes (consulta, id);
+"""
+
+# Colunas acrescentadas depois da criação da tabela (bancos antigos ganham via ALTER TABLE)
+_HISTORICO_COLUNAS = {
+    "execucoes": {
+        "duracao_s": "REAL", "linhas": "INTEGER", "linhas_est": "REAL", "erro": "TEXT",
+        "params": "TEXT", "etapas": "TEXT", "bytes": "INTEGER", "rss_pico_mb": "REAL",
+        "cache_hits": "INTEGER", "cache_misses": "INTEGER", "estrategia": "TEXT", "forma": "TEXT",
+    },
+}
+HISTORICO_BASELINE_N = 30  # execuções que formam a linha de base de cada base
+HISTORICO_RECENTES_N = 5  # execuções recentes comparadas com a linha de base
+HISTORICO_FATOR_REGRESSAO = 1.5  # alerta: p50 recente > fator x p50 da base (e acima do p95)
+HISTORICO_SEMANAS = 8
+RSS_AMOSTRAGEM_S = 0.5  # intervalo de leitura da memória residente durante a execução
+
+_execucao_ctx = threading.local()
+
+
+def _nome_consulta(sql_template: str) -> str:
+    for nome, (tpl, _, _) in QUERIES.items():
+        if tpl == sql_template:
+            return nome
+    return "(fora de QUERIES)"
+
+
+def _abrir_historico() -> sqlite3.Connection:
+    loc = _abrir_local(HISTORICO_DB_PATH)
+    loc.executescript(_HISTORICO_SCHEMA)
+    for tabela, colunas in _HISTORICO_COLUNAS.items():
+        existentes = {r[1] for r in loc.execute(f"PRAGMA table_info({tabela})")}
+        for col, tipo in colunas.items():
+            if col not in existentes:
+                loc.execute(f"ALTER TABLE {tabela} ADD COLUMN {col} {tipo}")
+    return loc
+
+
+def _rss_atual_mb() -> float | None:
+    """Memória residente (MB) do processo neste instante; None se a plataforma não informa."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class _PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        pmc = _PROCESS_MEMORY_COUNTERS()
+        pmc.cb = ctypes.sizeof(pmc)
+        processo = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(processo, ctypes.byref(pmc), pmc.cb):
+            return None
+        return pmc.WorkingSetSize / (1024 * 1024)
+    except (AttributeError, OSError):
+        return None
+
+
+@contextmanager
+def _amostrando_rss():
+    """
+    Lê a memória residente a cada RSS_AMOSTRAGEM_S enquanto o bloco roda e guarda o maior
+    valor em ["pico"] (None se a plataforma não informa). O pico do processo desde que abriu
+    (ru_maxrss) não serve: na tela e no servidor ele carrega as execuções anteriores.
+    """
+    amostra = {"pico": _rss_atual_mb()}
+    if amostra["pico"] is None:
+        yield amostra
+        return
+    parar = threading.Event()
+
+    def _amostrar():
+        while not parar.wait(RSS_AMOSTRAGEM_S):
+            atual = _rss_atual_mb()
+            if atual is not None and atual > amostra["pico"]:
+                amostra["pico"] = atual
+
+    t = threading.Thread(target=_amostrar, name="rss-execucao", daemon=True)
+    t.start()
+    try:
+        yield amostra
+    finally:
+        parar.set()
+        t.join()
+        atual = _rss_atual_mb()
+        if atual is not None and atual > amostra["pico"]:
+            amostra["pico"] = atual
+
+
+def _params_para_historico(extra: dict) -> str:
+    return json.dumps({k: v for k, v in extra.items() if k != "_linhas_est"}, default=str, sort_keys=True)
+
+
+@contextmanager
+def _registrando_execucao(consulta: str, carteiras: list[int], extra: dict):
+    """
+    Registra a execução em `execucoes`. Reentrante: chamadas internas (run_query dentro
+    do job da UI) reaproveitam o registro de fora, que cobre também a escrita do Excel.
+    """
+    atual = getattr(_execucao_ctx, "atual", None)
+    if atual is not None:
+        yield atual
+        return
+
+    with closing(_abrir_historico()) as loc:
+        cur = loc.execute(
+            "INSERT INTO execucoes (consulta, carteiras, iniciado_em, linhas_est, params, estrategia, forma) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (consulta, json.dumps(sorted(carteiras)), _fmt_ts(pd.Timestamp.now()),
+             extra.get("_linhas_est"), _params_para_historico(extra), _estrategia_de(extra), _forma_parametros(extra)),
+        )
+        loc.commit()
+    reg = {
+        "execucao_id": cur.lastrowid,
+        "modo": extra.get("_planos"),
+        "renderizados": set(),
+        "linhas": None,
+        "bytes": None,
+        "etapas": {},
+        "cache_hits": 0,
+        "cache_misses": 0,
+    }
+    _execucao_ctx.atual = reg
+    t0 = time.perf_counter()
+    erro = None
+    try:
+        with _amostrando_rss() as rss:
+            yield reg
+    except Exception as e:
+        erro = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _execucao_ctx.atual = None
+        with closing(_abrir_historico()) as loc:
+            loc.execute(
+                "UPDATE execucoes SET duracao_s = ?, linhas = ?, erro = ?, etapas = ?, bytes = ?, "
+                "rss_pico_mb = ?, cache_hits = ?, cache_misses = ? WHERE id = ?",
+                (
+                    time.perf_counter() - t0, reg["linhas"], erro,
+                    json.dumps({k: round(v, 3) for k, v in reg["etapas"].items()}),
+                    reg["bytes"], rss["pico"], reg["cache_hits"], reg["cache_misses"],
+                    reg["execucao_id"],
+                ),
+            )
+            loc.commit()
+
+
+def _somar_etapa(nome: str, segundos: float):
+    atual = getattr(_execucao_ctx, "atual", None)
+    if atual is not None:
+        atual["etapas"][nome] = atual["etapas"].get(nome, 0.0) + segundos
+
+
+@contextmanager
+def _etapa(nome: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _somar_etapa(nome, time.perf_counter() - t0)
+
+
+def _contar_cache(hit: bool):
+    atual = getattr(_execucao_ctx, "atual", None)
+    if atual is not None:
+        atual["cache_hits" if hit else "cache_misses"] += 1
+
+
+def _execucoes_para_tendencia() -> pd.DataFrame:
+    # Execuções com acerto de cache não medem o banco: ficam fora das tendências
+    with closing(_abrir_historico()) as loc:
+        df = pd.read_sql_query(
+            "SELECT id, consulta, iniciado_em, duracao_s FROM execucoes "
+            "WHERE erro IS NULL AND duracao_s IS NOT NULL AND COALESCE(cache_hits, 0) = 0 "
+            "ORDER BY id",
+            loc,
+        )
+    df["iniciado_em"] = pd.to_datetime(df["iniciado_em"])
+    return df
+
+
+def tendencias_execucoes() -> pd.DataFrame:
+    """Por base: nº de execuções, p50/p95 da linha de base, p50 recente e alerta de regressão."""
+    df = _execucoes_para_tendencia()
+    linhas = []
+    for consulta, g in df.groupby("consulta", sort=True):
+        recentes = g.tail(HISTORICO_RECENTES_N)["duracao_s"]
+        base = g.iloc[:-HISTORICO_RECENTES_N].tail(HISTORICO_BASELINE_N)["duracao_s"]
+        ref = base if len(base) >= HISTORICO_RECENTES_N else g["duracao_s"]
+        p50, p95, rec = ref.quantile(0.5), ref.quantile(0.95), recentes.quantile(0.5)
+        alerta = ref is base and rec > HISTORICO_FATOR_REGRESSAO * p50 and rec > p95
+        linhas.append({
+            "consulta": consulta,
+            "execucoes": len(g),
+            "p50_s": p50,
+            "p95_s": p95,
+            "recente_p50_s": rec,
+            "alerta": f"REGRESSÃO: {rec / p50:.1f}x a mediana" if alerta else "",
+        })
+    return pd.DataFrame(linhas, columns=["consulta", "execucoes", "p50_s", "p95_s", "recente_p50_s", "alerta"])
+
+
+def ultimas_execucoes(n: int = 200) -> pd.DataFrame:
+    with closing(_abrir_historico()) as loc:
+        return pd.read_sql_query(
+            "SELECT id, iniciado_em, consulta, carteiras, duracao_s, linhas, bytes, rss_pico_mb, "
+            "cache_hits, cache_misses, etapas, erro FROM execucoes ORDER BY id DESC LIMIT ?",
+            loc,
+            params=(n,),
+        )
+
+
+def relatorio_historico() -> str:
+    """p50/p95 por semana de cada base (últimas HISTORICO_SEMANAS), erros e alertas de regressão."""
+    df = _execucoes_para_tendencia()
+    if df.empty:
+        return "Nenhuma execução registrada."
+
+    df["semana"] = df["iniciado_em"].dt.to_period("W").astype(str)
+    with closing(_abrir_historico()) as loc:
+        erros = dict(loc.execute("SELECT consulta, COUNT(*) FROM execucoes WHERE erro IS NOT NULL GROUP BY consulta"))
+    tend = tendencias_execucoes().set_index("consulta")
+
+    saida = []
+    for consulta, g in df.groupby("consulta", sort=True):
+        saida.append(f"== {consulta} ({len(g)} execuções, {erros.get(consulta, 0)} com erro)")
+        semanas = g.groupby("semana")["duracao_s"].agg(
+            n="count", p50=lambda x: x.quantile(0.5), p95=lambda x: x.quantile(0.95)
+        ).tail(HISTORICO_SEMANAS)
+        for semana, r in semanas.iterrows():
+            saida.append(f"  {semana}  n={int(r['n']):>3}  p50={r['p50']:>8.1f}s  p95={r['p95']:>8.1f}s")
+        alerta = tend.loc[consulta, "alerta"]
+        if alerta:
+            saida.append(
+                f"  !! {alerta} (recente {tend.loc[consulta, 'recente_p50_s']:.1f}s; "
+                f"base p50 {tend.loc[consulta, 'p50_s']:.1f}s / p95 {tend.loc[consulta, 'p95_s']:.1f}s)"
+            )
+        saida.append("")
+    return "\n".join(saida)
+
+
+def _marcar_para_plano(sql: str):
+    atual = getattr(_execucao_ctx, "atual", None)
+    if atual and atual["modo"]:
+        atual["renderizados"].add(sql)
+
+
+def _capturar_plano(conn, sql: str, params: list | None):
+    atual = getattr(_execucao_ctx, "atual", None)
+    if not atual or sql not in atual["renderizados"]:
+        return
+    prefixo = "ANALYZE FORMAT=JSON " if atual["modo"] == "analyze" else "EXPLAIN FORMAT=JSON "
+    cur = conn.cursor()
+    try:
+        cur.execute(prefixo + sql, params or ())
+        plano = cur.fetchall()[0][0]
+    except (mysql.connector.Error, LookupError):
+        return  # plano é diagnóstico: não derruba a exportação (LookupError: replay sem o EXPLAIN gravado)
+    finally:
+        cur.close()
+
+    # seq calculado no INSERT: o fan-out por carteira captura planos da mesma execução em paralelo
+    with closing(_abrir_historico()) as loc:
+        loc.execute(
+            "INSERT INTO planos (execucao_id, seq, modo, sql_hash, sql, plano) "
+            "SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ? FROM planos WHERE execucao_id = ?",
+            (atual["execucao_id"], atual["modo"], hashlib.sha1(sql.encode("utf-8")).hexdigest(), sql, plano,
+             atual["execucao_id"]),
+        )
+        loc.commit()
+
+
+def _resumo_plano(plano_json: str) -> dict:
+    """Tabelas (alias, acesso, chave, linhas estimadas/reais) e contadores de full scan/temporária/filesort."""
+    resumo = {"tabelas": [], "full_scan": 0, "temporaria": 0, "filesort": 0}
+
+    def visitar(no):
+        if isinstance(no, list):
+            for x in no:
+                visitar(x)
+            return
+        if not isinstance(no, dict):
+            return
+        for k, v in no.items():
+            if k == "table" and isinstance(v, dict) and "table_name" in v:
+                acesso = v.get("access_type")
+                resumo["tabelas"].append({
+                    "tabela": v["table_name"],
+                    "acesso": acesso,
+                    "chave": v.get("key"),
+                    "linhas": v.get("rows", v.get("rows_examined_per_scan")),
+                    "r_linhas": v.get("r_rows"),
+                })
+                if acesso in PLANOS_ACESSOS_FULL_SCAN:
+                    resumo["full_scan"] += 1
+            elif k == "temporary_table" or (k == "using_temporary_table" and v is True):
+                resumo["temporaria"] += 1
+            elif k == "filesort" or (k == "using_filesort" and v is True):
+                resumo["filesort"] += 1
+            visitar(v)
+
+    visitar(json.loads(plano_json))
+    return resumo
+
+
+def _fmt_linhas(v) -> str:
+    return "?" if v is None else f"{float(v):,.0f}".replace(",", ".")
+
+
+def _diff_planos(antes: dict, depois: dict) -> list[str]:
+    linhas = []
+    for chave, rotulo in (("full_scan", "full scans"), ("temporaria", "temporárias"), ("filesort", "filesorts")):
+        if antes[chave] != depois[chave]:
+            linhas.append(f"{rotulo}: {antes[chave]} -> {depois[chave]}")
+
+    # Casa as tabelas pelo alias (e ordem de aparição, para aliases repetidos em CTEs)
+    def indexar(tabs):
+        vistos: dict[str, int] = {}
+        out = {}
+        for t in tabs:
+            n = vistos.get(t["tabela"], 0)
+            vistos[t["tabela"]] = n + 1
+            out[(t["tabela"], n)] = t
+        return out
+
+    a, d = indexar(antes["tabelas"]), indexar(depois["tabelas"])
+    for k in sorted(set(a) | set(d), key=str):
+        ta, td = a.get(k), d.get(k)
+        if ta is None or td is None:
+            linhas.append(f"{'+' if ta is None else '-'} tabela {k[0]}")
+            continue
+        if (ta["acesso"], ta["chave"]) != (td["acesso"], td["chave"]):
+            alerta = "  << FULL SCAN" if td["acesso"] in PLANOS_ACESSOS_FULL_SCAN else ""
+            linhas.append(
+                f"~ {k[0]}: {ta['acesso']}/{ta['chave'] or '-'} -> {td['acesso']}/{td['chave'] or '-'}{alerta}"
+            )
+        la, ld = ta["linhas"], td["linhas"]
+        if la and ld and max(la, ld) / max(min(la, ld), 1) >= PLANOS_FATOR_LINHAS:
+            linhas.append(f"~ {k[0]}: linhas estimadas {_fmt_linhas(la)} -> {_fmt_linhas(ld)}")
+    return linhas
+
+
+def relatorio_planos(consulta: str | None = None) -> str:
+    """
+    Para cada base (ou só `consulta`), resume o plano da última execução capturada e,
+    havendo uma anterior, o que mudou: acesso/índice por tabela, full scans,
+    tabelas temporárias, filesorts e estimativas de linhas (fator >= PLANOS_FATOR_LINHAS).
+    """
+    with closing(_abrir_historico()) as loc:
+        execs = pd.read_sql_query(
+            "SELECT e.id, e.consulta, e.carteiras, e.iniciado_em FROM execucoes e "
+            "WHERE EXISTS (SELECT 1 FROM planos p WHERE p.execucao_id = e.id) ORDER BY e.id",
+            loc,
+        )
+        planos = pd.read_sql_query("SELECT execucao_id, seq, plano FROM planos", loc)
+
+    if consulta:
+        execs = execs[execs["consulta"] == consulta]
+    if execs.empty:
+        return "Nenhum plano capturado."
+
+    saida = []
+    for nome, grupo in execs.groupby("consulta", sort=True):
+        ultimas = grupo.tail(2).to_dict("records")
+        atual = ultimas[-1]
+        anterior = ultimas[0] if len(ultimas) == 2 else None
+        cab = f"== {nome}: execução #{atual['id']} ({atual['iniciado_em']}, carteiras {atual['carteiras']})"
+        if anterior:
+            cab += f" vs #{anterior['id']} ({anterior['iniciado_em']})"
+        saida.append(cab)
+
+        def por_seq(exec_id):
+            sel = planos[planos["execucao_id"] == exec_id]
+            return {int(r.seq): _resumo_plano(r.plano) for r in sel.itertuples()}
+
+        p_atual = por_seq(atual["id"])
+        p_ant = por_seq(anterior["id"]) if anterior else {}
+        for seq, res in sorted(p_atual.items()):
+            scans = [t["tabela"] for t in res["tabelas"] if t["acesso"] in PLANOS_ACESSOS_FULL_SCAN]
+            saida.append(
+                f"  [{seq}] full scans: {res['full_scan']} ({', '.join(scans) or '-'}), "
+                f"temporárias: {res['temporaria']}, filesorts: {res['filesort']}"
+            )
+            if seq in p_ant:
+                mudancas = _diff_planos(p_ant[seq], res)
+                saida.extend(f"      {m}" for m in mudancas or ["(plano igual)"])
+        saida.append("")
+    return "\n".join(saida)
+
+
+# =========================
+# Pre-flight: custo estimado antes de rodar
+# =========================
+# EXPLAIN do SQL montado + histórico de execuções da base estimam linhas examinadas e
+# duração. Acima dos limites da base (LIMITES_CONSULTA, chave = nome em QUERIES):
+#   - "avisar":      pede confirmação
+#   - "fila":        no horário de pico, grava o pedido em FILA_DIR (rodar com --processar-fila)
+#   - "alternativa": troca para a estratégia em "alternativa" (flags de extra)
+HORARIO_PICO = (8, 18)  # [início, fim) em dias úteis
+FILA_DIR = os.path.join(LOCAL_DATA_DIR, "fila")
+PREFLIGHT_HISTORICO_N = 20
+
+LIMITES_CONSULTA = {
+    "Telefones + Melhor Contato (Top 7)": {
+        "linhas_max": 30_000_000, "segundos_max": 300, "acao": "avisar",
+    },
+    "CPC por Periodo (datas)": {
+        "linhas_max": 50_000_000, "segundos_max": 300, "acao": "alternativa",
+        "alternativa": {"_cpc_rollup": True},
+    },
+    "Sem Historico (ultimos 30 dias)": {
+        "linhas_max": 50_000_000, "segundos_max": 300, "acao": "alternativa",
+        "alternativa": {"_antijoin": "temp"},
+    },
+    "Quebras Rejeitadas": {
+        "linhas_max": 50_000_000, "segundos_max": 600, "acao": "alternativa",
+        "alternativa": {"_superbase": True, "_cache": True},
+    },
+    "Nunca Contatados": {
+        "linhas_max": 50_000_000, "segundos_max": 600, "acao": "fila",
+    },
+    "Base Recentes": {
+        "linhas_max": 50_000_000, "segundos_max": 600, "acao": "alternativa",
+        "alternativa": {"_superbase": True, "_cache": True},
+    },
+    "Maiores Dividas (valor minimo)": {
+        "linhas_max": 30_000_000, "segundos_max": 300, "acao": "avisar",
+    },
+}
+
+
+def em_horario_de_pico(agora: pd.Timestamp | None = None) -> bool:
+    agora = agora or pd.Timestamp.now()
+    return agora.dayofweek < 5 and HORARIO_PICO[0] <= agora.hour < HORARIO_PICO[1]
+
+
+def _linhas_examinadas_estimadas(plano_json: str) -> float:
+    """Soma, por bloco, do produto das linhas estimadas das tabelas do nested loop."""
+    total = 0.0
+
+    def visitar(no):
+        nonlocal total
+        if isinstance(no, list):
+            for x in no:
+                visitar(x)
+            return
+        if not isinstance(no, dict):
+            return
+        for k, v in no.items():
+            if k == "nested_loop" and isinstance(v, list):
+                prod = 1.0
+                for item in v:
+                    tab = item.get("table", {}) if isinstance(item, dict) else {}
+                    prod *= float(tab.get("rows") or 1)
+                    visitar(tab)
+                total += prod
+            elif k == "table" and isinstance(v, dict):
+                total += float(v.get("rows") or 0)
+                visitar(v)
+            else:
+                visitar(v)
+
+    visitar(json.loads(plano_json))
+    return total
+
+
+def _estimar_segundos(consulta: str, linhas_est: float | None) -> float | None:
+    """Duração pela mediana de segundos/linha das últimas execuções (ou mediana da duração)."""
+    with closing(_abrir_historico()) as loc:
+        hist = pd.read_sql_query(
+            "SELECT duracao_s, linhas_est FROM execucoes "
+            "WHERE consulta = ? AND erro IS NULL AND duracao_s IS NOT NULL "
+            "ORDER BY id DESC LIMIT ?",
+            loc,
+            params=(consulta, PREFLIGHT_HISTORICO_N),
+        )
+    if hist.empty:
+        return None
+    com_est = hist[hist["linhas_est"] > 0]
+    if linhas_est and len(com_est) >= 3:
+        return float(linhas_est * (com_est["duracao_s"] / com_est["linhas_est"]).median())
+    return float(hist["duracao_s"].median())
+
+
+def preflight(sql_template: str, carteiras: list[int], extra: dict) -> dict:
+    """
+    Estima o custo e decide o que fazer. Devolve
+    {"linhas_est", "segundos_est", "acao" (None|"avisar"|"fila"|"alternativa"), "motivo", "alternativa"}.
+    """
+    consulta = extra.get("_nome_consulta") or _nome_consulta(sql_template)
+    decisao = {"linhas_est": None, "segundos_est": None, "acao": None, "motivo": "", "alternativa": {}}
+    limite = LIMITES_CONSULTA.get(consulta)
+    if limite is None or extra.get("_replica"):
+        return decisao
+    if extra.get("_cache") and _em_cache(sql_template, carteiras, extra):
+        decisao["motivo"] = "Resultado já está no cache (só falta exportar)."
+        return decisao
+
+    sql, params = build_sql_and_params(_projetar(sql_template, extra), carteiras, extra=extra)
+    conn = _abrir_conexao()
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute("EXPLAIN FORMAT=JSON " + sql, params)
+            plano = cur.fetchall()[0][0]
+        finally:
+            cur.close()
+    finally:
+        conn.close()
+
+    linhas = _linhas_examinadas_estimadas(plano)
+    segundos = _estimar_segundos(consulta, linhas)
+    decisao.update(linhas_est=linhas, segundos_est=segundos)
+
+    excessos = []
+    if linhas > limite["linhas_max"]:
+        excessos.append(f"~{_fmt_linhas(linhas)} linhas examinadas (limite {_fmt_linhas(limite['linhas_max'])})")
+    if segundos is not None and segundos > limite["segundos_max"]:
+        excessos.append(f"~{segundos / 60:.0f} min estimados (limite {limite['segundos_max'] / 60:.0f} min)")
+    if not excessos:
+        return decisao
+
+    acao = limite["acao"]
+    if acao == "fila" and not em_horario_de_pico():
+        acao = "avisar"
+    decisao.update(acao=acao, motivo=f"{consulta}: " + "; ".join(excessos), alternativa=limite.get("alternativa", {}))
+    return decisao
+
+
+def enfileirar(consulta: str, carteiras: list[int], extra: dict, saida: str) -> str:
+    os.makedirs(FILA_DIR, exist_ok=True)
+    criado = pd.Timestamp.now()
+    path = os.path.join(FILA_DIR, f"{criado.strftime('%Y%m%d_%H%M%S_%f')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"consulta": consulta, "carteiras": carteiras, "extra": extra, "saida": saida, "criado_em": _fmt_ts(criado)},
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    return path
+
+
+def processar_fila() -> list[tuple[str, str]]:
+    """Roda os pedidos da fila em ordem de chegada; devolve [(pedido, resultado)]."""
+    if not os.path.isdir(FILA_DIR):
+        return []
+    feitos = []
+    for nome in sorted(n for n in os.listdir(FILA_DIR) if n.endswith(".json")):
+        path = os.path.join(FILA_DIR, nome)
+        with open(path, encoding="utf-8") as f:
+            pedido = json.load(f)
+        sql_template, _, sheet_name = QUERIES[pedido["consulta"]]
+        try:
+            with _registrando_execucao(pedido["consulta"], pedido["carteiras"], pedido["extra"]) as reg:
+                df = run_query(sql_template, pedido["carteiras"], extra=pedido["extra"])
+                with _etapa("excel"):
+                    caminhos = exportar(df, pedido["saida"], sheet_name, pedido["extra"].get("_exportacao"))
+                reg["bytes"] = sum(_tamanho_exportado(p) for p in caminhos)
+            # Fora do pico não há pressa: o pedido só sai da fila com a cópia no destino conferida
+            falhou = any(e["estado"] == "erro" for e in aguardar_envios(caminhos))
+            texto = resumo_envios(caminhos, descartar=True)
+            if falhou:
+                raise OSError(texto)
+        except Exception as e:
+            os.replace(path, path + ".erro")
+            feitos.append((nome, f"erro: {e}"))
+            continue
+        os.remove(path)
+        feitos.append((nome, f"{len(df)} linhas -> {pedido['saida']}"))
+    return feitos
+
+
+# =========================
+# Controle de admissão (orçamento global de consultas no banco)
+# =========================
+# Cada base tem um peso (ADMISSAO_PESOS; padrão 1) e a soma dos pesos rodando no GECOBI não
+# passa de ADMISSAO_ORCAMENTO. Quem espera entra numa fila FIFO de arquivos em ADMISSAO_DIR:
+# só o primeiro da fila pode entrar (uma pesada não é ultrapassada pelas leves). Os arquivos
+# são tocados a cada ADMISSAO_PULSO_S; os parados há mais de ADMISSAO_EXPIRA_S (processo que
+# morreu) são descartados. Para o orçamento valer entre estações, aponte GERADOR_ADMISSAO_DIR
+# para uma pasta compartilhada; com o servidor de jobs, a pasta local do servidor basta.
+# Antes de entrar, se o banco está com Threads_running alto, o primeiro da fila espera também.
+ADMISSAO_DIR = os.environ.get("GERADOR_ADMISSAO_DIR") or os.path.join(LOCAL_DATA_DIR, "admissao")
+ADMISSAO_ORCAMENTO = 6
+ADMISSAO_PESOS = {
+    "Telefones + Melhor Contato (Top 7)": 2,
+    "CPC por Periodo (datas)": 2,
+    "Sem Historico (ultimos 30 dias)": 2,
+    "Maiores Dividas (valor minimo)": 2,
+    "Quebras Rejeitadas": 3,
+    "Nunca Contatados": 3,
+    "Base Recentes": 3,
+}
+ADMISSAO_THREADS_RUNNING_MAX = 32
+ADMISSAO_CHECAGEM_BANCO_S = 10
+ADMISSAO_ESPERA_S = 2
+ADMISSAO_PULSO_S = 10
+ADMISSAO_EXPIRA_S = 60
+
+_admissao_ctx = threading.local()
+_threads_running_lock = threading.Lock()
+_threads_running_cache: list = [0.0, None]  # [monotonic da leitura, valor]
+
+
+def _peso_consulta(consulta: str) -> int:
+    return ADMISSAO_PESOS.get(consulta, 1)
+
+
+def _tickets_admissao() -> list[tuple[str, int, bool]]:
+    """[(nome, peso, rodando)] em ordem de chegada, sem os expirados."""
+    limite = time.time() - ADMISSAO_EXPIRA_S
+    tickets = []
+    for nome in sorted(os.listdir(ADMISSAO_DIR)):
+        base, _, estado = nome.rpartition(".")
+        if estado not in ("espera", "rodando"):
+            continue
+        path = os.path.join(ADMISSAO_DIR, nome)
+        try:
+            if os.path.getmtime(path) < limite:
+                os.remove(path)
+                continue
+        except OSError:
+            continue
+        tickets.append((base, int(base.rsplit("_", 1)[1]), estado == "rodando"))
+    return tickets
+
+
+def _threads_running() -> int | None:
+    """Threads_running do servidor (lido no máximo a cada ADMISSAO_CHECAGEM_BANCO_S); None se indisponível."""
+    with _threads_running_lock:
+        if time.monotonic() - _threads_running_cache[0] < ADMISSAO_CHECAGEM_BANCO_S:
+            return _threads_running_cache[1]
+        valor = None
+        try:
+            conn = _abrir_conexao()
+            try:
+                cur = conn.cursor()
+                cur.execute("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+                valor = int(cur.fetchall()[0][1])
+                cur.close()
+            finally:
+                conn.close()
+        except Exception:
+            pass
+        _threads_running_cache[:] = [time.monotonic(), valor]
+        return valor
+
+
+@contextmanager
+def _avisando_admissao(ao_aguardar):
+    """ao_aguardar(texto) recebe a posição na fila enquanto a thread espera ("" = entrou)."""
+    anterior = getattr(_admissao_ctx, "ao_aguardar", None)
+    _admissao_ctx.ao_aguardar = ao_aguardar
+    try:
+        yield
+    finally:
+        _admissao_ctx.ao_aguardar = anterior
+
+
+def _avisar_admissao(texto: str):
+    aviso = getattr(_admissao_ctx, "ao_aguardar", None)
+    if aviso and texto != getattr(_admissao_ctx, "ultimo_aviso", None):
+        _admissao_ctx.ultimo_aviso = texto
+        aviso(texto)
+
+
+def _avisar_andamento(texto: str):
+    """Aviso de andamento para quem acompanha a execução (tela, servidor, CLI); sem ninguém, stderr."""
+    aviso = getattr(_admissao_ctx, "ao_aguardar", None)
+    if aviso:
+        aviso(texto)
+    else:
+        print(texto, file=sys.stderr)
+
+
+@contextmanager
+def _admissao(consulta: str):
+    """Espera a vez da base no orçamento global e segura o peso dela até o fim do bloco."""
+    if DRIVER_MODO == "replay" or getattr(_admissao_ctx, "dentro", False):
+        yield
+        return
+
+    peso = _peso_consulta(consulta)
+    os.makedirs(ADMISSAO_DIR, exist_ok=True)
+    base = f"{time.time_ns():020d}_{socket.gethostname().replace('_', '-')}_{os.getpid()}_{threading.get_ident()}_{peso}"
+    path = os.path.join(ADMISSAO_DIR, base + ".espera")
+    open(path, "w").close()
+
+    parar = threading.Event()
+
+    def pulso():
+        while not parar.wait(ADMISSAO_PULSO_S):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+    threading.Thread(target=pulso, daemon=True).start()
+    t0 = time.perf_counter()
+    try:
+        while True:
+            os.utime(path)
+            tickets = _tickets_admissao()
+            fila = [b for b, _, rodando in tickets if not rodando]
+            if base not in fila:  # descartado como expirado (pasta compartilhada lenta): volta para a fila
+                open(path, "w").close()
+                continue
+            em_uso = sum(p for _, p, rodando in tickets if rodando)
+            posicao = fila.index(base) + 1
+            if posicao == 1 and (em_uso == 0 or em_uso + peso <= ADMISSAO_ORCAMENTO):
+                threads = _threads_running()
+                if threads is None or threads < ADMISSAO_THREADS_RUNNING_MAX:
+                    break
+                _avisar_admissao(f"Banco ocupado (Threads_running={threads}); {consulta} é a próxima")
+            else:
+                _avisar_admissao(
+                    f"Na fila do banco: posição {posicao} de {len(fila)} "
+                    f"(em uso {em_uso}/{ADMISSAO_ORCAMENTO}, esta pesa {peso})"
+                )
+            time.sleep(ADMISSAO_ESPERA_S)
+
+        rodando = os.path.join(ADMISSAO_DIR, base + ".rodando")
+        os.replace(path, rodando)
+        path = rodando
+        _somar_etapa("admissao", time.perf_counter() - t0)
+        t0 = None
+        _avisar_admissao("")
+        _admissao_ctx.dentro = True
+        try:
+            yield
+        finally:
+            _admissao_ctx.dentro = False
+    finally:
+        if t0 is not None:
+            _somar_etapa("admissao", time.perf_counter() - t0)
+        parar.set()
+        _admissao_ctx.ultimo_aviso = None
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# =========================
+# Planejador adaptativo (estratégia mais rápida por base)
+# =========================
+# Cada execução registra a estratégia usada e a "forma" dos parâmetros (quais filtros/opções
+# que mudam o resultado vieram preenchidos). Com o planejador ligado, a estratégia de cada
+# pedido sai da mediana das últimas execuções da mesma base + carteiras + forma: a mais rápida
+# vence; com probabilidade PLANEJADOR_EPSILON explora a candidata com menos medições, para
+# acompanhar a mudança no volume de dados. Tempo medido = etapa "consulta" menos a espera na
+# fila de admissão; execuções que usaram o cache de resultados ficam de fora. Staging e réplica
+# leem cópias que podem estar atrasadas (não devolvem as mesmas linhas que "unica"): só entram
+# na disputa quando o próprio pedido já as ligou.
+PLANEJADOR_EPSILON = 0.1
+PLANEJADOR_HISTORICO_N = 10  # medições por estratégia que entram na mediana
+PLANEJADOR_REPLICA_MAX_IDADE_MIN = 60
+PLANEJADOR_MAX_CONEXOES = 4  # fan-out por carteira: conexões em paralelo
+
+# estratégia -> flags de extra; a ordem é a de preferência sem histórico
+ESTRATEGIAS = {
+    "unica": {},
+    "por_carteira": {"_por_carteira": True},
+    "blocos": {"_blocos": True},
+    "staging": {"_staging": True},
+    "replica": {"_replica": True},
+}
+_FLAGS_ESTRATEGIA = {k for flags in ESTRATEGIAS.values() for k in flags}
+_ATALHOS_FORA_DO_PLANEJADOR = ("_cpc_rollup", "_superbase", "_indice_segmentos")
+
+
+def _estrategia_de(extra: dict) -> str | None:
+    """Estratégia de ESTRATEGIAS que o pedido usa; None nos atalhos que não leem a base inteira."""
+    if any(extra.get(k) for k in _ATALHOS_FORA_DO_PLANEJADOR):
+        return None
+    for nome in ("replica", "blocos", "por_carteira", "staging"):
+        if all(extra.get(k) for k in ESTRATEGIAS[nome]):
+            return nome
+    return "unica"
+
+
+def _forma_parametros(extra: dict) -> str:
+    chaves = sorted(
+        k for k, v in extra.items()
+        if k not in _EXTRA_SEM_EFEITO_NO_RESULTADO | _EXTRA_FONTE_LOCAL and k != "_tail_params"
+        and v not in (None, "", [], {})
+    )
+    return json.dumps({"chaves": chaves, "filtros": sorted(extra.get("_filtros") or {})})
+
+
+def _estrategias_candidatas(sql_template: str, carteiras: list[int], extra: dict) -> list[str]:
+    candidatas = ["unica"]
+    if len(carteiras) > 1 and _particionavel_por_carteira(sql_template):
+        candidatas.append("por_carteira")
+    if _motivo_sem_blocos(sql_template) is None:
+        candidatas.append("blocos")
+    if extra.get("_staging") and _usa_staging(sql_template):
+        candidatas.append("staging")
+    if extra.get("_replica"):
+        idade = idade_replica_min(carteiras) if os.path.exists(REPLICA_DB_PATH) else None
+        if idade is not None and idade <= PLANEJADOR_REPLICA_MAX_IDADE_MIN:
+            candidatas.append("replica")
+    return candidatas
+
+
+def _tempos_por_estrategia(consulta: str, carteiras: list[int], forma: str) -> dict[str, list[float]]:
+    with closing(_abrir_historico()) as loc:
+        hist = pd.read_sql_query(
+            "SELECT estrategia, duracao_s, etapas FROM execucoes "
+            "WHERE consulta = ? AND carteiras = ? AND forma = ? AND estrategia IS NOT NULL "
+            "AND erro IS NULL AND duracao_s IS NOT NULL AND COALESCE(cache_hits, 0) = 0 "
+            "ORDER BY id DESC LIMIT 500",
+            loc,
+            params=(consulta, json.dumps(sorted(carteiras)), forma),
+        )
+    tempos: dict[str, list[float]] = {}
+    for r in hist.itertuples(index=False):
+        etapas = json.loads(r.etapas or "{}")
+        seg = etapas.get("consulta", r.duracao_s) - etapas.get("admissao", 0.0)
+        lista = tempos.setdefault(r.estrategia, [])
+        if len(lista) < PLANEJADOR_HISTORICO_N:
+            lista.append(seg)
+    return tempos
+
+
+def planejar(sql_template: str, carteiras: list[int], extra: dict) -> dict:
+    """
+    Escolhe a estratégia do pedido. Devolve
+    {"estrategia", "motivo", "segundos_est", "medicoes": {estratégia: (n, mediana)}}.
+    """
+    consulta = extra.get("_nome_consulta") or _nome_consulta(sql_template)
+    candidatas = _estrategias_candidatas(sql_template, carteiras, extra)
+    tempos = _tempos_por_estrategia(consulta, carteiras, _forma_parametros(extra))
+    medicoes = {e: (len(tempos[e]), float(np.median(tempos[e]))) for e in candidatas if tempos.get(e)}
+
+    if len(candidatas) > 1 and random.random() < PLANEJADOR_EPSILON:
+        menor = min(medicoes.get(e, (0, 0))[0] for e in candidatas)
+        escolha = random.choice([e for e in candidatas if medicoes.get(e, (0, 0))[0] == menor])
+        motivo = "exploração (estratégia com menos medições)"
+    elif medicoes:
+        escolha = min(medicoes, key=lambda e: medicoes[e][1])
+        motivo = f"mais rápida nas últimas {medicoes[escolha][0]} execução(ões)"
+    else:
+        escolha, motivo = "unica", "sem histórico para esta base/carteiras/parâmetros"
+    segundos = medicoes[escolha][1] if escolha in medicoes else None
+    return {"estrategia": escolha, "motivo": motivo, "segundos_est": segundos, "medicoes": medicoes}
+
+
+def aplicar_plano(extra: dict, plano: dict):
+    for k in _FLAGS_ESTRATEGIA:
+        extra.pop(k, None)
+    extra.update(ESTRATEGIAS[plano["estrategia"]])
+
+
+def descrever_plano(plano: dict) -> str:
+    est = plano["segundos_est"]
+    duracao = "duração desconhecida" if est is None else f"~{est / 60:.1f} min" if est >= 90 else f"~{est:.0f} s"
+    return f"Estratégia: {plano['estrategia']} ({plano['motivo']}; {duracao})"
+
+
+def _run_por_carteira(sql_template: str, carteiras: list[int], extra: dict) -> pd.DataFrame:
+    """
+    Fan-out: uma instrução por carteira, em conexões paralelas (cada uma passa pela admissão).
+    Cada thread leva o registro da execução (planos, etapas) e o aviso de andamento de quem
+    chamou; a espera de admissão que fica no registro é a da carteira que terminou por último.
+    """
+    sub = {k: v for k, v in extra.items() if k != "_por_carteira"}
+    reg = getattr(_execucao_ctx, "atual", None)
+    aviso = getattr(_admissao_ctx, "ao_aguardar", None)
+    medidas: list[tuple[float, dict]] = []  # (segundos, etapas) de cada carteira
+
+    def rodar(carteira: int) -> pd.DataFrame:
+        etapas: dict[str, float] = {}
+        _execucao_ctx.atual = None if reg is None else {**reg, "etapas": etapas}
+        _admissao_ctx.ao_aguardar = aviso
+        t0 = time.perf_counter()
+        try:
+            return _run_query_direto(sql_template, [carteira], sub)
+        finally:
+            medidas.append((time.perf_counter() - t0, etapas))
+            _execucao_ctx.atual = None
+            _admissao_ctx.ao_aguardar = None
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(len(carteiras), PLANEJADOR_MAX_CONEXOES)) as ex:
+            partes = list(ex.map(rodar, carteiras))
+    finally:
+        for _, etapas in medidas:
+            for nome, seg in etapas.items():
+                if nome != "admissao":
+                    _somar_etapa(nome, seg)
+        if medidas:
+            _somar_etapa("admissao", max(medidas, key=lambda m: m[0])[1].get("admissao", 0.0))
+    return _ordenar_como_template(pd.concat(partes, ignore_index=True), sql_template)
+
+
+# =========================
+# Consultor de índices (colunas de junção/filtro/ordem dos templates)
+# =========================
+# Cada template de QUERIES é lido por tabela/alias: colunas de ON (junção), WHERE/HAVING
+# (filtro) e PARTITION/ORDER BY (ordem). Para cada acesso monta o índice composto
+# que o serviria (igualdades, depois a 1ª faixa ou as colunas de ordem) e compara com
+# information_schema.STATISTICS. O impacto é o total de linhas estimadas pelo EXPLAIN
+# nas leituras dessa tabela que não usaram um índice que cubra o acesso.
+INDICES_MAX_COLUNAS = 4
+
+_PALAVRAS_NAO_FUNCAO = {"AND", "OR", "NOT", "IN", "ON", "WHERE", "EXISTS", "SELECT", "BY"}
+_RE_CTE_NOME = re.compile(r"(?:\bWITH|,)\s*(\w+)\s+AS\s*\(", re.IGNORECASE)
+_RE_TABELA_ALIAS = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+_RE_CLAUSULA_OU_COLUNA = re.compile(
+    r"\b(ON|WHERE|HAVING|GROUP\s+BY|ORDER\s+BY|PARTITION\s+BY|SELECT|FROM|JOIN)\b"
+    r"|\b(\w+)\.(\w+)\b"
+    r"|(?<![.\w])(\w+)(?=\s*(?:<=>|>=|<=|<>|!=|=|>|<|\bIN\b|\bBETWEEN\b|\bNOT\b|\bLIKE\b))",
+    re.IGNORECASE,
+)
+_RE_OPERADOR_APOS = re.compile(r"\s*(<=>|>=|<=|<>|!=|=|>|<|IN\b|BETWEEN\b|LIKE\b|NOT\b|REGEXP\b|IS\b)", re.IGNORECASE)
+_RE_FUNCAO_ANTES = re.compile(r"(\w+)\s*\(\s*$")
+_RE_OPERADOR_ANTES = re.compile(r"(<=>|>=|<=|=|>|<)\s*$")
+_RE_COLUNA_APOS_IGUAL = re.compile(r"\s*(?:<=>|=)\s*(\w+)\.", re.IGNORECASE)
+_RE_COLUNA_ANTES_IGUAL = re.compile(r"\b(\w+)\.\w+\s*(?:<=>|=)\s*$", re.IGNORECASE)
+_CLAUSULAS = {
+    "ON": "juncao", "WHERE": "filtro", "HAVING": "filtro", "GROUP BY": "agrupamento", "ORDER BY": "ordem",
+    "SELECT": "projecao", "FROM": None, "JOIN": None,
+}
+
+
+def _extra_exemplo(consulta: str) -> dict:
+    """Parâmetros representativos (como a tela monta) para rodar os templates sem a tela."""
+    hoje = pd.Timestamp.now().normalize()
+    if consulta == "CPC por Periodo (datas)":
+        return {
+            "dt_ini_filter": "AND his.data_at >= %s",
+            "dt_fim_filter": "AND his.data_at <= %s",
+            "_tail_params": [_fmt_ts(hoje - pd.Timedelta(days=30)), _fmt_ts(hoje + pd.Timedelta(days=1))],
+        }
+    if consulta == "Maiores Dividas (valor minimo)":
+        return {"having_filter": "HAVING SUM(rec.vlrparc) >= %s", "_tail_params": [10_000.0]}
+    return {}
+
+
+def _dentro_de_funcao(sql: str, ini: int) -> bool:
+    f = _RE_FUNCAO_ANTES.search(sql[max(0, ini - 40):ini])
+    return bool(f) and f.group(1).upper() not in _PALAVRAS_NAO_FUNCAO
+
+
+def _tipo_predicado(sql: str, ini: int, fim: int) -> str | None:
+    """'igualdade', 'faixa' ou None (coluna dentro de função, <>, LIKE, NOT...: não usa índice)."""
+    if _dentro_de_funcao(sql, ini):
+        return None
+    antes = sql[max(0, ini - 40):ini]
+    m = _RE_OPERADOR_APOS.match(sql, fim)
+    op = m.group(1).upper() if m else None
+    if op is None:
+        m = _RE_OPERADOR_ANTES.search(antes)
+        op = m.group(1) if m else None
+    if op in ("=", "<=>", "IN"):
+        return "igualdade"
+    if op in (">=", "<=", ">", "<", "BETWEEN"):
+        return "faixa"
+    return None
+
+
+def acessos_do_template(sql: str) -> list[dict]:
+    """
+    Acessos a tabelas reais (FROM/JOIN que não são CTEs) de um SQL renderizado, com as
+    colunas de igualdade, faixa e ordem usadas em cada um e os índices candidatos.
+    """
+    sql = _RE_LITERAL_SQL.sub("''", sql)
+    ctes = {m.group(1).lower() for m in _RE_CTE_NOME.finditer(sql)}
+    declaracoes = list(_RE_TABELA_ALIAS.finditer(sql))
+
+    acessos = []
+    for m in declaracoes:
+        tabela = m.group(1).lower()
+        if tabela in ctes or tabela.upper() in _PALAVRAS_NAO_ALIAS:
+            continue
+        alias = m.group(2) if m.group(2) and m.group(2).upper() not in _PALAVRAS_NAO_ALIAS else tabela
+        acessos.append({
+            "tabela": tabela, "alias": alias.lower(), "pos": m.start(),
+            "origem": "join" if m.group(0).upper().startswith("JOIN") else "from",
+            "juncao": [], "filtro": [], "faixa": [], "ordem": [],
+        })
+    # Colunas sem alias só são atribuíveis quando o SQL lê uma tabela só
+    unica = acessos[0] if len(declaracoes) == 1 and len(acessos) == 1 else None
+
+    def resolver(alias: str, pos: int, para_frente: bool) -> dict | None:
+        cands = [a for a in acessos if a["alias"] == alias]
+        antes = [a for a in cands if a["pos"] < pos]
+        depois = [a for a in cands if a["pos"] > pos]
+        if para_frente:
+            return (depois or antes[-1:] or [None])[0]
+        return (antes[-1:] or depois or [None])[0]
+
+    clausula = None
+    for m in _RE_CLAUSULA_OU_COLUNA.finditer(sql):
+        if m.group(1):
+            kw = " ".join(m.group(1).upper().split())
+            if kw == "PARTITION BY" or (kw == "ORDER BY" and clausula in ("projecao", "janela")):
+                clausula = "janela"  # OVER (...) na projeção: a tabela é declarada depois
+            else:
+                clausula = _CLAUSULAS[kw]
+            continue
+        if clausula not in ("juncao", "filtro", "ordem", "janela"):
+            continue
+
+        if m.group(2):
+            acesso = resolver(m.group(2).lower(), m.start(), clausula == "janela")
+            coluna, ini, fim = m.group(3).lower(), m.start(2), m.end(3)
+        elif unica is not None and m.group(4).upper() not in _PALAVRAS_NAO_FUNCAO:
+            acesso, coluna, ini, fim = unica, m.group(4).lower(), m.start(4), m.end(4)
+        else:
+            continue
+        if acesso is None:
+            continue
+
+        if clausula in ("ordem", "janela"):
+            if not _dentro_de_funcao(sql, ini):
+                acesso["ordem"].append(coluna)
+            continue
+        tipo = _tipo_predicado(sql, ini, fim)
+        outro = _RE_COLUNA_APOS_IGUAL.match(sql, fim) or _RE_COLUNA_ANTES_IGUAL.search(sql[max(0, ini - 60):ini])
+        if outro and outro.group(1).lower() == acesso["alias"]:
+            continue  # coluna = coluna da mesma tabela: não restringe o acesso
+        if tipo == "igualdade":
+            acesso["juncao" if clausula == "juncao" else "filtro"].append(coluna)
+        elif tipo == "faixa":
+            acesso["faixa"].append(coluna)
+
+    for a in acessos:
+        # Tabela de JOIN é lida pelas colunas do ON; a do FROM, pelos filtros do WHERE
+        iguais = a["juncao"] + a["filtro"] if a["origem"] == "join" else a["filtro"] + a["juncao"]
+        iguais = list(dict.fromkeys(iguais))
+        candidatos = []
+        if iguais or a["faixa"]:
+            candidatos.append(tuple((iguais + [c for c in a["faixa"] if c not in iguais][:1])[:INDICES_MAX_COLUNAS]))
+        ordem = [c for c in dict.fromkeys(a["ordem"]) if c not in iguais]
+        if ordem:
+            candidatos.append(tuple((iguais + ordem)[:INDICES_MAX_COLUNAS]))
+        a["candidatos"] = list(dict.fromkeys(c for c in candidatos if c))
+    return acessos
+
+
+def _cobertura(colunas: tuple, indice: list[str]) -> int:
+    """Quantas colunas do candidato o prefixo do índice atende (igualdades em qualquer ordem)."""
+    restantes, n = set(colunas), 0
+    for col in indice:
+        if col not in restantes:
+            break
+        restantes.discard(col)
+        n += 1
+    return n
+
+
+def _indices_existentes(conn, tabelas: list[str]) -> dict[str, dict[str, list[str]]]:
+    sql = SQL_INDICES_EXISTENTES.format(tabelas=", ".join(["%s"] * len(tabelas)))
+    df = _ler_sql(conn, sql, tabelas)
+    out: dict[str, dict[str, list[str]]] = {}
+    for r in df.itertuples(index=False):
+        out.setdefault(r.tabela.lower(), {}).setdefault(r.indice, []).append(r.coluna.lower())
+    return out
+
+
+def analisar_indices(carteiras: list[int]) -> dict[str, pd.DataFrame]:
+    """
+    {"candidatos": índice que cada acesso dos templates pede, status (ok/parcial/ausente),
+    impacto do EXPLAIN e bases afetadas; "sem_uso": índices existentes que nenhum template
+    aproveita ou que o otimizador não escolheu em nenhum EXPLAIN}.
+    """
+    por_consulta = {}
+    for consulta, (sql_template, _, _) in QUERIES.items():
+        extra = _extra_exemplo(consulta)
+        sql, params = build_sql_and_params(sql_template, carteiras, extra=extra)
+        por_consulta[consulta] = (sql, params, acessos_do_template(sql))
+    tabelas = sorted({a["tabela"] for _, _, acessos in por_consulta.values() for a in acessos})
+
+    conn = _abrir_conexao()
+    try:
+        existentes = _indices_existentes(conn, tabelas)
+        planos, explain_ok = {}, True
+        for consulta, (sql, params, _) in por_consulta.items():
+            cur = conn.cursor()
+            try:
+                cur.execute("EXPLAIN FORMAT=JSON " + sql, params)
+                planos[consulta] = _resumo_plano(cur.fetchall()[0][0])["tabelas"]
+            except mysql.connector.Error:
+                explain_ok = False
+            finally:
+                cur.close()
+    finally:
+        conn.close()
+
+    linhas, escolhidos = {}, set()
+    for consulta, (_, _, acessos) in por_consulta.items():
+        plano = planos.get(consulta)
+        for a in acessos:
+            # InnoDB: todo índice secundário carrega a chave primária no fim
+            pk = existentes.get(a["tabela"], {}).get("PRIMARY", [])
+            indices = {
+                nome: ic + [c for c in pk if c not in ic]
+                for nome, ic in existentes.get(a["tabela"], {}).items()
+            }
+            leituras = [t for t in plano or [] if t["tabela"] == a["alias"]]
+            escolhidos.update((a["tabela"], t["chave"]) for t in leituras if t["chave"])
+            for cols in a["candidatos"]:
+                cobre = {nome for nome, ic in indices.items() if _cobertura(cols, ic) == len(cols)}
+                melhor = max((_cobertura(cols, ic) for ic in indices.values()), default=0)
+                status = "ok" if cobre else ("parcial" if melhor else "ausente")
+                impacto = None if plano is None else sum(
+                    float(t["linhas"] or 0) for t in leituras if t["chave"] not in cobre
+                )
+                r = linhas.setdefault((a["tabela"], cols), {
+                    "tabela": a["tabela"], "colunas": ", ".join(cols), "status": status,
+                    "cobertura": f"{melhor}/{len(cols)}", "impacto_linhas": None, "consultas": [],
+                })
+                if impacto is not None:
+                    r["impacto_linhas"] = (r["impacto_linhas"] or 0.0) + impacto
+                if consulta not in r["consultas"]:
+                    r["consultas"].append(consulta)
+
+    cand = pd.DataFrame(list(linhas.values()), columns=[
+        "tabela", "colunas", "status", "cobertura", "impacto_linhas", "consultas"])
+    cand["consultas"] = cand["consultas"].map(", ".join)
+    cand["_ok"] = cand["status"] == "ok"
+    cand = cand.sort_values(["_ok", "impacto_linhas", "status"], ascending=[True, False, True], na_position="last")
+    cand = cand.drop(columns="_ok").reset_index(drop=True)
+
+    usadas = {}
+    for _, _, acessos in por_consulta.values():
+        for a in acessos:
+            for cols in a["candidatos"]:
+                usadas.setdefault(a["tabela"], set()).update(cols)
+    sem_uso = []
+    for tabela, indices in sorted(existentes.items()):
+        for nome, cols in sorted(indices.items()):
+            if nome == "PRIMARY" or (tabela, nome) in escolhidos:
+                continue
+            if cols[0] not in usadas.get(tabela, set()):
+                motivo = f"nenhum template filtra/junta/ordena por {cols[0]}"
+            elif explain_ok:
+                motivo = "o otimizador não escolheu em nenhum EXPLAIN"
+            else:
+                continue
+            sem_uso.append({"tabela": tabela, "indice": nome, "colunas": ", ".join(cols), "motivo": motivo})
+    return {
+        "candidatos": cand,
+        "sem_uso": pd.DataFrame(sem_uso, columns=["tabela", "indice", "colunas", "motivo"]),
+    }
+
+
+def relatorio_indices(carteiras: list[int]) -> str:
+    res = analisar_indices(carteiras)
+    saida = ["== Índices que os templates pedem (ausentes/parciais por impacto no EXPLAIN; atendidos no fim)"]
+    for r in res["candidatos"].itertuples(index=False):
+        impacto = "sem EXPLAIN" if pd.isna(r.impacto_linhas) else f"~{_fmt_linhas(r.impacto_linhas)} linhas"
+        saida.append(f"  [{r.status:<7}] {r.tabela}({r.colunas})  cobertura {r.cobertura}  {impacto}")
+        saida.append(f"            {r.consultas}")
+    saida.append("")
+    saida.append("== Índices sem uso pelos templates (podem servir a outros sistemas: confira antes de remover)")
+    if res["sem_uso"].empty:
+        saida.append("  (nenhum)")
+    for r in res["sem_uso"].itertuples(index=False):
+        saida.append(f"  {r.tabela}.{r.indice}({r.colunas}): {r.motivo}")
+    return "\n".join(saida)
+
+
+# =========================
+# Linter de SQL (anti-padrões nos templates)
+# =========================
+# Verifica todas as constantes SQL_* (inclusive os dicts de SQL) e as consultas de QUERIES.
+# Cada achado tem regra, severidade e posição (arquivo:linha:coluna). --lint sai com 1
+# quando há achado com severidade >= LINT_SEVERIDADE_GATE fora de LINT_ACEITOS, para
+# servir de porteira antes de publicar um template novo.
+LINT_SEVERIDADES = ("baixa", "media", "alta")
+LINT_SEVERIDADE_GATE = "alta"
+
+# Achados conhecidos e aceitos: {(template, regra): motivo}. Template novo não entra aqui
+# sem revisão: o gate existe para que os anti-padrões não se espalhem.
+_LINT_MOTIVO_REGEXP_TEL = "filtro de sequência repetida; com staging ligado lê stg_fones_limpos sem o REGEXP"
+_LINT_MOTIVO_FAT_PARC = "regra de negócio: só contratos fora de ENTRADA; mover para o ON muda o resultado"
+LINT_ACEITOS: dict[tuple[str, str], str] = {
+    ("SQL_TELEFONES_MELHOR_CONTATO", "funcao_em_filtro"): _LINT_MOTIVO_REGEXP_TEL,
+    ("SQL_RECENTES", "funcao_em_filtro"): _LINT_MOTIVO_REGEXP_TEL,
+    ("SQL_NUNCA", "funcao_em_filtro"): _LINT_MOTIVO_REGEXP_TEL,
+    ("SQL_QUEBRAS_REJEITADAS", "funcao_em_filtro"): _LINT_MOTIVO_REGEXP_TEL,
+    ("SQL_SUPERBASE", "funcao_em_filtro"): _LINT_MOTIVO_REGEXP_TEL,
+    ("SQL_RECENTES", "left_join_anulado"): _LINT_MOTIVO_FAT_PARC,
+    ("SQL_NUNCA", "left_join_anulado"): _LINT_MOTIVO_FAT_PARC,
+    ("SQL_QUEBRAS_REJEITADAS", "left_join_anulado"): _LINT_MOTIVO_FAT_PARC,
+    ("SQL_SUPERBASE", "left_join_anulado"): _LINT_MOTIVO_FAT_PARC,
+    ("SQL_VALORES_TUPLAS", "left_join_anulado"): _LINT_MOTIVO_FAT_PARC,
+    ("SQL_CONTATADOS_30D['nunca']", "left_join_anulado"): "mesmo critério de stcob do NOT IN de Nunca Contatados",
+    ("SQL_NUNCA", "not_in_correlacionado"): "a opção de anti-join (tabela temporária) troca esse NOT IN",
+}
+
+LINT_REGRAS = {
+    "like_curinga_inicial": ("media", "LIKE com '%' no início não usa índice (varre a tabela)"),
+    "funcao_em_filtro": ("alta", "CONCAT(...) comparado com REGEXP/LIKE/= avalia a função em toda linha"),
+    "date_format_projecao": ("baixa", "DATE_FORMAT na projeção devolve texto (formate no Excel/pandas)"),
+    "not_in_correlacionado": ("alta", "NOT IN com subconsulta correlacionada: reexecuta por linha (use NOT EXISTS/anti-join)"),
+    "not_in_subconsulta": ("media", "NOT IN (SELECT ...) materializa a subconsulta e falha com NULL (prefira NOT EXISTS)"),
+    "group_by_concat": ("media", "GROUP BY sobre CONCAT: agrupa por texto calculado, sem índice"),
+    "left_join_anulado": ("alta", "WHERE na tabela do LEFT JOIN descarta os NULLs: vira INNER JOIN"),
+}
+
+_RE_LIKE_CURINGA = re.compile(r"\bLIKE\s+'%", re.IGNORECASE)
+_RE_CONCAT = re.compile(r"\bCONCAT\s*\(", re.IGNORECASE)
+_RE_COMPARACAO_APOS = re.compile(r"\s*(?:NOT\s+)?(REGEXP|RLIKE|LIKE|=|<>|!=)", re.IGNORECASE)
+_RE_DATE_FORMAT = re.compile(r"\bDATE_FORMAT\s*\(", re.IGNORECASE)
+_RE_NOT_IN_SELECT = re.compile(r"\bNOT\s+IN\s*(\()\s*SELECT\b", re.IGNORECASE)
+_RE_GROUP_BY_LISTA = re.compile(
+    r"\bGROUP\s+BY\b(.+?)(?=\bHAVING\b|\bORDER\s+BY\b|\bLIMIT\b|\bWINDOW\b|\)|;|\Z)", re.IGNORECASE | re.DOTALL
+)
+_RE_LEFT_JOIN = re.compile(r"\bLEFT\s+(?:OUTER\s+)?JOIN\s+(?:(\()|(\w+))", re.IGNORECASE)
+_RE_ALIAS_APOS = re.compile(r"\s*(?:AS\s+)?(\w+)", re.IGNORECASE)
+
+
+def _clausula_em(masc: str, pos: int) -> str | None:
+    """Cláusula (SELECT/FROM/WHERE/...) do mesmo nível de parênteses em que `pos` está."""
+    depth = 0
+    for m in reversed(list(_RE_CLAUSULA_SQL.finditer(masc, 0, pos))):
+        tok = m.group(0)
+        if tok == ")":
+            depth += 1
+        elif tok == "(":
+            depth = max(depth - 1, 0)  # "(" sem par: subimos para o nível de fora
+        elif depth == 0 and m.group(1):
+            return " ".join(m.group(1).upper().split())
+    return None
+
+
+def _lint_like(sql: str, masc: str):
+    for m in _RE_LIKE_CURINGA.finditer(sql):
+        # o LIKE em si não pode estar dentro de literal/comentário; CASE na projeção não filtra
+        if masc[m.start()] != " " and _clausula_em(masc, m.start()) in ("WHERE", "ON", "HAVING"):
+            yield "like_curinga_inicial", m.start()
+
+
+def _lint_funcao_em_filtro(sql: str, masc: str):
+    for m in _RE_CONCAT.finditer(masc):
+        if _clausula_em(masc, m.start()) not in ("WHERE", "ON", "HAVING"):
+            continue
+        fecha = _fecha_parenteses(masc, m.end() - 1)
+        if _RE_COMPARACAO_APOS.match(masc, fecha + 1):
+            yield "funcao_em_filtro", m.start()
+
+
+def _lint_date_format(sql: str, masc: str):
+    for m in _RE_DATE_FORMAT.finditer(masc):
+        if _clausula_em(masc, m.start()) == "SELECT":
+            yield "date_format_projecao", m.start()
+
+
+def _lint_not_in(sql: str, masc: str):
+    for m in _RE_NOT_IN_SELECT.finditer(masc):
+        abre = m.start(1)
+        interno = masc[abre + 1:_fecha_parenteses(masc, abre)]
+        locais = {t.lower() for d in _RE_TABELA_ALIAS.finditer(interno) for t in d.groups() if t}
+        externos = {q.lower() for q in re.findall(r"\b(\w+)\.\w+", interno)} - locais
+        yield ("not_in_correlacionado" if externos else "not_in_subconsulta"), m.start()
+
+
+def _lint_group_by_concat(sql: str, masc: str):
+    calculadas = {
+        m.group(1).lower()
+        for m in re.finditer(r"\bCONCAT\s*\([^()]*(?:\([^()]*\)[^()]*)*\)\s+AS\s+(\w+)", masc, re.IGNORECASE)
+    }
+    for m in _RE_GROUP_BY_LISTA.finditer(masc):
+        lista = m.group(1)
+        itens = [i.strip().split(".")[-1].lower() for i in _dividir_args(lista)]
+        if _RE_CONCAT.search(lista) or calculadas.intersection(itens):
+            yield "group_by_concat", m.start()
+
+
+def _lint_left_join_anulado(sql: str, masc: str):
+    for m in _RE_LEFT_JOIN.finditer(masc):
+        fim_tabela = _fecha_parenteses(masc, m.start(1)) + 1 if m.group(1) else m.end(2)
+        a = _RE_ALIAS_APOS.match(masc, fim_tabela)
+        alias = a.group(1) if a and a.group(1).upper() not in _PALAVRAS_NAO_ALIAS else m.group(2)
+        if not alias:
+            continue
+
+        fim_from = _fim_do_nivel(masc, fim_tabela, ("WHERE", "GROUP BY", "ORDER BY", "HAVING", "LIMIT", "UNION"))
+        w = re.match(r"WHERE\b", masc[fim_from:], re.IGNORECASE)
+        if not w:
+            continue
+        ini_where = fim_from + w.end()
+        where = masc[ini_where:_fim_do_nivel(masc, ini_where, ("GROUP BY", "ORDER BY", "HAVING", "LIMIT", "UNION", "WINDOW"))]
+        ref = re.compile(rf"(?<![\w.]){re.escape(alias)}\.\w+", re.IGNORECASE)
+        if re.search(ref.pattern + r"\s+IS\s+NULL\b", where, re.IGNORECASE):
+            continue  # anti-join / predicado que já trata o NULL
+        for r in ref.finditer(where):
+            antes = where[max(0, r.start() - 30):r.start()]
+            if re.search(r"\b(COALESCE|IFNULL)\s*\(\s*$", antes, re.IGNORECASE):
+                continue
+            yield "left_join_anulado", ini_where + r.start()
+            break
+
+
+_LINT_VERIFICACOES = (
+    _lint_like, _lint_funcao_em_filtro, _lint_date_format, _lint_not_in, _lint_group_by_concat,
+    _lint_left_join_anulado,
+)
+
+
+def _templates_para_lint() -> list[tuple[str, str]]:
+    templates, vistos = [], set()
+    for nome, valor in globals().items():
+        if not nome.startswith("SQL_"):
+            continue
+        itens = valor.items() if isinstance(valor, dict) else [(None, valor)]
+        for chave, sql in itens:
+            if isinstance(sql, str):
+                templates.append((nome if chave is None else f"{nome}[{chave!r}]", sql))
+                vistos.add(sql)
+    for consulta, (sql, _, _) in QUERIES.items():
+        if sql not in vistos:
+            templates.append((f"QUERIES[{consulta!r}]", sql))
+    return templates
+
+
+def lint_sql(sql: str) -> list[tuple[str, int]]:
+    """(regra, posição) de cada anti-padrão encontrado em um SQL/template."""
+    masc = _mascarar_sql(sql)
+    achados = {(regra, pos) for verificar in _LINT_VERIFICACOES for regra, pos in verificar(sql, masc)}
+    return sorted(achados, key=lambda a: a[1])
+
+
+def lint_templates() -> pd.DataFrame:
+    """Achados de todos os templates, com arquivo:linha:coluna, severidade e se está em LINT_ACEITOS."""
+    try:
+        with open(__file__, "r", encoding="utf-8") as f:
+            fonte = f.read()
+    except OSError:
+        fonte = ""
+    arquivo = os.path.basename(__file__)
+
+    linhas = []
+    for nome, sql in _templates_para_lint():
+        base = fonte.find(sql) if fonte else -1
+        for regra, pos in lint_sql(sql):
+            if base >= 0:
+                abs_pos = base + pos
+                lin = fonte.count("\n", 0, abs_pos) + 1
+                col = abs_pos - (fonte.rfind("\n", 0, abs_pos) + 1) + 1
+                local = f"{arquivo}:{lin}:{col}"
+            else:
+                lin = sql.count("\n", 0, pos) + 1
+                local = f"{nome}:{lin}"
+            severidade, descricao = LINT_REGRAS[regra]
+            trecho = " ".join(sql[pos:pos + 60].split())
+            linhas.append({
+                "local": local, "template": nome, "regra": regra, "severidade": severidade,
+                "descricao": descricao, "trecho": trecho, "aceito": (nome, regra) in LINT_ACEITOS,
+            })
+    return pd.DataFrame(
+        linhas, columns=["local", "template", "regra", "severidade", "descricao", "trecho", "aceito"]
+    )
+
+
+def relatorio_lint(severidade_min: str = "baixa") -> tuple[str, int]:
+    """Texto do relatório e código de saída (1 se houver achado >= LINT_SEVERIDADE_GATE não aceito)."""
+    df = lint_templates()
+    nivel = LINT_SEVERIDADES.index
+    df = df[df["severidade"].map(nivel) >= nivel(severidade_min)]
+    saida = []
+    for r in df.itertuples(index=False):
+        marca = " (aceito)" if r.aceito else ""
+        saida.append(f"{r.local}: [{r.severidade}] {r.regra}{marca} em {r.template}")
+        saida.append(f"    {r.descricao}")
+        saida.append(f"    {r.trecho}")
+    bloqueantes = df[(df["severidade"].map(nivel) >= nivel(LINT_SEVERIDADE_GATE)) & ~df["aceito"]]
+    contagem = df["severidade"].value_counts()
+    saida.append(
+        f"{len(df)} achado(s): " + ", ".join(f"{s} {int(contagem.get(s, 0))}" for s in reversed(LINT_SEVERIDADES))
+        + f"; {len(bloqueantes)} bloqueante(s) (>= {LINT_SEVERIDADE_GATE}, fora de LINT_ACEITOS)"
+    )
+    return "\n".join(saida), (1 if len(bloqueantes) else 0)
+
+
+# =========================
+# Cache de resultados (por carteira quando a base permite)
+# =========================
+# Bases cujas linhas se particionam por cod_cli são guardadas uma entrada por carteira;
+# um pedido 517+518 reaproveita 517 e só consulta 518. Bases com junções entre carteiras
+# (ex.: acordos_ultimos ligado só por nmcont) ou LIMIT global ficam com uma entrada
+# para a combinação exata de carteiras.
+RESULT_CACHE_DIR = os.path.join(LOCAL_DATA_DIR, "cache_resultados")
+RESULT_CACHE_TTL_H = 8
+
+# Flags de estratégia: mudam o caminho de execução, não o resultado
+_EXTRA_SEM_EFEITO_NO_RESULTADO = {
+    "_cache", "_valores_cliente", "_antijoin", "_planos", "_nome_consulta", "_linhas_est", "_exportacao",
+    "_blocos", "_por_carteira", "_planejador", "_cache_renovar",
+}
+# Flags que leem cópias locais ou tabelas-resumo (índice, superbase, rollup, réplica, staging),
+# que podem estar atrasadas em relação ao banco: entram na chave do cache, para um resultado
+# lido delas não servir a quem pediu a leitura direta.
+_EXTRA_FONTE_LOCAL = {"_indice_segmentos", "_superbase", "_cpc_rollup", "_replica", "_staging"}
+
+_RE_ON = re.compile(
+    r"\bON\s+(.+?)(?=\s+(?:LEFT\s+|RIGHT\s+|INNER\s+)?JOIN\b|\s+WHERE\b|\s+GROUP\s+BY\b"
+    r"|\s+ORDER\s+BY\b|\s*\)|\s*;|\Z)",
+    re.IGNORECASE | re.DOTALL,
+)
+_RE_PARTITION = re.compile(r"PARTITION\s+BY\s+(.+?)\s+ORDER\s+BY", re.IGNORECASE | re.DOTALL)
+_RE_GROUP_BY = re.compile(
+    r"GROUP\s+BY\s+(.+?)(?=\s+HAVING\b|\s+ORDER\s+BY\b|\s*\)|\s*;|\s*\{|\Z)",
+    re.IGNORECASE | re.DOTALL,
+)
+_RE_NMCONT_SUBQUERY = re.compile(r"nmcont\s+(?:NOT\s+)?IN\s*\(\s*SELECT", re.IGNORECASE)
+_RE_ORDER_FINAL = re.compile(r"ORDER\s+BY\s+(\w+)(\s+DESC|\s+ASC)?\s*(?:LIMIT\s+\d+\s*)?;?\s*\Z", re.IGNORECASE)
+
+
+def _motivo_nao_particionavel(sql_template: str) -> str | None:
+    """None se o resultado da base é a união dos resultados por carteira; senão o motivo."""
+    if re.search(r"\bLIMIT\s+\d+", sql_template, re.IGNORECASE):
+        return "LIMIT global"
+    for m in _RE_ON.finditer(sql_template):
+        cond = m.group(1).lower()
+        if "nmcont" in cond and "cod_cli" not in cond:
+            return f"junção só por nmcont: ON {' '.join(m.group(1).split())}"
+    for m in _RE_PARTITION.finditer(sql_template):
+        cols = m.group(1).lower()
+        if "nmcont" in cols and "cod_cli" not in cols:
+            return f"janela entre carteiras: PARTITION BY {' '.join(m.group(1).split())}"
+    for m in _RE_GROUP_BY.finditer(sql_template):
+        cols = m.group(1).lower()
+        if "nmcont" in cols and "cod_cli" not in cols and "cod_cad" not in cols:
+            return f"agregação entre carteiras: GROUP BY {' '.join(m.group(1).split())}"
+    if _RE_NMCONT_SUBQUERY.search(sql_template):
+        return "subconsulta por nmcont sem carteira"
+    return None
+
+
+def _ordenar_como_template(df: pd.DataFrame, sql_template: str) -> pd.DataFrame:
+    """Reaplica o ORDER BY final do template depois de juntar as partes."""
+    m = _RE_ORDER_FINAL.search(sql_template.strip())
+    if not m or m.group(1) not in df.columns:
+        return df
+    desc = (m.group(2) or "").strip().upper() == "DESC"
+    return df.sort_values(m.group(1), ascending=not desc, kind="stable").reset_index(drop=True)
+
+
+def _particionavel_por_carteira(sql_template: str) -> bool:
+    if _motivo_nao_particionavel(sql_template) is not None:
+        return False
+    if re.search(r"\bORDER\s+BY\b", _ultima_instrucao_select(sql_template), re.IGNORECASE):
+        return bool(_RE_ORDER_FINAL.search(sql_template.strip()))
+    return True
+
+
+def _ultima_instrucao_select(sql_template: str) -> str:
+    """Texto depois da última CTE (ou o SQL inteiro, se não houver WITH)."""
+    pos = 0
+    for m in re.finditer(r"\b\w+\s+AS\s*\(", sql_template, re.IGNORECASE):
+        if m.start() < pos:
+            continue
+        pos = _fecha_parenteses(sql_template, m.end() - 1) + 1
+    return sql_template[pos:]
+
+
+def _chave_cache(sql_template: str, carteiras: list[int], extra: dict) -> str:
+    relevante = {k: v for k, v in extra.items() if k not in _EXTRA_SEM_EFEITO_NO_RESULTADO}
+    payload = json.dumps(
+        {"sql": sql_template, "carteiras": sorted(carteiras), "extra": relevante},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def _cache_ler(chave: str) -> pd.DataFrame | None:
+    path = os.path.join(RESULT_CACHE_DIR, chave + ".pkl")
+    try:
+        idade_h = (time.time() - os.path.getmtime(path)) / 3600.0
+    except OSError:
+        return None
+    if idade_h > RESULT_CACHE_TTL_H:
+        return None
+    try:
+        return pd.read_pickle(path)
+    except Exception:
+        return None
+
+
+def _cache_gravar(chave: str, df: pd.DataFrame):
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    path = os.path.join(RESULT_CACHE_DIR, chave + ".pkl")
+    tmp = path + ".tmp"
+    df.to_pickle(tmp)
+    os.replace(tmp, path)
+    _cache_limpar_expirados()
+
+
+def _cache_limpar_expirados():
+    limite = time.time() - RESULT_CACHE_TTL_H * 3600
+    for nome in os.listdir(RESULT_CACHE_DIR):
+        path = os.path.join(RESULT_CACHE_DIR, nome)
+        try:
+            if os.path.getmtime(path) < limite:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _partes_cache(sql_template: str, carteiras: list[int], extra: dict) -> list[tuple[list[int], str]]:
+    """[(carteiras da parte, chave)]: uma por carteira quando a base permite, senão a combinação exata."""
+    if not _particionavel_por_carteira(sql_template) or len(carteiras) == 1:
+        return [(carteiras, _chave_cache(sql_template, carteiras, extra))]
+    return [([c], _chave_cache(sql_template, [c], extra)) for c in carteiras]
+
+
+def _cache_fresco(chave: str) -> bool:
+    try:
+        return time.time() - os.path.getmtime(os.path.join(RESULT_CACHE_DIR, chave + ".pkl")) <= RESULT_CACHE_TTL_H * 3600
+    except OSError:
+        return False
+
+
+def _em_cache(sql_template: str, carteiras: list[int], extra: dict) -> bool:
+    """Resultado inteiro no cache (com as colunas escolhidas ou com todas)."""
+    sem_colunas = {k: v for k, v in extra.items() if k != "_colunas"}
+    return any(
+        all(_cache_fresco(chave) for _, chave in _partes_cache(sql_template, carteiras, e))
+        for e in (extra, sem_colunas)
+    )
+
+
+def _cache_ler_parte(sql_template: str, carteiras: list[int], extra: dict, chave: str) -> pd.DataFrame | None:
+    df = _cache_ler(chave)
+    if df is None and extra.get("_colunas"):
+        # Entrada com todas as colunas (ex.: pré-aquecida) também serve: run_query corta as colunas
+        sem_colunas = {k: v for k, v in extra.items() if k != "_colunas"}
+        df = _cache_ler(_chave_cache(sql_template, carteiras, sem_colunas))
+    return df
+
+
+def _run_com_cache(sql_template: str, carteiras: list[int], extra: dict) -> pd.DataFrame:
+    """extra["_cache_renovar"]: não lê o cache, recalcula e troca as entradas (os.replace)."""
+    partes = []
+    for sub, chave in _partes_cache(sql_template, carteiras, extra):
+        df = None if extra.get("_cache_renovar") else _cache_ler_parte(sql_template, sub, extra, chave)
+        _contar_cache(df is not None)
+        if df is None:
+            df = _run_query_direto(sql_template, sub, extra)
+            _cache_gravar(chave, df)
+        partes.append(df)
+
+    if len(partes) == 1:
+        return partes[0]
+    partes = [_selecionar_colunas(p, extra["_colunas"]) for p in partes] if extra.get("_colunas") else partes
+    return _ordenar_como_template(pd.concat(partes, ignore_index=True), sql_template)
+
+
+# =========================
+# Pré-aquecimento do cache (bases da manhã)
+# =========================
+# As bases que todo mundo pede de manhã são calculadas de madrugada direto no cache de
+# resultados (com o planejador escolhendo a estratégia); o "Gerar Excel" com o cache ligado
+# vira leitura do cache + exportação. Bases que se particionam por carteira ficam uma entrada
+# por carteira (servem qualquer combinação); as demais, só as combinações listadas.
+# Rode na máquina que atende os pedidos (o servidor de jobs, ou cada estação): o cache é local.
+# Lista em PREAQUECER_PATH (mesmo formato de PREAQUECER) substitui a padrão.
+PREAQUECER_PATH = os.path.join(LOCAL_DATA_DIR, "preaquecer.json")
+_TODAS_AS_CARTEIRAS = [c for _, c in CARTEIRAS]
+PREAQUECER = [
+    {"consulta": "Nunca Contatados", "combinacoes": [[c] for c in _TODAS_AS_CARTEIRAS] + [_TODAS_AS_CARTEIRAS]},
+    {"consulta": "Base Recentes", "combinacoes": [[c] for c in _TODAS_AS_CARTEIRAS] + [_TODAS_AS_CARTEIRAS]},
+    {"consulta": "Quebras Rejeitadas", "combinacoes": [[c] for c in _TODAS_AS_CARTEIRAS] + [_TODAS_AS_CARTEIRAS]},
+    {"consulta": "Telefones + Melhor Contato (Top 7)", "combinacoes": [_TODAS_AS_CARTEIRAS]},
+    {"consulta": "Sem Historico (ultimos 30 dias)", "combinacoes": [_TODAS_AS_CARTEIRAS]},
+]
+
+
+def carregar_preaquecimento() -> list[dict]:
+    try:
+        with open(PREAQUECER_PATH, encoding="utf-8") as f:
+            itens = json.load(f)
+    except FileNotFoundError:
+        return PREAQUECER
+    desconhecidas = [i.get("consulta") for i in itens if i.get("consulta") not in QUERIES]
+    if desconhecidas:
+        raise ValueError(f"{PREAQUECER_PATH}: bases desconhecidas: {', '.join(map(str, desconhecidas))}")
+    return itens
+
+
+def preaquecer(itens: list[dict] | None = None) -> list[tuple[str, list[int], str]]:
+    """Recalcula cada base x combinação de carteiras no cache; devolve [(base, carteiras, resultado)]."""
+    feitos = []
+    for item in itens if itens is not None else carregar_preaquecimento():
+        sql_template = QUERIES[item["consulta"]][0]
+        for carteiras in item["combinacoes"]:
+            # Recalcula mesmo com entrada válida (a de ontem à tarde já não é a base da manhã), mas
+            # sem apagá-la antes: até a troca, quem pedir a base ainda lê a entrada anterior
+            extra = {**item.get("extra", {}), "_nome_consulta": item["consulta"], "_cache": True, "_cache_renovar": True}
+            t0 = time.perf_counter()
+            try:
+                aplicar_plano(extra, planejar(sql_template, carteiras, extra))
+                df = run_query(sql_template, carteiras, extra=extra)
+            except Exception as e:
+                feitos.append((item["consulta"], carteiras, f"erro: {e}"))
+                continue
+            feitos.append((item["consulta"], carteiras, f"{len(df)} linhas em {time.perf_counter() - t0:.0f} s"))
+    return feitos
+
+
+def _proximo_horario(hhmm: str, agora: pd.Timestamp | None = None) -> pd.Timestamp:
+    """Próximo dia útil às HH:MM (hoje, se ainda não passou)."""
+    agora = agora or pd.Timestamp.now()
+    h, m = (int(x) for x in hhmm.split(":"))
+    alvo = agora.normalize() + pd.Timedelta(hours=h, minutes=m)
+    while alvo <= agora or alvo.weekday() >= 5:
+        alvo += pd.Timedelta(days=1)
+    return alvo
+
+
+def agendar_preaquecimento(hhmm: str):
+    """Fica rodando e pré-aquece todo dia útil às HH:MM (Ctrl+C para parar)."""
+    while True:
+        alvo = _proximo_horario(hhmm)
+        print(f"Próximo pré-aquecimento: {_fmt_ts(alvo)}")
+        time.sleep(max(0.0, (alvo - pd.Timestamp.now()).total_seconds()))
+        for consulta, carteiras, resultado in preaquecer():
+            print(f"[{_fmt_ts(pd.Timestamp.now())}] {consulta} {carteiras}: {resultado}")
+
+
+# =========================
+# Extração em faixas de cod_cad com checkpoints (retomável)
+# =========================
+# Bases longas são lidas em faixas de cod_cad; cada faixa concluída vai para disco em
+# BLOCOS_DIR/<chave do pedido>/. Se a conexão cai (2006/2013), reconecta com backoff e segue
+# da faixa seguinte; se o job falhar de vez, gerar o mesmo pedido de novo reaproveita as faixas
+# já baixadas. O resultado é montado a partir dos arquivos das faixas. Enquanto reconecta, o
+# servidor ainda fora do ar (2002/2003/2005, InterfaceError) também conta como transitório.
+# A chave da pasta inclui a reescrita aplicada ao template (anti-join, staging): faixas
+# gravadas com outra reescrita não são misturadas.
+#
+# Em cada faixa, a tabela do FROM de cada SELECT recebe um filtro: cod_cad (ou hist_tb.cod_cli)
+# BETWEEN, ou, para tabelas ligadas só por nmcont e agregações por nmcont, um semi-join com os
+# nmcont dos cadastros da faixa (os grupos por nmcont continuam completos).
+BLOCOS_DIR = os.path.join(LOCAL_DATA_DIR, "blocos")
+BLOCOS_CADASTROS_POR_FAIXA = 50_000
+BLOCOS_MAX_IDADE_H = 24  # checkpoints mais velhos são descartados: os dados já mudaram
+BLOCOS_ERROS_TRANSITORIOS = {2006, 2013, 2055}  # server has gone away / lost connection
+BLOCOS_ERROS_CONEXAO = {2002, 2003, 2005}  # can't connect (socket/host/unknown host)
+BLOCOS_BACKOFF_S = (2, 5, 15, 30, 60, 120)  # uma espera por tentativa; depois desiste
+
+_BLOCOS_COD_CAD_MAX = 2**63 - 1
+_BLOCOS_TABELAS_NMCONT = {"acordos_tb", "rec_comp_tb", "receber_tb", "bens_tb"}
+
+
+def _motivo_sem_blocos(sql_template: str) -> str | None:
+    """None se a base pode ser lida em faixas de cod_cad; senão o motivo."""
+    if re.search(r"\bLIMIT\s+\d+", sql_template, re.IGNORECASE):
+        return "LIMIT global"
+    if not re.search(r"\bFROM\s+cadastros_tb\b", sql_template, re.IGNORECASE):
+        return "a base não parte de cadastros_tb"
+    tabelas = {t.lower() for t, _ in _RE_TABELA_ALIAS.findall(sql_template)}
+    if len(tabelas) > 1 and not re.search(r"\bcod_cad\b", _ultima_instrucao_select(sql_template), re.IGNORECASE):
+        return "saída sem cod_cad: a mesma linha poderia vir de faixas diferentes"
+    return None
+
+
+def _agrupa_por_nmcont(masc: str, ini: int, alias: str) -> bool:
+    fim = _fim_do_nivel(masc, ini, ("GROUP BY", "HAVING", "ORDER BY", "LIMIT", "UNION", "WINDOW"))
+    m = re.match(r"GROUP\s+BY\b", masc[fim:], re.IGNORECASE)
+    if not m:
+        return False
+    lista = masc[fim + m.end():_fim_do_nivel(masc, fim + m.end(), ("HAVING", "ORDER BY", "LIMIT", "UNION"))]
+    a = re.escape(alias)
+    return bool(re.search(rf"\b{a}\.nmcont\b", lista, re.I)) and not re.search(rf"\b{a}\.cod_cad\b", lista, re.I)
+
+
+def _template_em_faixa(sql_template: str, lo: int, hi: int, hist_col: str = HIST_CAD_REF_COL) -> str:
+    """Template restrito a cod_cad em [lo, hi] (literais inteiros: não mexe nos parâmetros)."""
+    masc = _mascarar_sql(sql_template)
+    ctes = {m.group(1).lower() for m in _RE_CTE_NOME.finditer(masc)}
+    chave = {"cadastros_tb": "cod_cad", "fones_tb": "cod_cad", "hist_tb": hist_col}
+    semi = f"IN (SELECT ck.nmcont FROM cadastros_tb ck WHERE ck.cod_cad BETWEEN {lo} AND {hi})"
+
+    insercoes = []
+    for m in _RE_FROM_TABELA.finditer(masc):
+        tabela = m.group(1).lower()
+        if tabela in ctes:
+            continue
+        if m.group(2) and m.group(2).upper() not in _PALAVRAS_NAO_ALIAS:
+            alias, ini = m.group(2), m.end()
+        else:
+            alias, ini = m.group(1), m.end(1)
+        if tabela in chave and not (tabela == "cadastros_tb" and _agrupa_por_nmcont(masc, ini, alias)):
+            pred = f"{alias}.{chave[tabela]} BETWEEN {lo} AND {hi}"
+        elif tabela in _BLOCOS_TABELAS_NMCONT or tabela == "cadastros_tb":
+            pred = f"{alias}.nmcont {semi}"
+        else:
+            continue
+        insercoes.extend(_inserir_no_where(masc, ini, pred))
+    return _aplicar_insercoes(sql_template, insercoes)
+
+
+def _faixas_cod_cad(conn, carteiras: list[int]) -> list[tuple[int, int]]:
+    """Faixas contíguas com ~BLOCOS_CADASTROS_POR_FAIXA cadastros; cobrem todo o espaço de cod_cad."""
+    sql, params = build_sql_and_params(SQL_BLOCOS_COD_CAD, carteiras)
+    ids = _ler_sql(conn, sql, params)["cod_cad"].to_numpy(dtype=np.int64)
+    inicios = [int(x) for x in ids[::BLOCOS_CADASTROS_POR_FAIXA]][1:]
+    los = [0] + inicios
+    his = [x - 1 for x in inicios] + [_BLOCOS_COD_CAD_MAX]
+    return list(zip(los, his))
+
+
+def _ler_plano_blocos(pasta: str) -> dict | None:
+    try:
+        with open(os.path.join(pasta, "plano.json"), "r", encoding="utf-8") as f:
+            plano = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - plano.get("criado", 0) > BLOCOS_MAX_IDADE_H * 3600:
+        shutil.rmtree(pasta, ignore_errors=True)
+        return None
+    return plano
+
+
+def _gravar_plano_blocos(pasta: str, plano: dict):
+    path = os.path.join(pasta, "plano.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(plano, f)
+    os.replace(path + ".tmp", path)
+
+
+def _gravar_faixa(pasta: str, i: int, df: pd.DataFrame):
+    path = os.path.join(pasta, f"faixa_{i:05d}.pkl")
+    df.to_pickle(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def _fechar_sem_erro(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass  # conexão que caiu não fecha limpa
+
+
+def _limpar_blocos_expirados():
+    if not os.path.isdir(BLOCOS_DIR):
+        return
+    for nome in os.listdir(BLOCOS_DIR):
+        _ler_plano_blocos(os.path.join(BLOCOS_DIR, nome))
+
+
+def _reescrita_blocos(sql_template: str, extra: dict) -> dict:
+    """Reescritas que _run_em_blocos aplica ao template (entram na chave dos checkpoints)."""
+    return {
+        "antijoin": extra["_antijoin"] if extra.get("_antijoin") and _modo_antijoin(sql_template) else None,
+        "staging": bool(extra.get("_staging") and _usa_staging(sql_template)),
+    }
+
+
+def _erro_transitorio_blocos(e: mysql.connector.Error, conectando: bool) -> bool:
+    if e.errno in BLOCOS_ERROS_TRANSITORIOS:
+        return True
+    return conectando and (
+        e.errno in BLOCOS_ERROS_CONEXAO or isinstance(e, mysql.connector.errors.InterfaceError)
+    )
+
+
+def _texto_erro(e: BaseException) -> str:
+    """Mensagem do erro seguida das notas (add_note), que str(e) não mostra."""
+    return "\n\n".join([str(e), *getattr(e, "__notes__", [])])
+
+
+def _run_em_blocos(sql_template: str, carteiras: list[int], extra: dict) -> pd.DataFrame:
+    _limpar_blocos_expirados()
+    reescrita = _reescrita_blocos(sql_template, extra)
+    chave = _chave_cache(sql_template, carteiras, {**extra, "_blocos_reescrita": reescrita})
+    pasta = os.path.join(BLOCOS_DIR, chave)
+    os.makedirs(pasta, exist_ok=True)
+    plano = _ler_plano_blocos(pasta)
+    hist_col = extra.get("hist_cad_ref_col", HIST_CAD_REF_COL)
+
+    conn = None
+    tpl = None
+    falhas = 0
+    try:
+        while True:
+            conectando = False
+            try:
+                if conn is None:
+                    conectando = True
+                    conn = _abrir_conexao()
+                    conectando = False
+                if tpl is None:
+                    tpl = sql_template
+                    if reescrita["antijoin"]:
+                        # tmp_contatados é da conexão: a cada reconexão tpl volta a None e ela é recarregada
+                        tpl = _preparar_antijoin(conn, tpl, reescrita["antijoin"], hist_col)
+                    if reescrita["staging"] and _garantir_staging(conn):
+                        tpl = _template_com_staging(tpl, extra)
+                    tpl = _projetar(tpl, extra)
+                if plano is None:
+                    plano = {"criado": time.time(), "faixas": _faixas_cod_cad(conn, carteiras)}
+                    _gravar_plano_blocos(pasta, plano)
+
+                pendentes = [
+                    i for i in range(len(plano["faixas"]))
+                    if not os.path.exists(os.path.join(pasta, f"faixa_{i:05d}.pkl"))
+                ]
+                if not pendentes:
+                    break
+                i = pendentes[0]
+                lo, hi = plano["faixas"][i]
+                sql, params = build_sql_and_params(_template_em_faixa(tpl, lo, hi, hist_col), carteiras, extra=extra)
+                df = _ler_sql(conn, sql, params)
+                _gravar_faixa(pasta, i, df)
+                falhas = 0
+            except mysql.connector.Error as e:
+                if not _erro_transitorio_blocos(e, conectando) or falhas >= len(BLOCOS_BACKOFF_S):
+                    total = len(plano["faixas"]) if plano else 0
+                    feitas = sum(1 for n in os.listdir(pasta) if n.endswith(".pkl"))
+                    e.add_note(
+                        f"{feitas} de {total} faixas ficaram salvas; "
+                        "gere o mesmo pedido de novo para continuar de onde parou."
+                    )
+                    raise
+                if conn is not None:
+                    _fechar_sem_erro(conn)
+                    conn, tpl = None, None
+                time.sleep(BLOCOS_BACKOFF_S[falhas])
+                falhas += 1
+    finally:
+        if conn is not None:
+            _fechar_sem_erro(conn)
+
+    partes = [pd.read_pickle(os.path.join(pasta, f"faixa_{i:05d}.pkl")) for i in range(len(plano["faixas"]))]
+    df = _ordenar_como_template(pd.concat(partes, ignore_index=True), sql_template)
+    shutil.rmtree(pasta, ignore_errors=True)
+    return df
+
+
+# =========================
+# Reescrita de templates (CTEs)
+# =========================
+def _fecha_parenteses(sql: str, pos_abre: int) -> int:
+    """
+    Recebe a posição de um "(" e devolve a posição do ")" correspondente,
+    ignorando parênteses dentro de literais '...'.
+    """
+    depth = 0
+    in_str = False
+    i = pos_abre
+    while i < len(sql):
+        ch = sql[i]
+        if in_str:
+            if ch == "\\":
+                i += 2
+                continue
+            if ch == "'":
+                in_str = False
+        elif ch == "'":
+            in_str = True
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    raise ValueError("Parênteses desbalanceados no SQL.")
+
+
+def _localizar_cte(sql: str, nome: str) -> tuple[int, int] | None:
+    """Devolve (inicio, fim) do corpo da CTE `nome AS ( ... )`, sem os parênteses."""
+    m = re.search(rf"(?<![\w.]){re.escape(nome)}\s+AS\s*\(", sql, re.IGNORECASE)
+    if not m:
+        return None
+    abre = m.end() - 1
+    fecha = _fecha_parenteses(sql, abre)
+    return abre + 1, fecha
+
+
+def _substituir_cte(sql: str, nome: str, novo_corpo: str) -> str:
+    pos = _localizar_cte(sql, nome)
+    if pos is None:
+        raise ValueError(f"CTE '{nome}' não encontrada no template.")
+    ini, fim = pos
+    return sql[:ini] + novo_corpo + sql[fim:]
+
+
+# =========================
+# Projeção de colunas (SELECT final enxuto)
+# =========================
+# A tela deixa escolher as colunas de cada base. O SELECT final é reescrito só com elas
+# (mais as do ORDER BY final e as que a execução precisa, ex.: cod_cad do anti-join no app).
+# LEFT JOINs que ficaram sem uso caem quando a CTE ligada tem no máximo uma linha por chave
+# da junção (GROUP BY ou rn = 1 por PARTITION BY contidos no ON), e CTEs sem referência saem
+# do WITH. O DataFrame é cortado de novo no fim, o que cobre os caminhos sem SQL próprio.
+COLUNAS_ESCOLHIDAS_PATH = os.path.join(LOCAL_DATA_DIR, "colunas.json")
+
+_RE_ALIAS_FINAL = re.compile(r"(?:\bAS\s+)?`?(\w+)`?\s*$", re.IGNORECASE)
+_RE_JUNCAO_FINAL = re.compile(
+    r"\b(LEFT\s+(?:OUTER\s+)?JOIN|(?:INNER\s+)?JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)\s+ON\b", re.IGNORECASE
+)
+_RE_IGUAL_1 = re.compile(r"\b(?:\w+\.)?(\w+)\s*=\s*1\b")
+# Placeholders que trazem parâmetros de cauda: a CTE que os contém não pode sair do WITH
+_RE_PLACEHOLDER_COM_PARAMETRO = re.compile(r"\{(?!cod_cli\}|tel_limit\}|hist_cad_ref_col\}|infoad_filter\})\w+\}|%s")
+_FIM_DA_JUNCAO = ("WHERE", "GROUP BY", "HAVING", "ORDER BY", "LIMIT", "UNION", "WINDOW")
+
+
+def _lista_select_final(sql_template: str) -> tuple[int, int]:
+    """(início, fim) da lista de colunas do SELECT final, em posições do template."""
+    masc = _mascarar_sql(sql_template)
+    pos_final = len(sql_template) - len(_ultima_instrucao_select(sql_template))
+    m = re.compile(r"\bSELECT\b", re.IGNORECASE).search(masc, pos_final)
+    return m.end(), _fim_do_nivel(masc, m.end(), ("FROM",))
+
+
+def _nome_coluna(expr: str) -> str:
+    m = _RE_ALIAS_FINAL.search(expr.strip())
+    return m.group(1) if m else expr.strip()
+
+
+def colunas_da_base(sql_template: str) -> list[str]:
+    """Nomes das colunas do SELECT final (alias ou última parte de tabela.coluna)."""
+    ini, fim = _lista_select_final(sql_template)
+    return [_nome_coluna(e) for e in _dividir_args(sql_template[ini:fim]) if e]
+
+
+def _colunas_order_by_final(sql_template: str) -> set[str]:
+    masc = _mascarar_sql(sql_template)
+    _, fim_select = _lista_select_final(sql_template)
+    o = _fim_do_nivel(masc, fim_select, ("ORDER BY",))
+    m = re.match(r"ORDER\s+BY\b", masc[o:], re.IGNORECASE)
+    if not m:
+        return set()
+    lista = masc[o + m.end():_fim_do_nivel(masc, o + m.end(), ("LIMIT", "UNION"))]
+    return {
+        n.lower() for n in re.findall(r"\b(?:\w+\.)?(\w+)\b", lista)
+        if n.upper() not in ("ASC", "DESC")
+    }
+
+
+def _particao_do_rn(corpo: str, rn: str) -> set[str] | None:
+    """Colunas do PARTITION BY do ROW_NUMBER() cujo alias é `rn` (None se não houver)."""
+    for m in re.finditer(r"\bOVER\s*\(", corpo, re.IGNORECASE):
+        fecha = _fecha_parenteses(corpo, m.end() - 1)
+        a = re.match(r"\s*(?:AS\s+)?(\w+)", corpo[fecha + 1:], re.IGNORECASE)
+        if a and a.group(1).lower() == rn.lower():
+            p = re.search(r"PARTITION\s+BY\s+(.+?)\s+ORDER\s+BY", corpo[m.end():fecha], re.IGNORECASE | re.DOTALL)
+            return {c.strip().split(".")[-1].lower() for c in p.group(1).split(",")} if p else None
+    return None
+
+
+def _chave_unica_cte(sql: str, nome: str) -> set[str] | None:
+    """Colunas que identificam uma linha da CTE `nome`, quando dá para provar pelo texto."""
+    loc = _localizar_cte(sql, nome)
+    if loc is None:
+        return None
+    corpo = sql[loc[0]:loc[1]]
+    masc = _mascarar_sql(corpo)
+
+    g = _fim_do_nivel(masc, 0, ("GROUP BY", "UNION"))
+    m = re.match(r"GROUP\s+BY\b", masc[g:], re.IGNORECASE)
+    if m:
+        ini = g + m.end()
+        lista = corpo[ini:_fim_do_nivel(masc, ini, ("HAVING", "ORDER BY", "LIMIT", "UNION"))]
+        return {c.strip().split(".")[-1].lower() for c in _dividir_args(lista)}
+
+    w = _fim_do_nivel(masc, 0, ("WHERE", "UNION"))
+    origem = re.search(r"\bFROM\s+(\w+)", masc, re.IGNORECASE)
+    if not re.match(r"WHERE\b", masc[w:], re.IGNORECASE) or not origem:
+        return None
+    loc_origem = _localizar_cte(sql, origem.group(1))
+    if loc_origem is None:
+        return None
+    cond = masc[w:_fim_do_nivel(masc, w + 5, _FIM_DA_JUNCAO)]
+    for rn in _RE_IGUAL_1.finditer(cond):
+        particao = _particao_do_rn(sql[loc_origem[0]:loc_origem[1]], rn.group(1))
+        if particao:
+            return particao
+    return None
+
+
+def _podar_juncoes(sql: str) -> str:
+    """Tira do SELECT final os LEFT JOINs com CTE que não são referenciados e não multiplicam linhas."""
+    while True:
+        pos_final = len(sql) - len(_ultima_instrucao_select(sql))
+        masc = _mascarar_sql(sql[pos_final:])
+        juncoes = [
+            m for m in _RE_JUNCAO_FINAL.finditer(masc)
+            if masc.count("(", 0, m.start()) == masc.count(")", 0, m.start())
+        ]
+        for k, m in enumerate(juncoes):
+            if not m.group(1).upper().startswith("LEFT"):
+                continue
+            fim = juncoes[k + 1].start() if k + 1 < len(juncoes) else _fim_do_nivel(masc, m.end(), _FIM_DA_JUNCAO)
+            alias = re.escape(m.group(3))
+            if re.search(rf"\b{alias}\.", masc[:m.start()] + masc[fim:], re.IGNORECASE):
+                continue
+            on = masc[m.end():fim]
+            chave = _chave_unica_cte(sql, m.group(2))
+            usadas = {c.lower() for c in re.findall(rf"\b{alias}\.(\w+)", on, re.IGNORECASE)}
+            if chave and chave <= usadas and not re.search(r"\bOR\b", on, re.IGNORECASE):
+                sql = sql[:pos_final + m.start()] + sql[pos_final + fim:]
+                break
+        else:
+            return sql
+
+
+def _podar_ctes(sql: str) -> str:
+    """Tira do WITH as CTEs que ninguém mais referencia (as que têm parâmetros de cauda ficam)."""
+    while True:
+        masc = _mascarar_sql(sql)
+        for m in _RE_CTE_NOME.finditer(masc):
+            fecha = _fecha_parenteses(sql, m.end() - 1)
+            fora = masc[:m.start()] + masc[fecha + 1:]
+            if re.search(rf"(?<![\w.]){m.group(1)}\b", fora, re.IGNORECASE):
+                continue
+            if _RE_PLACEHOLDER_COM_PARAMETRO.search(masc[m.end():fecha]):
+                continue
+            if masc[m.start()] == ",":
+                sql = sql[:m.start()] + sql[fecha + 1:]
+                break
+            prox = re.match(r"\s*,", masc[fecha + 1:])
+            if prox:  # primeira CTE: fica o WITH, sai a vírgula seguinte
+                sql = sql[:m.start() + len("WITH")] + sql[fecha + 1 + prox.end():]
+                break
+        else:
+            return sql
+
+
+def _template_com_colunas(sql_template: str, colunas: list[str], manter: tuple[str, ...] = ()) -> str:
+    disponiveis = {c.lower() for c in colunas_da_base(sql_template)}
+    desconhecidas = [c for c in colunas if c.lower() not in disponiveis]
+    if desconhecidas:
+        raise ValueError(f"Coluna(s) que a base não tem: {', '.join(desconhecidas)}")
+
+    alvo = {c.lower() for c in (*colunas, *manter)} | _colunas_order_by_final(sql_template)
+    ini, fim = _lista_select_final(sql_template)
+    exprs = [e for e in _dividir_args(sql_template[ini:fim]) if _nome_coluna(e).lower() in alvo]
+    sql = sql_template[:ini] + "\n    " + ",\n    ".join(exprs) + "\n" + sql_template[fim:]
+    return _podar_ctes(_podar_juncoes(sql))
+
+
+def _projetar(sql_template: str, extra: dict, manter: tuple[str, ...] = ()) -> str:
+    colunas = extra.get("_colunas")
+    return _template_com_colunas(sql_template, colunas, manter) if colunas else sql_template
+
+
+def _selecionar_colunas(df: pd.DataFrame, colunas: list[str]) -> pd.DataFrame:
+    por_nome = {str(c).lower(): c for c in df.columns}
+    return df[[por_nome[c.lower()] for c in colunas if c.lower() in por_nome]]
+
+
+def carregar_colunas_escolhidas() -> dict[str, list[str]]:
+    try:
+        with open(COLUNAS_ESCOLHIDAS_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def salvar_colunas_escolhidas(escolhas: dict[str, list[str]]):
+    os.makedirs(LOCAL_DATA_DIR, exist_ok=True)
+    with open(COLUNAS_ESCOLHIDAS_PATH + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(escolhas, f, ensure_ascii=False, indent=1)
+    os.replace(COLUNAS_ESCOLHIDAS_PATH + ".tmp", COLUNAS_ESCOLHIDAS_PATH)
+
+
+# =========================
+# Filtros na origem (portfolio, status, data_cad, valor)
+# =========================
+# Os filtros viram predicados parametrizados no WHERE dos SELECTs que "dirigem" a base: a
+# tabela do campo no FROM ou em JOIN interno (LEFT JOIN fica de fora para não virar INNER) e,
+# em cadastros_tb, só onde não há agregação por nmcont. O portfolio vai pelo gancho
+# {infoad_filter} dos templates que o têm: o escopo cujo WHERE já traz o gancho não ganha o
+# predicado de novo. Os valores entram como {_v_<campo>}, expandidos e colocados nos
+# parâmetros na ordem em que aparecem no texto (como {cod_cli}).
+FILTROS_CAMPOS = {
+    # campo: (rótulo, tabela, coluna, tipo)
+    "portfolio": ("Portfolio (infoad)", "cadastros_tb", "infoad", "lista"),
+    "status_cliente": ("Status do cliente (stcli)", "cadastros_tb", "stcli", "lista"),
+    "status_telefone": ("Status do telefone", "fones_tb", "status", "inteiros"),
+    "data_cad": ("Data de cadastro", "cadastros_tb", "data_cad", "datas"),
+    "valor": ("Dívida do contrato (soma de vlrparc)", "cadastros_tb", None, "faixa"),
+}
+FILTROS_EXEMPLOS = {
+    "lista": "A, B", "inteiros": "2, 4", "datas": "2025-01-01..2025-06-30", "faixa": "10.000,00..",
+}
+
+_RE_ESCOPO_TABELA = re.compile(
+    r"\b(FROM|(?:(LEFT|RIGHT)\s+(?:OUTER\s+)?|INNER\s+|CROSS\s+)?JOIN)\s+(?:\w+\.)?(\w+)(?:\s+(?:AS\s+)?(\w+))?",
+    re.IGNORECASE,
+)
+_RE_PLACEHOLDER_POSICIONAL = re.compile(r"\{(cod_cli|infoad_filter|_v_\w+)\}")
+
+
+def _escopos_dirigentes(sql_template: str, tabela: str):
+    """(alias, posição) de cada FROM/JOIN interno de `tabela` que corta linhas da base."""
+    masc = _mascarar_sql(sql_template)
+    ctes = {m.group(1).lower() for m in _RE_CTE_NOME.finditer(masc)}
+    for m in _RE_ESCOPO_TABELA.finditer(masc):
+        if m.group(2) or m.group(3).lower() != tabela or tabela in ctes:
+            continue
+        if m.group(4) and m.group(4).upper() not in _PALAVRAS_NAO_ALIAS:
+            alias, ini = m.group(4), m.end()
+        else:
+            alias, ini = m.group(3), m.end(3)
+        if tabela == "cadastros_tb" and _agrupa_por_nmcont(masc, ini, alias):
+            continue
+        yield alias, ini
+
+
+def filtros_aplicaveis(sql_template: str) -> list[str]:
+    tabelas = {t for _, t, _, _ in FILTROS_CAMPOS.values()}
+    com_escopo = {t for t in tabelas if next(_escopos_dirigentes(sql_template, t), None)}
+    return [c for c, (_, t, _, _) in FILTROS_CAMPOS.items() if t in com_escopo]
+
+
+def interpretar_filtro(campo: str, texto: str):
+    """Converte o texto digitado (tela ou --filtro) no valor guardado em extra["_filtros"]; None = sem filtro."""
+    rotulo, _, _, tipo = FILTROS_CAMPOS[campo]
+    texto = (texto or "").strip()
+    if not texto:
+        return None
+    if tipo in ("lista", "inteiros"):
+        itens = [x.strip() for x in texto.split(",") if x.strip()]
+        if tipo == "inteiros":
+            try:
+                itens = [int(x) for x in itens]
+            except ValueError:
+                raise ValueError(f"{rotulo}: use números separados por vírgula. Ex.: {FILTROS_EXEMPLOS[tipo]}")
+        return itens or None
+    ini, sep, fim = texto.partition("..")
+    if not sep:
+        raise ValueError(f"{rotulo}: use início..fim (um dos lados pode ficar vazio). Ex.: {FILTROS_EXEMPLOS[tipo]}")
+    ini, fim = ini.strip() or None, fim.strip() or None
+    if ini is None and fim is None:
+        return None
+    if tipo == "datas":
+        for d in (ini, fim):
+            if d is not None and not _is_valid_ymd(d):
+                raise ValueError(f"{rotulo}: data inválida {d!r}. Use YYYY-MM-DD.")
+        return [ini, fim]
+    return [None if v is None else _parse_money_br_or_plain(v) for v in (ini, fim)]
+
+
+def descrever_filtros(filtros: dict) -> str:
+    partes = []
+    for campo, valor in filtros.items():
+        rotulo, _, _, tipo = FILTROS_CAMPOS[campo]
+        if tipo in ("lista", "inteiros"):
+            partes.append(f"{rotulo} em {', '.join(map(str, valor))}")
+        else:
+            ini, fim = ("" if v is None else str(v) for v in valor)
+            partes.append(f"{rotulo} {ini}..{fim}")
+    return "; ".join(partes)
+
+
+def _predicado_filtro(campo: str, valor, alias: str) -> tuple[str, dict[str, list]]:
+    _, _, coluna, tipo = FILTROS_CAMPOS[campo]
+    if tipo in ("lista", "inteiros"):
+        return f"{alias}.{coluna} IN ({{_v_{campo}}})", {f"_v_{campo}": list(valor)}
+
+    ini, fim = valor
+    if tipo == "datas":
+        conds, vals = [], {}
+        if ini is not None:
+            conds.append(f"{alias}.{coluna} >= {{_v_{campo}_ini}}")
+            vals[f"_v_{campo}_ini"] = [ini + " 00:00:00"]
+        if fim is not None:
+            conds.append(f"{alias}.{coluna} <= {{_v_{campo}_fim}}")
+            vals[f"_v_{campo}_fim"] = [fim + " 23:59:59"]
+        return " AND ".join(conds), vals
+
+    conds, vals = [], {}
+    if ini is not None:
+        conds.append(f"SUM(fr.vlrparc) >= {{_v_{campo}_min}}")
+        vals[f"_v_{campo}_min"] = [ini]
+    if fim is not None:
+        conds.append(f"SUM(fr.vlrparc) <= {{_v_{campo}_max}}")
+        vals[f"_v_{campo}_max"] = [fim]
+    return (
+        f"({alias}.nmcont, {alias}.cod_cli) IN (SELECT fr.nmcont, fr.cod_cli FROM receber_tb fr "
+        f"WHERE fr.cod_cli IN ({{cod_cli}}) GROUP BY fr.nmcont, fr.cod_cli HAVING {' AND '.join(conds)})",
+        vals,
+    )
+
+
+def _corta_na_origem(extra: dict) -> bool:
+    """Pedido com filtros ou amostra: só os caminhos que montam o SQL pelo template servem."""
+    return bool(extra.get("_filtros") or extra.get("_amostra"))
+
+
+def _tem_gancho_infoad(masc: str, ini: int) -> bool:
+    """O WHERE do escopo que começa em `ini` traz {infoad_filter} no próprio nível."""
+    fim = _fim_do_nivel(masc, ini, _BLOCOS_PARADAS_WHERE[1:])
+    return any(
+        masc[ini:m.start()].count("(") == masc[ini:m.start()].count(")")
+        for m in re.finditer(r"\{infoad_filter\}", masc[:fim])
+        if m.start() >= ini
+    )
+
+
+def _template_com_filtros(sql_template: str, extra: dict) -> tuple[str, dict[str, list]]:
+    """Template com os predicados dos filtros (e da amostra) e os valores de cada placeholder {_v_...}."""
+    filtros = extra.get("_filtros") or {}
+    masc = _mascarar_sql(sql_template)
+    insercoes, valores, filtros_cad = [], {}, []
+    gancho = filtros.get("portfolio") is not None and "infoad_filter" not in extra
+    for campo, (rotulo, tabela, _, _) in FILTROS_CAMPOS.items():
+        if filtros.get(campo) is None:
+            continue
+        escopos = list(_escopos_dirigentes(sql_template, tabela))
+        if not escopos:
+            raise ValueError(f"O filtro '{rotulo}' não se aplica a esta base.")
+        for alias, ini in escopos:
+            pred, vals = _predicado_filtro(campo, filtros[campo], alias)
+            valores.update(vals)
+            if campo == "portfolio" and gancho and _tem_gancho_infoad(masc, ini):
+                continue
+            insercoes.extend(_inserir_no_where(masc, ini, pred))
+        if tabela == "cadastros_tb":
+            filtros_cad.append(_predicado_filtro(campo, filtros[campo], "ck")[0])
+
+    if extra.get("_amostra"):
+        escopos = list(_escopos_dirigentes(sql_template, "cadastros_tb"))
+        if not escopos:
+            raise ValueError("A amostra estratificada só vale para bases que partem de cadastros_tb.")
+        for alias, ini in escopos:
+            condicoes = _condicoes_do_escopo(sql_template, alias, ini) + [
+                re.sub(r"\bck\.", f"{alias}.", f) for f in filtros_cad
+            ]
+            pred, vals = _predicado_amostra(extra["_amostra"], alias, condicoes)
+            insercoes.extend(_inserir_no_where(masc, ini, pred))
+            valores.update(vals)
+    sql = _aplicar_insercoes(sql_template, insercoes)
+
+    if gancho:
+        sql = sql.replace("{infoad_filter}", "AND cad.infoad IN ({_v_portfolio})")
+    return sql, valores
+
+
+# =========================
+# Amostra estratificada (pilotos de discador)
+# =========================
+# N cadastros por estrato (cod_cli, infoad), sorteados no servidor antes das junções pesadas:
+# os cadastros de cada estrato são ordenados por MD5(semente + cod_cad) e ficam os N primeiros.
+# A mesma semente devolve a mesma amostra (e um cod_cad novo não desloca os já sorteados).
+# O sorteio é entre os cadastros que passam nas condições do próprio escopo de cadastros_tb
+# (as do WHERE que só olham cadastros_tb: carteira, status, sem contato em 30 dias etc.) e nos
+# filtros de cadastros_tb. O que depende de outras tabelas (telefone válido, dívida, acordos)
+# vem depois, então um estrato pode ficar com menos de N: resumo_amostra mostra quantos.
+AMOSTRA_N_PADRAO = 5_000
+AMOSTRA_SEMENTE_PADRAO = "piloto"
+
+_PALAVRAS_CONDICAO = {
+    "AND", "OR", "NOT", "IN", "IS", "NULL", "LIKE", "REGEXP", "BETWEEN", "EXISTS", "CASE", "WHEN",
+    "THEN", "ELSE", "END", "INTERVAL", "DAY", "MONTH", "YEAR", "HOUR", "MINUTE", "TRUE", "FALSE",
+}
+_RE_PLACEHOLDER_CONDICAO = re.compile(r"\{(?!cod_cli\}|hist_cad_ref_col\})\w+\}")
+
+
+def amostra_aplicavel(sql_template: str) -> bool:
+    return next(_escopos_dirigentes(sql_template, "cadastros_tb"), None) is not None
+
+
+def interpretar_amostra(n_texto: str, semente: str) -> dict | None:
+    n_texto = (n_texto or "").strip().replace(".", "")
+    if not n_texto:
+        return None
+    if not n_texto.isdigit() or int(n_texto) <= 0:
+        raise ValueError("Amostra: informe quantos cadastros por carteira/portfolio (inteiro > 0).")
+    return {"n": int(n_texto), "semente": (semente or "").strip() or AMOSTRA_SEMENTE_PADRAO}
+
+
+def _inicio_do_nivel(masc: str, pos: int) -> int:
+    depth = 0
+    for i in range(pos - 1, -1, -1):
+        if masc[i] == ")":
+            depth += 1
+        elif masc[i] == "(":
+            if depth == 0:
+                return i + 1
+            depth -= 1
+    return 0
+
+
+def _partes_and(masc: str, ini: int, fim: int) -> list[tuple[int, int]] | None:
+    """Trechos [ini, fim) separados por AND de nível 0; None se houver OR de nível 0."""
+    partes, depth, ini_parte = [], 0, ini
+    for m in re.finditer(r"\(|\)|\b(AND|OR|BETWEEN)\b", masc[:fim], re.IGNORECASE):
+        if m.start() < ini:
+            continue
+        tok = m.group(0).upper()
+        if tok == "(":
+            depth += 1
+        elif tok == ")":
+            depth -= 1
+        elif depth == 0 and tok == "OR":
+            return None
+        elif depth == 0 and tok == "BETWEEN":
+            depth -= 1  # o AND do BETWEEN não separa condições
+        elif depth == -1 and tok == "AND":
+            depth = 0
+        elif depth == 0 and tok == "AND":
+            partes.append((ini_parte, m.start()))
+            ini_parte = m.end()
+    partes.append((ini_parte, fim))
+    return partes
+
+
+def _condicoes_do_escopo(sql_template: str, alias: str, ini: int) -> list[str]:
+    """Condições do WHERE do escopo de `alias` que só usam essa tabela (texto do template)."""
+    masc = _mascarar_sql(sql_template)
+    fim = _fim_do_nivel(masc, ini, _BLOCOS_PARADAS_WHERE)
+    w = re.match(r"WHERE\b", masc[fim:], re.IGNORECASE)
+    if not w:
+        return []
+    ini_cond = fim + w.end()
+    partes = _partes_and(masc, ini_cond, _fim_do_nivel(masc, ini_cond, _BLOCOS_PARADAS_WHERE[1:]))
+    if partes is None:
+        return []
+
+    nivel = _inicio_do_nivel(masc, ini)
+    outros = set()
+    for m in _RE_ESCOPO_TABELA.finditer(masc, nivel, fim):
+        trecho = masc[nivel:m.start()]
+        if trecho.count("(") == trecho.count(")"):
+            outros.add(m.group(4) if m.group(4) and m.group(4).upper() not in _PALAVRAS_NAO_ALIAS else m.group(3))
+    outros.discard(alias)
+
+    condicoes = []
+    for a, b in partes:
+        mc, oc = masc[a:b], sql_template[a:b]
+        if "%s" in mc:
+            continue  # parâmetro de cauda: a posição dele não pode mudar
+        for p in reversed(list(_RE_PLACEHOLDER_CONDICAO.finditer(mc))):
+            mc = mc[:p.start()] + " " * len(p.group(0)) + mc[p.end():]
+            oc = oc[:p.start()] + " " * len(p.group(0)) + oc[p.end():]
+        if not mc.strip() or any(re.search(rf"\b{re.escape(o)}\.", mc, re.IGNORECASE) for o in outros):
+            continue
+        # Fora das subconsultas, toda coluna precisa vir qualificada pelo alias do escopo
+        fora = mc
+        for s in reversed([s.start() for s in re.finditer(r"\(\s*SELECT\b", mc, re.IGNORECASE)]):
+            f = _fecha_parenteses(fora, s)
+            fora = fora[:s] + " " * (f + 1 - s) + fora[f + 1:]
+        fora = re.sub(r"\{\w+\}", lambda p: " " * len(p.group(0)), fora)
+        qualificadas = re.findall(r"\b(\w+)\s*\.\s*\w+", fora)
+        if any(q.lower() != alias.lower() for q in qualificadas):
+            continue
+        soltas = [
+            t.start() for t in re.finditer(
+                r"\b[A-Za-z_]\w*\b(?!\s*[.(])",
+                re.sub(r"\b\w+\s*\.\s*\w+", lambda q: " " * len(q.group(0)), fora),
+            )
+            if t.group(0).upper() not in _PALAVRAS_CONDICAO
+        ]
+        if soltas and outros:
+            continue  # coluna sem alias numa junção: não dá para saber de que tabela é
+        for s in reversed(soltas):
+            oc = f"{oc[:s]}{alias}.{oc[s:]}"
+        condicoes.append(oc.strip())
+    return condicoes
+
+
+def _predicado_amostra(amostra: dict, alias: str, condicoes: list[str] | None = None) -> tuple[str, dict[str, list]]:
+    """
+    cod_cad IN (N primeiros por estrato). `condicoes` (com alias `alias`) restringem os
+    cadastros sorteados; sem {cod_cli} entre elas, entra o filtro de carteira.
+    """
+    conds = [re.sub(rf"\b{re.escape(alias)}\.", "ck.", c) for c in condicoes or []]
+    if not any("{cod_cli}" in c for c in conds):
+        conds.insert(0, "ck.cod_cli IN ({cod_cli})")
+    return (
+        f"{alias}.cod_cad IN (SELECT am.cod_cad FROM ("
+        f"SELECT ck.cod_cad, ROW_NUMBER() OVER (PARTITION BY ck.cod_cli, ck.infoad "
+        f"ORDER BY MD5(CONCAT({{_v_amostra_semente}}, ck.cod_cad))) AS rn_amostra "
+        f"FROM cadastros_tb ck WHERE {' AND '.join(conds)}"
+        f") am WHERE am.rn_amostra <= {{_v_amostra_n}})",
+        {"_v_amostra_semente": [str(amostra["semente"])], "_v_amostra_n": [int(amostra["n"])]},
+    )
+
+
+def resumo_amostra(df: pd.DataFrame, n: int | None = None) -> str:
+    """
+    Linhas por estrato da amostra devolvida (quando a base traz cod_cli/portfolio) e, com `n`,
+    quantos estratos ficaram abaixo de N depois dos filtros da base.
+    """
+    cols = {str(c).lower(): c for c in df.columns}
+    chaves = [cols[c] for c in ("cod_cli", "portfolio") if c in cols]
+    if not chaves or df.empty:
+        return f"{len(df)} linhas"
+    contagem = df.groupby(chaves, dropna=False).size()
+    texto = f"{len(df)} linhas em {len(contagem)} estratos (min {contagem.min()}, máx {contagem.max()} por estrato)"
+    if n:
+        abaixo = contagem[contagem < n]
+        if len(abaixo):
+            texto += f"; {len(abaixo)} estratos abaixo de {n} (faltam {int((n - abaixo).sum())} no total)"
+    return texto
+
+
+# =========================
+# Estratégia: Contratos/TipoProduto agregados no cliente
+# =========================
+# Em vez de GROUP_CONCAT no servidor (sort buffer grande + corte em group_concat_max_len),
+# a CTE `valores` vira só chaves e as tuplas (nmcont, cod_cli, fat_parc, char_5) são
+# lidas ordenadas por chave e agregadas no pandas. Só as chaves que a base devolveu (já com
+# os predicados dela: valor mínimo, exclusão de 30 dias, filtros, amostra) vão para a
+# tabela temporária tmp_valores_chaves, e as tuplas são lidas só para elas.
+VALORES_CHUNK_ROWS = 200_000
+VALORES_SEPARADOR = " || "
+VALORES_LOTE_INSERT = 10_000
+
+_RE_VALORES_GROUP_CONCAT = re.compile(
+    r",\s*GROUP_CONCAT\(DISTINCT rec\.fat_parc [^)]*\) AS Contratos"
+    r",\s*GROUP_CONCAT\(DISTINCT recc\.char_5 [^)]*\) AS TipoProduto",
+    re.IGNORECASE,
+)
+_RE_VALORES_SELECT = re.compile(r"v\.Contratos,\s*v\.TipoProduto", re.IGNORECASE)
+
+
+def _suporta_valores_cliente(sql_template: str) -> bool:
+    pos = _localizar_cte(sql_template, "valores")
+    if pos is None:
+        return False
+    corpo = sql_template[pos[0]:pos[1]]
+    return bool(_RE_VALORES_GROUP_CONCAT.search(corpo)) and bool(_RE_VALORES_SELECT.search(sql_template))
+
+
+def _template_valores_so_chaves(sql_template: str) -> str:
+    ini, fim = _localizar_cte(sql_template, "valores")
+    corpo = _RE_VALORES_GROUP_CONCAT.sub("", sql_template[ini:fim], count=1)
+    sql = sql_template[:ini] + corpo + sql_template[fim:]
+    return _RE_VALORES_SELECT.sub("v.nmcont AS _valores_nmcont, v.cod_cli AS _valores_cod_cli", sql, count=1)
+
+
+def _concat_distintos(df: pd.DataFrame, chaves: list[str], col: str) -> pd.Series:
+    """Equivalente a GROUP_CONCAT(DISTINCT col ORDER BY col SEPARATOR ' || ')."""
+    s = df[chaves + [col]].dropna(subset=[col]).drop_duplicates()
+    s = s.sort_values(chaves + [col], kind="stable")
+    return s.assign(**{col: s[col].astype(str)}).groupby(chaves, sort=False)[col].agg(VALORES_SEPARADOR.join)
+
+
+def _agregar_valores(df: pd.DataFrame) -> pd.DataFrame:
+    chaves = ["nmcont", "cod_cli"]
+    out = df[chaves].drop_duplicates().set_index(chaves)
+    out["Contratos"] = _concat_distintos(df, chaves, "fat_parc")
+    out["TipoProduto"] = _concat_distintos(df, chaves, "char_5")
+    return out.reset_index()
+
+
+def _carregar_tmp_valores_chaves(conn, chaves: pd.DataFrame):
+    """Chaves (nmcont, cod_cli) da base em tmp_valores_chaves (tipos copiados de rec_comp_tb)."""
+    linhas = chaves.dropna().drop_duplicates().astype(object).values.tolist()
+    cur = conn.cursor()
+    try:
+        cur.execute("DROP TEMPORARY TABLE IF EXISTS tmp_valores_chaves")
+        cur.execute("CREATE TEMPORARY TABLE tmp_valores_chaves AS SELECT nmcont, cod_cli FROM rec_comp_tb LIMIT 0")
+        cur.execute("ALTER TABLE tmp_valores_chaves ADD PRIMARY KEY (nmcont, cod_cli)")
+        for i in range(0, len(linhas), VALORES_LOTE_INSERT):
+            cur.executemany(
+                "INSERT IGNORE INTO tmp_valores_chaves (nmcont, cod_cli) VALUES (%s, %s)",
+                [tuple(r) for r in linhas[i:i + VALORES_LOTE_INSERT]],
+            )
+    finally:
+        cur.close()
+
+
+def _valores_cliente(conn, carteiras: list[int]) -> pd.DataFrame:
+    """
+    Lê as tuplas das chaves em tmp_valores_chaves, ordenadas por (nmcont, cod_cli), em blocos
+    e agrega cada bloco. A última chave de cada bloco fica retida até o próximo, pois pode
+    continuar nele.
+    """
+    sql, params = build_sql_and_params(SQL_VALORES_TUPLAS, carteiras)
+
+    partes = []
+    resto = None
+    for bloco in _ler_sql_blocos(conn, sql, params, chunksize=VALORES_CHUNK_ROWS):
+        if resto is not None:
+            bloco = pd.concat([resto, bloco], ignore_index=True)
+
+        ult = bloco.iloc[-1]
+        mask_ult = (bloco["nmcont"] == ult["nmcont"]) & (bloco["cod_cli"] == ult["cod_cli"])
+        resto = bloco[mask_ult]
+
+        fechado = bloco[~mask_ult]
+        if len(fechado):
+            partes.append(_agregar_valores(fechado))
+
+    if resto is not None and len(resto):
+        partes.append(_agregar_valores(resto))
+
+    if not partes:
+        return pd.DataFrame(columns=["nmcont", "cod_cli", "Contratos", "TipoProduto"])
+    return pd.concat(partes, ignore_index=True)
+
+
+def _run_valores_cliente(conn, sql_template: str, carteiras: list[int], extra: dict) -> pd.DataFrame:
+    sql, params = build_sql_and_params(_template_valores_so_chaves(sql_template), carteiras, extra=extra)
+    df = _ler_sql(conn, sql, params)
+
+    chaves = ["_valores_nmcont", "_valores_cod_cli"]
+    _carregar_tmp_valores_chaves(conn, df[chaves])
+    valores = _valores_cliente(conn, carteiras)
+    valores = valores.rename(columns={"nmcont": chaves[0], "cod_cli": chaves[1]})
+
+    pos = df.columns.get_loc(chaves[0])
+    df = df.merge(valores, how="left", on=chaves)
+
+    cols = [c for c in df.columns if c not in chaves + ["Contratos", "TipoProduto"]]
+    cols[pos:pos] = ["Contratos", "TipoProduto"]
+    return df[cols]
+
+
+# =========================
+# Estratégia: anti-join "contatados nos últimos 30 dias"
+# =========================
+# O conjunto de cod_cli contatados é montado uma vez (range scan em hist_tb.data_at),
+# fica em cache por alguns minutos (por modo e coluna de hist_tb) e é aplicado via tabela
+# temporária com PK ("temp"), no lugar do NOT IN correlacionado. Não há anti-join no app:
+# ele trazia do banco as linhas dos contatados só para descartá-las no pandas.
+CONTATADOS_TTL_S = 600
+ANTIJOIN_PADRAO = "temp"
+ANTIJOIN_OPCOES = [
+    ("Tabela temporária com PK", ANTIJOIN_PADRAO),
+    ("No banco (NOT IN original)", None),
+]
+CONTATADOS_LOTE_INSERT = 10_000
+
+_contatados_cache: dict[tuple[str, str], tuple[float, np.ndarray]] = {}
+_contatados_lock = threading.Lock()
+
+_RE_NOT_IN_HIST = re.compile(r"AND\s+cad\.cod_cad\s+NOT\s+IN\s*\(", re.IGNORECASE)
+
+
+def _modo_antijoin(sql_template: str) -> str | None:
+    if sql_template == SQL_SEM_HIST_30D:
+        return "sem_hist"
+    if sql_template == SQL_NUNCA:
+        return "nunca"
+    return None
+
+
+def _remover_not_in_hist(sql_template: str, substituto: str) -> str:
+    m = _RE_NOT_IN_HIST.search(sql_template)
+    if not m:
+        raise ValueError("Template não tem o filtro 'cod_cad NOT IN (hist_tb ...)'.")
+    fim = _fecha_parenteses(sql_template, m.end() - 1)
+    return sql_template[:m.start()] + substituto + sql_template[fim + 1:]
+
+
+def _contatados_30d(conn, modo: str, hist_col: str = HIST_CAD_REF_COL) -> np.ndarray:
+    chave = (modo, hist_col)
+    with _contatados_lock:
+        hit = _contatados_cache.get(chave)
+        if hit and time.monotonic() - hit[0] < CONTATADOS_TTL_S:
+            return hit[1]
+
+    sql = SQL_CONTATADOS_30D[modo].format(hist_cad_ref_col=hist_col)
+    ids = _ler_sql(conn, sql)["cod_cli"].dropna().to_numpy()
+
+    with _contatados_lock:
+        _contatados_cache[chave] = (time.monotonic(), ids)
+    return ids
+
+
+def _carregar_tmp_contatados(conn, ids: np.ndarray):
+    cur = conn.cursor()
+    try:
+        cur.execute("DROP TEMPORARY TABLE IF EXISTS tmp_contatados")
+        cur.execute("CREATE TEMPORARY TABLE tmp_contatados (cod_cli BIGINT NOT NULL PRIMARY KEY)")
+        for i in range(0, len(ids), CONTATADOS_LOTE_INSERT):
+            lote = [(int(x),) for x in ids[i:i + CONTATADOS_LOTE_INSERT]]
+            cur.executemany("INSERT IGNORE INTO tmp_contatados (cod_cli) VALUES (%s)", lote)
+    finally:
+        cur.close()
+
+
+def _preparar_antijoin(conn, sql_template: str, estrategia: str, hist_col: str = HIST_CAD_REF_COL) -> str:
+    """Carrega tmp_contatados na conexão e troca o NOT IN por NOT EXISTS contra ela ("temp")."""
+    if estrategia != "temp":
+        raise ValueError(f"Estratégia de anti-join desconhecida: {estrategia!r}")
+    _carregar_tmp_contatados(conn, _contatados_30d(conn, _modo_antijoin(sql_template), hist_col))
+    return _remover_not_in_hist(
+        sql_template,
+        "AND NOT EXISTS (SELECT 1 FROM tmp_contatados tc WHERE tc.cod_cli = cad.cod_cad)",
+    )
+
+
+# =========================
+# Estratégia: super-base (Recentes / Nunca / Quebras numa consulta só)
+# =========================
+# SQL_SUPERBASE traz o superconjunto das três bases com os predicados como colunas;
+# cada base é derivada no pandas. O frame fica em cache por carteiras + filtros,
+# então gerar as três custa ~1 consulta.
+SUPERBASE_TTL_S = 900
+
+_superbase_cache: dict[tuple, tuple[float, pd.DataFrame]] = {}
+_superbase_lock = threading.Lock()
+
+_SUPERBASE_COLS_FIXAS = [
+    "MarcaModelo", "placa", "cor", "AnoFabModelo", "QtdGarantiasUnicas",
+    "Contratos", "TipoProduto",
+    "UltimoValorAcordado", "TipoAcordo", "DataCriacaoGecobi", "StatusUltimoAcordo",
+]
+
+
+def _superbase_alvo(sql_template: str) -> str | None:
+    if sql_template == SQL_RECENTES:
+        return "recentes"
+    if sql_template == SQL_NUNCA:
+        return "nunca"
+    if sql_template == SQL_QUEBRAS_REJEITADAS:
+        return "quebras"
+    return None
+
+
+def _superbase_frame(conn, carteiras: list[int], extra: dict) -> pd.DataFrame:
+    chave = (
+        tuple(sorted(carteiras)),
+        extra.get("infoad_filter", ""),
+        extra.get("vlrparc_having", ""),
+        tuple(extra.get("_tail_params") or []),
+        bool(extra.get("_valores_cliente")),
+        json.dumps([extra.get("_filtros"), extra.get("_amostra")], sort_keys=True, default=str),
+    )
+    with _superbase_lock:
+        hit = _superbase_cache.get(chave)
+        if hit and time.monotonic() - hit[0] < SUPERBASE_TTL_S:
+            return hit[1]
+
+    if extra.get("_valores_cliente"):
+        df = _run_valores_cliente(conn, SQL_SUPERBASE, carteiras, extra)
+    else:
+        sql, params = build_sql_and_params(SQL_SUPERBASE, carteiras, extra=extra)
+        df = _ler_sql(conn, sql, params)
+
+    with _superbase_lock:
+        _superbase_cache[chave] = (time.monotonic(), df)
+    return df
+
+
+def _derivar_da_superbase(conn, sup: pd.DataFrame, alvo: str, hist_col: str = HIST_CAD_REF_COL) -> pd.DataFrame:
+    tels = [f"Telefone{i}" for i in range(1, TEL_LIMIT_FIXO + 1)]
+
+    if alvo == "recentes":
+        df = sup[sup["_flag_recente"] == 1]
+        cols = ["cod_cad", "nome", "cpf", "BindingID", "DataNascimento", "Portfolio"] + tels
+        return df[cols + _SUPERBASE_COLS_FIXAS].reset_index(drop=True)
+
+    # Nunca / Quebras: só clientes com telefone válido, e telefones do ranking "Ok"
+    df = sup[sup["_tem_tel_ok"] == 1]
+    if alvo == "nunca":
+        df = df[~df["cod_cad"].isin(_contatados_30d(conn, "nunca", hist_col))]
+    elif alvo == "quebras":
+        df = df[df["_staco"].isin(["Q", "E"])]
+    else:
+        raise ValueError(f"Base desconhecida para a super-base: {alvo!r}")
+
+    ren = {f"TelefoneOk{i}": f"Telefone{i}" for i in range(1, TEL_LIMIT_FIXO + 1)}
+    ren.update({"BindingID": "bindingid", "DataNascimento": "datanascimento", "Portfolio": "portfolio"})
+    df = df.drop(columns=tels).rename(columns=ren)
+    cols = ["cod_cad", "nome", "cpf", "bindingid", "datanascimento", "portfolio"] + tels
+    return df[cols + _SUPERBASE_COLS_FIXAS].reset_index(drop=True)
+
+
+def _run_superbase(conn, sql_template: str, carteiras: list[int], extra: dict) -> pd.DataFrame:
+    hist_col = extra.get("hist_cad_ref_col", HIST_CAD_REF_COL)
+    return _derivar_da_superbase(conn, _superbase_frame(conn, carteiras, extra), _superbase_alvo(sql_template), hist_col)
+
+
+def gerar_superbase_todas(carteiras: list[int], extra: dict | None = None) -> dict[str, pd.DataFrame]:
+    """Recentes, Nunca e Quebras a partir de uma única leitura da super-base."""
+    extra = extra or {}
+    conn = _abrir_conexao()
+    try:
+        sup = _superbase_frame(conn, carteiras, extra)
+        hist_col = extra.get("hist_cad_ref_col", HIST_CAD_REF_COL)
+        return {alvo: _derivar_da_superbase(conn, sup, alvo, hist_col) for alvo in ("recentes", "nunca", "quebras")}
+    finally:
+        conn.close()
+
+
+# =========================
+# Reescrita de SQL no texto (literais e comentários mascarados)
+# =========================
+# As buscas rodam sobre o SQL mascarado (mesmas posições, conteúdo de literais e comentários
+# apagado) e as inserções são aplicadas no texto original, de trás para frente.
+_RE_COMENTARIO_SQL = re.compile(r"--[^\n]*")
+_RE_CLAUSULA_SQL = re.compile(
+    r"\(|\)|;|\b(SELECT|FROM|WHERE|GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT|UNION|WINDOW|ON)\b", re.IGNORECASE
+)
+_RE_FROM_TABELA = re.compile(r"\bFROM\s+(?:\w+\.)?(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+_BLOCOS_PARADAS_WHERE = ("WHERE", "GROUP BY", "HAVING", "ORDER BY", "LIMIT", "UNION", "WINDOW")
+_PALAVRAS_NAO_ALIAS = {
+    "ON", "WHERE", "LEFT", "RIGHT", "INNER", "OUTER", "CROSS", "JOIN", "STRAIGHT_JOIN", "GROUP",
+    "ORDER", "HAVING", "LIMIT", "UNION", "USING", "WINDOW", "SELECT", "AND", "OR",
+}
+
+
+def _mascarar_sql(sql: str) -> str:
+    """Apaga conteúdo de literais e comentários mantendo as posições (as buscas olham só o código)."""
+    sql = _RE_LITERAL_SQL.sub(lambda m: "'" + " " * (len(m.group(0)) - 2) + "'", sql)
+    return _RE_COMENTARIO_SQL.sub(lambda m: " " * len(m.group(0)), sql)
+
+
+def _fim_do_nivel(masc: str, ini: int, paradas: tuple[str, ...]) -> int:
+    """Posição onde o nível de parênteses de `ini` fecha ou aparece uma das cláusulas `paradas`."""
+    depth = 0
+    for m in _RE_CLAUSULA_SQL.finditer(masc, ini):
+        tok = m.group(0)
+        if tok == "(":
+            depth += 1
+        elif tok == ")":
+            if depth == 0:
+                return m.start()
+            depth -= 1
+        elif depth == 0 and (tok == ";" or (m.group(1) and " ".join(m.group(1).upper().split()) in paradas)):
+            return m.start()
+    return len(masc)
+
+
+def _texto_no_nivel(masc: str) -> str:
+    """Só o que está fora de parênteses (para achar OR de nível 0)."""
+    partes, depth = [], 0
+    for ch in masc:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif depth == 0:
+            partes.append(ch)
+    return "".join(partes)
+
+
+def _inserir_no_where(masc: str, ini: int, pred: str) -> list[tuple[int, str]]:
+    """Inserções que somam `pred` (com AND) ao WHERE do SELECT em que `ini` está."""
+    fim = _fim_do_nivel(masc, ini, _BLOCOS_PARADAS_WHERE)
+    w = re.match(r"WHERE\b", masc[fim:], re.IGNORECASE)
+    if not w:
+        return [(fim, f" WHERE {pred}\n")]
+    ini_cond = fim + w.end()
+    fim_cond = _fim_do_nivel(masc, ini_cond, _BLOCOS_PARADAS_WHERE[1:])
+    if re.search(r"\bOR\b", _texto_no_nivel(masc[ini_cond:fim_cond]), re.IGNORECASE):
+        return [(ini_cond, f" {pred} AND ("), (fim_cond, ")")]
+    return [(ini_cond, f" {pred} AND")]
+
+
+def _aplicar_insercoes(sql: str, insercoes: list[tuple[int, str]]) -> str:
+    for pos, texto in sorted(insercoes, key=lambda x: x[0], reverse=True):
+        sql = sql[:pos] + texto + sql[pos:]
+    return sql
+
+
+# =========================
+# Staging: tabelas-resumo no banco (mantidas pela ferramenta)
+# =========================
+# Fatos derivados que as bases compostas recalculam a cada execução (último acordo,
+# último CPC, dívida, telefones limpos, garantias) ficam materializados e indexados em
+# STAGING_SCHEMA. As CTEs correspondentes são reescritas para ler dessas tabelas.
+# stg_ultimo_cpc é incremental por hist_tb.data_at. As demais são incrementais por chave
+# alterada: as chaves dos cadastros recarregados (cadastros_tb.data_arq) e dos acordos novos
+# (acordos_tb.data_cad) desde o watermark (com sobreposição) são apagadas e recalculadas numa
+# transação. Reconstrução completa (RENAME atômico) só na primeira vez e com --completo.
+# Na execução das bases nada é reconstruído: staging velho é lido assim mesmo (com aviso) e
+# a atualização incremental vai para segundo plano; staging inexistente, ou mais velho que
+# STAGING_MAX_IDADE_USO_MIN, cai nas tabelas de origem.
+STAGING_SCHEMA = "gerador_stg"
+STAGING_MAX_IDADE_MIN = 60
+STAGING_MAX_IDADE_USO_MIN = 6 * 60
+STAGING_JANELA_DIAS = 31
+STAGING_SOBREPOSICAO_MIN = 60
+STAGING_LOCK = "gerador_stg_refresh"
+# Tabela -> chave das linhas alteradas (nmcont + carteira, ou cod_cad)
+STAGING_CHAVES = {
+    "stg_ultimo_acordo": "nmcont",
+    "stg_divida": "nmcont",
+    "stg_fones_limpos": "cod_cad",
+    "stg_bens": "nmcont",
+}
+
+_staging_em_fila = threading.Event()
+_STG_TABELAS_ORIGEM = {"acordos_tb", "receber_tb", "rec_comp_tb", "fones_tb", "bens_tb"}
+
+_RE_FILTRO_CPC = re.compile(r"LIKE\s+'%+CPC%+'", re.IGNORECASE)
+_RE_REGEXP_TELEFONE = re.compile(
+    r"\s*AND\s+CONCAT\(\s*(?:tel\.)?dddfone,\s*(?:tel\.)?telefone\s*\)\s+NOT\s+REGEXP\s+'[^']*'",
+    re.IGNORECASE,
+)
+
+
+def _stg_existe(conn, tabela: str) -> bool:
+    df = _ler_sql(
+        conn,
+        "SELECT COUNT(*) AS n FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+        [STAGING_SCHEMA, tabela],
+    )
+    return bool(df.iloc[0, 0])
+
+
+def _stg_executar(conn, sql: str, params: list | None = None):
+    cur = conn.cursor()
+    try:
+        cur.execute(sql, params or ())
+    finally:
+        cur.close()
+    conn.commit()
+
+
+def _stg_reconstruir(conn, tabela: str, indices: str, select: str):
+    stg = STAGING_SCHEMA
+    _stg_executar(conn, f"DROP TABLE IF EXISTS {stg}.{tabela}_novo")
+    _stg_executar(conn, f"CREATE TABLE {stg}.{tabela}_novo ({indices}) {select}")
+    if _stg_existe(conn, tabela):
+        _stg_executar(conn, f"RENAME TABLE {stg}.{tabela} TO {stg}.{tabela}_velho, {stg}.{tabela}_novo TO {stg}.{tabela}")
+        _stg_executar(conn, f"DROP TABLE {stg}.{tabela}_velho")
+    else:
+        _stg_executar(conn, f"RENAME TABLE {stg}.{tabela}_novo TO {stg}.{tabela}")
+
+
+def _stg_executar_transacao(conn, comandos: list[tuple[str, list | None]]):
+    """Vários comandos num commit só (quem lê no meio continua vendo a versão anterior)."""
+    cur = conn.cursor()
+    try:
+        for sql, params in comandos:
+            cur.execute(sql, params or ())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def _stg_watermarks(conn) -> dict[str, pd.Timestamp]:
+    df = _ler_sql(conn, f"SELECT tabela, watermark FROM {STAGING_SCHEMA}.stg_controle")
+    return {t: pd.Timestamp(w) for t, w in zip(df["tabela"], df["watermark"]) if w is not None and not pd.isna(w)}
+
+
+def _stg_marcar_alteradas(conn, desde: pd.Timestamp):
+    """Chaves alteradas desde `desde` em stg_chaves_alteradas / stg_cad_alterados (tabelas comuns:
+    uma tabela temporária não pode ser lida duas vezes na mesma instrução)."""
+    stg = STAGING_SCHEMA
+    ts = _fmt_ts(desde)
+    for tabela, sql in SQL_STG_CHAVES_ALTERADAS.items():
+        _stg_executar(conn, f"DROP TABLE IF EXISTS {stg}.{tabela}")
+        _stg_executar(conn, sql.format(stg=stg), [ts] * sql.count("%s"))
+
+
+def _stg_restrito_as_alteradas(select: str, chave: str) -> str:
+    """`select` com as tabelas de origem restritas às chaves alteradas."""
+    stg = STAGING_SCHEMA
+    masc = _mascarar_sql(select)
+    insercoes = []
+    for m in _RE_FROM_TABELA.finditer(masc):
+        tabela = m.group(1).lower()
+        if tabela not in _STG_TABELAS_ORIGEM:
+            continue
+        if m.group(2) and m.group(2).upper() not in _PALAVRAS_NAO_ALIAS:
+            alias, ini = m.group(2), m.end()
+        else:
+            alias, ini = m.group(1), m.end(1)
+        if chave == "cod_cad":
+            pred = f"{alias}.cod_cad IN (SELECT k.cod_cad FROM {stg}.stg_cad_alterados k)"
+        else:
+            pred = f"({alias}.nmcont, {alias}.cod_cli) IN (SELECT k.nmcont, k.cod_cli FROM {stg}.stg_chaves_alteradas k)"
+        insercoes.extend(_inserir_no_where(masc, ini, pred))
+    return _aplicar_insercoes(select, insercoes)
+
+
+def _stg_atualizar_alteradas(conn, tabela: str, select: str):
+    stg = STAGING_SCHEMA
+    if STAGING_CHAVES[tabela] == "cod_cad":
+        apagar = (
+            f"DELETE s FROM {stg}.{tabela} s "
+            f"JOIN {stg}.stg_cad_alterados k ON k.cod_cad = s.cod_cad"
+        )
+    else:
+        apagar = (
+            f"DELETE s FROM {stg}.{tabela} s "
+            f"JOIN {stg}.stg_chaves_alteradas k ON k.nmcont = s.nmcont AND k.cod_cli = s.cod_cli"
+        )
+    inserir = f"INSERT INTO {stg}.{tabela} {_stg_restrito_as_alteradas(select, STAGING_CHAVES[tabela])}"
+    _stg_executar_transacao(conn, [(apagar, None), (inserir, None)])
+
+
+def _stg_atualizar_ultimo_cpc(conn):
+    stg = STAGING_SCHEMA
+    select = SQL_STG_ULTIMO_CPC_SELECT.format(hist_cad_ref_col=HIST_CAD_REF_COL)
+    agora = pd.Timestamp(_ler_sql(conn, "SELECT NOW() AS agora").iloc[0, 0])
+
+    wm = None
+    if _stg_existe(conn, "stg_ultimo_cpc"):
+        df = _ler_sql(conn, f"SELECT watermark FROM {stg}.stg_controle WHERE tabela = 'stg_ultimo_cpc'")
+        wm = df.iloc[0, 0] if len(df) else None
+    else:
+        _stg_executar(
+            conn,
+            f"CREATE TABLE {stg}.stg_ultimo_cpc (PRIMARY KEY (nmcont, cod_cli), INDEX ix_cli (cod_cli)) "
+            f"{select} LIMIT 0",
+            [_fmt_ts(agora), _fmt_ts(agora)],
+        )
+
+    if wm is None or pd.isna(wm):
+        inicio = _ler_sql(conn, "SELECT MIN(data_at) AS ini FROM hist_tb").iloc[0, 0]
+        ini = pd.Timestamp(inicio).normalize() if inicio is not None else agora.normalize()
+    else:
+        ini = pd.Timestamp(wm) - pd.Timedelta(minutes=STAGING_SOBREPOSICAO_MIN)
+
+    upsert = SQL_STG_ULTIMO_CPC_UPSERT.format(stg=stg, select=select)
+    while ini <= agora:
+        fim = min(ini + pd.Timedelta(days=STAGING_JANELA_DIAS), agora + pd.Timedelta(seconds=1))
+        _stg_executar(conn, upsert, [_fmt_ts(ini), _fmt_ts(fim)])
+        ini = fim
+    return agora
+
+
+def atualizar_staging(completo: bool = False, reconstruir: bool = True) -> dict[str, float] | None:
+    """
+    Atualiza as tabelas-resumo e devolve {tabela: segundos}. Devolve None se outra
+    estação já está atualizando (GET_LOCK), para não atualizar duas vezes.
+    completo=True reconstrói todas; reconstruir=False só faz o incremental (tabelas sem
+    watermark ficam como estão).
+    """
+    stg = STAGING_SCHEMA
+    duracoes: dict[str, float] = {}
+
+    conn = _abrir_conexao()
+    try:
+        if not _ler_sql(conn, "SELECT GET_LOCK(%s, 0) AS ok", [STAGING_LOCK]).iloc[0, 0]:
+            return None
+        try:
+            _stg_executar(conn, f"CREATE DATABASE IF NOT EXISTS {stg}")
+            _stg_executar(conn, SQL_STG_CONTROLE.format(stg=stg))
+            registrar = SQL_STG_REGISTRAR.format(stg=stg)
+            agora = pd.Timestamp(_ler_sql(conn, "SELECT NOW() AS agora").iloc[0, 0])
+            wms = _stg_watermarks(conn)
+
+            incrementais = [
+                t for t in SQL_STG_RECONSTRUCAO if not completo and t in wms and _stg_existe(conn, t)
+            ]
+            if incrementais:
+                desde = min(wms[t] for t in incrementais) - pd.Timedelta(minutes=STAGING_SOBREPOSICAO_MIN)
+                _stg_marcar_alteradas(conn, desde)
+
+            for tabela, (indices, select) in SQL_STG_RECONSTRUCAO.items():
+                if tabela not in incrementais and not reconstruir:
+                    continue
+                t0 = time.perf_counter()
+                if tabela in incrementais:
+                    _stg_atualizar_alteradas(conn, tabela, select)
+                else:
+                    _stg_reconstruir(conn, tabela, indices, select)
+                duracoes[tabela] = time.perf_counter() - t0
+                _stg_executar(conn, registrar, [tabela, _fmt_ts(agora), duracoes[tabela]])
+
+            if reconstruir or "stg_ultimo_cpc" in wms:
+                t0 = time.perf_counter()
+                wm = _stg_atualizar_ultimo_cpc(conn)
+                duracoes["stg_ultimo_cpc"] = time.perf_counter() - t0
+                _stg_executar(conn, registrar, ["stg_ultimo_cpc", _fmt_ts(wm), duracoes["stg_ultimo_cpc"]])
+        finally:
+            _ler_sql(conn, "SELECT RELEASE_LOCK(%s) AS ok", [STAGING_LOCK])
+    finally:
+        conn.close()
+
+    return duracoes
+
+
+def status_staging(conn=None) -> pd.DataFrame | None:
+    """(tabela, atualizado_em, duracao_s, idade_min) de cada tabela-resumo; None se o staging não existe."""
+    fechar = conn is None
+    conn = conn or _abrir_conexao()
+    try:
+        if not _stg_existe(conn, "stg_controle"):
+            return None
+        df = _ler_sql(
+            conn,
+            f"SELECT tabela, atualizado_em, duracao_s, "
+            f"TIMESTAMPDIFF(SECOND, atualizado_em, NOW()) / 60 AS idade_min "
+            f"FROM {STAGING_SCHEMA}.stg_controle",
+        )
+    finally:
+        if fechar:
+            conn.close()
+    if not {*SQL_STG_RECONSTRUCAO, "stg_ultimo_cpc"} <= set(df["tabela"]):
+        return None
+    return df
+
+
+def _atualizar_staging_em_segundo_plano():
+    """Atualização incremental numa thread (uma por vez por processo; GET_LOCK cuida das estações)."""
+    if DRIVER_MODO == "replay" or _staging_em_fila.is_set():
+        return
+    _staging_em_fila.set()
+
+    def rodar():
+        try:
+            atualizar_staging(reconstruir=False)
+        except Exception as e:
+            print(f"[staging] atualização em segundo plano falhou: {e}", file=sys.stderr)
+        finally:
+            _staging_em_fila.clear()
+
+    threading.Thread(target=rodar, daemon=True, name="staging").start()
+
+
+def _garantir_staging(conn) -> bool:
+    """
+    True se a base pode ler das tabelas-resumo. Velhas: lê assim mesmo, com aviso, e a
+    atualização incremental vai para segundo plano. Inexistentes ou mais velhas que
+    STAGING_MAX_IDADE_USO_MIN: False (lê das tabelas de origem); a criação fica com --atualizar-staging.
+    """
+    st = status_staging(conn)
+    if st is None:
+        _avisar_andamento(
+            f"[staging] {STAGING_SCHEMA} ainda não foi criado; lendo das tabelas de origem "
+            "(rode --atualizar-staging)"
+        )
+        return False
+    idade = float(st["idade_min"].max())
+    if idade > STAGING_MAX_IDADE_USO_MIN:
+        _avisar_andamento(
+            f"[staging] tabelas-resumo de {idade:.0f} min atrás; lendo das tabelas de origem enquanto atualiza",
+        )
+        _atualizar_staging_em_segundo_plano()
+        return False
+    if idade > STAGING_MAX_IDADE_MIN:
+        _avisar_andamento(
+            f"[staging] tabelas-resumo de {idade:.0f} min atrás; lendo assim mesmo e atualizando em segundo plano",
+        )
+        _atualizar_staging_em_segundo_plano()
+    return True
+
+
+def _usa_staging(sql_template: str) -> bool:
+    if sql_template == SQL_MAIORES_DIVIDAS:
+        return True
+    return any(_localizar_cte(sql_template, n) for n in ("acordos_ranked", "ranked", "cpc_ultimo", "valores", "bens", "telefones"))
+
+
+def _template_com_staging(sql_template: str, extra: dict) -> str:
+    """Reescreve as CTEs (e Maiores Dívidas) para ler das tabelas-resumo do staging."""
+    stg = STAGING_SCHEMA
+    tpl = sql_template
+
+    if tpl == SQL_MAIORES_DIVIDAS:
+        return (
+            tpl.replace("JOIN receber_tb rec", f"JOIN {stg}.stg_divida rec")
+            .replace("COUNT(DISTINCT rec.fat_parc)", "SUM(rec.qtd_contratos)")
+        )
+
+    for nome in ("acordos_ranked", "ranked"):
+        pos = _localizar_cte(tpl, nome)
+        if pos:
+            corpo = tpl[pos[0]:pos[1]].replace("FROM acordos_tb a", f"FROM {stg}.stg_ultimo_acordo a")
+            tpl = _substituir_cte(tpl, nome, corpo)
+
+    pos = _localizar_cte(tpl, "cpc_ultimo")
+    if pos and not extra.get("infoad_filter") and not (extra.get("_filtros") or {}).get("portfolio"):
+        col = "dt_ultimo_cpc" if _RE_FILTRO_CPC.search(tpl[pos[0]:pos[1]]) else "dt_ultimo_contato"
+        tpl = _substituir_cte(tpl, "cpc_ultimo", f"""
+    SELECT uc.nmcont, MAX(uc.{col}) AS dt_ultimo_cpc
+    FROM {stg}.stg_ultimo_cpc uc
+    WHERE uc.cod_cli IN ({{cod_cli}})
+    GROUP BY uc.nmcont
+""")
+
+    if _localizar_cte(tpl, "valores") and not extra.get("vlrparc_having"):
+        tpl = _substituir_cte(tpl, "valores", f"""
+    SELECT d.nmcont, d.cod_cli, d.Contratos, d.TipoProduto
+    FROM {stg}.stg_divida d
+    WHERE d.cod_cli IN ({{cod_cli}})
+      AND d.tem_rec_comp = 1
+      AND d.Contratos IS NOT NULL
+      AND d.nmcont NOT IN (SELECT nmcont FROM acordos_pagos)
+""")
+
+    if _localizar_cte(tpl, "bens"):
+        tpl = _substituir_cte(tpl, "bens", f"""
+    SELECT b.nmcont, b.cod_cli, b.MarcaModelo, b.placa, b.cor, b.AnoFabModelo, b.QtdGarantiasUnicas
+    FROM {stg}.stg_bens b
+    WHERE b.cod_cli IN ({{cod_cli}})
+""")
+
+    pos = _localizar_cte(tpl, "telefones")
+    if pos:
+        corpo = tpl[pos[0]:pos[1]].replace("JOIN fones_tb tel", f"JOIN {stg}.stg_fones_limpos tel")
+        tpl = _substituir_cte(tpl, "telefones", _RE_REGEXP_TELEFONE.sub("", corpo))
+
+    return tpl
+
+
+# =========================
+# Armazenamento local (SQLite)
+# =========================
+_WATERMARK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS watermark (
+    nome TEXT PRIMARY KEY,
+    valor TEXT NOT NULL
+);
+"""
+
+
+def _abrir_local(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    loc = sqlite3.connect(path)
+    loc.executescript(_WATERMARK_SCHEMA)
+    return loc
+
+
+def _ler_watermark(loc: sqlite3.Connection, nome: str) -> str | None:
+    row = loc.execute("SELECT valor FROM watermark WHERE nome = ?", (nome,)).fetchone()
+    return row[0] if row else None
+
+
+def _gravar_watermark(loc: sqlite3.Connection, nome: str, valor: str):
+    loc.execute(
+        "INSERT INTO watermark (nome, valor) VALUES (?, ?) "
+        "ON CONFLICT(nome) DO UPDATE SET valor = excluded.valor",
+        (nome, valor),
+    )
+
+
+def _fmt_ts(v) -> str:
+    return pd.Timestamp(v).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# =========================
+# Índice local de segmentos (bitmaps de cod_cad)
+# =========================
+# Cada segmento é um conjunto de cod_cad guardado como bitmap comprimido (int do Python
+# + zlib). Bases que são operações de conjunto ("ativos - contatados 30d") viram
+# AND/OR/ANDNOT em memória, e só as colunas de detalhe finais vão ao banco. Nas bases
+# compostas (Nunca, Quebras) o índice escolhe as chaves: os cod_cad vão para uma tabela
+# temporária e o SQL só monta as colunas desses cadastros.
+#
+# ativos/acordo/garantia saem de um espelho local das chaves (seg_cadastro, seg_acordo,
+# seg_garantia), atualizado só pelas chaves alteradas desde a marca d'água: cadastros
+# recarregados (data_arq) e acordos novos (data_cad). Mudança de status sem carga nova só
+# entra na carga completa (primeira vez, a cada SEGMENTOS_COMPLETO_MAX_IDADE_H ou --completo).
+SEGMENTOS_DB_PATH = os.path.join(LOCAL_DATA_DIR, "segmentos.sqlite")
+SEGMENTOS_MAX_IDADE_MIN = 30
+SEGMENTOS_MAX_IDADE_USO_MIN = 4 * 60  # acima disso a base vai ao banco sem o índice
+SEGMENTOS_DETALHE_LOTE = 5_000
+SEGMENTOS_JANELA_CONTATO_DIAS = 30
+SEGMENTOS_SOBREPOSICAO_MIN = 60  # relê a última hora para pegar gravações atrasadas
+SEGMENTOS_COMPLETO_MAX_IDADE_H = 24
+SEGMENTOS_LOTE_INSERT = 10_000
+STATUS_ACORDO = ("P", "A", "G", "Q", "E")
+
+_SEGMENTOS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS seg_bitmap (
+    nome TEXT PRIMARY KEY,
+    bits BLOB NOT NULL,
+    cardinalidade INTEGER NOT NULL,
+    atualizado_em TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS seg_ultimo_contato (
+    cod_cad INTEGER PRIMARY KEY,
+    data_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS seg_ultimo_contato_nunca (
+    cod_cad INTEGER PRIMARY KEY,
+    data_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS seg_cadastro (
+    cod_cad INTEGER PRIMARY KEY,
+    nmcont,
+    cod_cli INTEGER NOT NULL,
+    ativo INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_seg_cadastro_nmcont ON seg_cadastro (nmcont, cod_cli);
+CREATE TABLE IF NOT EXISTS seg_acordo (
+    nmcont PRIMARY KEY,
+    staco TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS seg_garantia (
+    nmcont NOT NULL,
+    cod_cli INTEGER NOT NULL,
+    PRIMARY KEY (nmcont, cod_cli)
+);
+"""
+
+
+def _ids_para_bitmap(ids) -> int:
+    arr = np.unique(np.asarray(ids, dtype=np.int64))
+    if arr.size == 0:
+        return 0
+    if arr[0] < 0:
+        raise ValueError("cod_cad negativo não cabe no bitmap.")
+    flags = np.zeros(int(arr[-1]) + 1, dtype=bool)
+    flags[arr] = True
+    return int.from_bytes(np.packbits(flags, bitorder="little").tobytes(), "little")
+
+
+def _bitmap_para_ids(bits: int) -> np.ndarray:
+    if bits <= 0:
+        return np.empty(0, dtype=np.int64)
+    raw = np.frombuffer(bits.to_bytes((bits.bit_length() + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(raw, bitorder="little")).astype(np.int64)
+
+
+def _bitmap_serializar(bits: int) -> bytes:
+    return zlib.compress(bits.to_bytes((bits.bit_length() + 7) // 8, "little"), 6)
+
+
+def _bitmap_deserializar(blob: bytes) -> int:
+    return int.from_bytes(zlib.decompress(blob), "little")
+
+
+def carregar_segmentos() -> dict[str, int]:
+    with closing(_abrir_local(SEGMENTOS_DB_PATH)) as loc:
+        loc.executescript(_SEGMENTOS_SCHEMA)
+        return {nome: _bitmap_deserializar(bits) for nome, bits in loc.execute("SELECT nome, bits FROM seg_bitmap")}
+
+
+def idade_segmentos_min() -> float | None:
+    """Minutos desde a atualização mais antiga do índice (None se vazio)."""
+    with closing(_abrir_local(SEGMENTOS_DB_PATH)) as loc:
+        loc.executescript(_SEGMENTOS_SCHEMA)
+        row = loc.execute("SELECT MIN(atualizado_em) FROM seg_bitmap").fetchone()
+    if not row or not row[0]:
+        return None
+    return (pd.Timestamp.now() - pd.Timestamp(row[0])).total_seconds() / 60.0
+
+
+def _linhas_py(df: pd.DataFrame) -> list[tuple]:
+    """Linhas com tipos do Python (o sqlite3 não aceita np.int64) e None no lugar de NaN."""
+    return [tuple(r) for r in df.astype(object).where(df.notna(), None).values.tolist()]
+
+
+def _seg_executar_lotes(loc: sqlite3.Connection, sql: str, linhas: list[tuple]):
+    for i in range(0, len(linhas), SEGMENTOS_LOTE_INSERT):
+        loc.executemany(sql, linhas[i:i + SEGMENTOS_LOTE_INSERT])
+
+
+def _seg_atualizar_chaves(conn, loc: sqlite3.Connection, carteiras: list[int], agora: pd.Timestamp, completo: bool):
+    """Atualiza seg_cadastro / seg_acordo / seg_garantia (carga completa ou só chaves alteradas)."""
+    ultimo_completo = _ler_watermark(loc, "chaves_completo")
+    wm = _ler_watermark(loc, "chaves")
+    completo = (
+        completo or wm is None or ultimo_completo is None
+        or agora - pd.Timestamp(ultimo_completo) > pd.Timedelta(hours=SEGMENTOS_COMPLETO_MAX_IDADE_H)
+    )
+    marcas = ",".join("?" * len(carteiras))
+
+    if completo:
+        sql, params = build_sql_and_params(SQL_SEG_CADASTROS, carteiras)
+        cad = _ler_sql(conn, sql, params)
+        sql, params = build_sql_and_params(SQL_SEG_ACORDOS, carteiras)
+        aco = _ler_sql(conn, sql, params)
+        sql, params = build_sql_and_params(SQL_SEG_GARANTIAS, carteiras)
+        ben = _ler_sql(conn, sql, params)
+        loc.execute(f"DELETE FROM seg_cadastro WHERE cod_cli IN ({marcas})", carteiras)
+        loc.execute(f"DELETE FROM seg_garantia WHERE cod_cli IN ({marcas})", carteiras)
+        loc.execute("DELETE FROM seg_acordo")
+    else:
+        desde = {"_tail_params": [_fmt_ts(pd.Timestamp(wm) - pd.Timedelta(minutes=SEGMENTOS_SOBREPOSICAO_MIN))]}
+        sql, params = build_sql_and_params(SQL_SEG_CADASTROS_ALTERADOS, carteiras, extra=desde)
+        cad = _ler_sql(conn, sql, params)
+        sql, params = build_sql_and_params(SQL_SEG_ACORDOS_ALTERADOS, carteiras, extra=desde)
+        aco = _ler_sql(conn, sql, params)
+        sql, params = build_sql_and_params(SQL_SEG_GARANTIAS_ALTERADAS, carteiras, extra=desde)
+        ben = _ler_sql(conn, sql, params)
+        # O último acordo de cada nmcont alterado pode ter saído dos status do índice
+        _seg_executar_lotes(loc, "DELETE FROM seg_acordo WHERE nmcont = ?", _linhas_py(aco[["nmcont"]]))
+        _seg_executar_lotes(
+            loc, "DELETE FROM seg_garantia WHERE nmcont = ? AND cod_cli = ?", _linhas_py(cad[["nmcont", "cod_cli"]])
+        )
+        aco = aco[aco["staco"].isin(STATUS_ACORDO)]
+
+    _seg_executar_lotes(
+        loc,
+        "INSERT OR REPLACE INTO seg_cadastro (cod_cad, nmcont, cod_cli, ativo) VALUES (?, ?, ?, ?)",
+        _linhas_py(cad[["cod_cad", "nmcont", "cod_cli", "ativo"]]),
+    )
+    _seg_executar_lotes(loc, "INSERT OR REPLACE INTO seg_acordo (nmcont, staco) VALUES (?, ?)", _linhas_py(aco[["nmcont", "staco"]]))
+    _seg_executar_lotes(
+        loc, "INSERT OR IGNORE INTO seg_garantia (nmcont, cod_cli) VALUES (?, ?)", _linhas_py(ben[["nmcont", "cod_cli"]])
+    )
+    _gravar_watermark(loc, "chaves", _fmt_ts(agora))
+    if completo:
+        _gravar_watermark(loc, "chaves_completo", _fmt_ts(agora))
+
+
+def _seg_atualizar_contatos(conn, loc: sqlite3.Connection, tabela: str, marca: str, sql: str, janela_ini: str, agora: str) -> int:
+    """Último contato por cod_cad em `tabela` (incremental com sobreposição, só a janela) -> bitmap."""
+    wm = _ler_watermark(loc, marca)
+    if wm is not None:
+        wm = _fmt_ts(pd.Timestamp(wm) - pd.Timedelta(minutes=SEGMENTOS_SOBREPOSICAO_MIN))
+    wm = max(wm or janela_ini, janela_ini)
+    contatos = _ler_sql(conn, sql, [wm])
+    loc.executemany(
+        f"INSERT INTO {tabela} (cod_cad, data_at) VALUES (?, ?) "
+        "ON CONFLICT(cod_cad) DO UPDATE SET data_at = MAX(data_at, excluded.data_at)",
+        [(int(k), _fmt_ts(d)) for k, d in zip(contatos["cod_cad"], contatos["data_at"])],
+    )
+    loc.execute(f"DELETE FROM {tabela} WHERE data_at < ?", (janela_ini,))
+    _gravar_watermark(loc, marca, agora)
+    return _ids_para_bitmap([r[0] for r in loc.execute(f"SELECT cod_cad FROM {tabela}")])
+
+
+def atualizar_segmentos(carteiras: list[int] | None = None, completo: bool = False) -> dict[str, int]:
+    """
+    Atualiza o índice de segmentos e devolve {segmento: cardinalidade}.
+      - contatados_30d, contatados_30d_nunca e cpc: incrementais a partir da marca d'água em hist_tb.data_at
+      - ativos_<carteira>, acordo_<staco> e garantia: do espelho local das chaves, atualizado
+        pelas chaves alteradas desde a marca d'água (completo=True recarrega tudo)
+    """
+    carteiras = carteiras or [c for _, c in CARTEIRAS]
+    ref_col = HIST_CAD_REF_COL
+
+    conn = _abrir_conexao()
+    try:
+        with closing(_abrir_local(SEGMENTOS_DB_PATH)) as loc:
+            loc.executescript(_SEGMENTOS_SCHEMA)
+            agora = _fmt_ts(_ler_sql(conn, "SELECT NOW() AS agora").iloc[0, 0])
+            bitmaps: dict[str, int] = {}
+
+            # Cadastros: ativos por carteira + mapa nmcont -> cod_cad
+            _seg_atualizar_chaves(conn, loc, carteiras, pd.Timestamp(agora), completo)
+            marcas = ",".join("?" * len(carteiras))
+            cad = pd.read_sql_query(
+                f"SELECT cod_cad, nmcont, cod_cli, ativo FROM seg_cadastro WHERE cod_cli IN ({marcas})", loc, params=carteiras
+            )
+            for c in carteiras:
+                ativos = cad.loc[(cad["cod_cli"] == c) & (cad["ativo"] == 1), "cod_cad"]
+                bitmaps[f"ativos_{c}"] = _ids_para_bitmap(ativos)
+
+            # Contatados (janela deslizante): último contato por cod_cad, incremental com sobreposição.
+            # Sem Histórico conta NOW() - 30 dias; Nunca conta CURDATE() - 30 dias e só ocorrências
+            # com stcob_tb (os mesmos critérios de SQL_CONTATADOS_30D de cada base).
+            dias = pd.Timedelta(days=SEGMENTOS_JANELA_CONTATO_DIAS)
+            bitmaps["contatados_30d"] = _seg_atualizar_contatos(
+                conn, loc, "seg_ultimo_contato", "contatos", SQL_SEG_CONTATOS.format(hist_cad_ref_col=ref_col),
+                _fmt_ts(pd.Timestamp(agora) - dias), agora,
+            )
+            bitmaps["contatados_30d_nunca"] = _seg_atualizar_contatos(
+                conn, loc, "seg_ultimo_contato_nunca", "contatos_nunca",
+                SQL_SEG_CONTATOS_NUNCA.format(hist_cad_ref_col=ref_col),
+                _fmt_ts(pd.Timestamp(agora).normalize() - dias), agora,
+            )
+
+            # CPC alguma vez: só cresce, então basta OR com o que entrou desde a marca d'água
+            wm = _ler_watermark(loc, "cpc")
+            if wm is None:
+                wm = "1900-01-01 00:00:00"
+            else:
+                wm = _fmt_ts(pd.Timestamp(wm) - pd.Timedelta(minutes=SEGMENTOS_SOBREPOSICAO_MIN))
+            cpc = _ler_sql(conn, SQL_SEG_CPC.format(hist_cad_ref_col=ref_col), [wm])
+            atual = loc.execute("SELECT bits FROM seg_bitmap WHERE nome = 'cpc'").fetchone()
+            base = _bitmap_deserializar(atual[0]) if atual else 0
+            bitmaps["cpc"] = base | _ids_para_bitmap(cpc["cod_cad"])
+            _gravar_watermark(loc, "cpc", agora)
+
+            # Último acordo por nmcont (P/A/G/Q/E) -> cod_cad
+            acordos = pd.read_sql_query("SELECT nmcont, staco FROM seg_acordo", loc).merge(
+                cad[["nmcont", "cod_cad"]], on="nmcont"
+            )
+            for st in STATUS_ACORDO:
+                bitmaps[f"acordo_{st}"] = _ids_para_bitmap(acordos.loc[acordos["staco"] == st, "cod_cad"])
+
+            # Possui garantia (bens_tb)
+            bens = pd.read_sql_query("SELECT nmcont, cod_cli FROM seg_garantia", loc).merge(
+                cad[["nmcont", "cod_cli", "cod_cad"]], on=["nmcont", "cod_cli"]
+            )
+            bitmaps["garantia"] = _ids_para_bitmap(bens["cod_cad"])
+
+            ts = _fmt_ts(pd.Timestamp.now())
+            loc.executemany(
+                "INSERT INTO seg_bitmap (nome, bits, cardinalidade, atualizado_em) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(nome) DO UPDATE SET bits = excluded.bits, "
+                "cardinalidade = excluded.cardinalidade, atualizado_em = excluded.atualizado_em",
+                [(nome, _bitmap_serializar(b), b.bit_count(), ts) for nome, b in bitmaps.items()],
+            )
+            loc.commit()
+    finally:
+        conn.close()
+
+    return {nome: b.bit_count() for nome, b in bitmaps.items()}
+
+
+def avaliar_segmentos(expr: str, segmentos: dict[str, int]) -> int:
+    """
+    Avalia uma expressão de conjuntos sobre os segmentos:
+      &  interseção   |  união   -  diferença (ANDNOT)
+    Ex.: "(ativos_517 | ativos_518) - contatados_30d"
+    """
+    def ev(node):
+        if isinstance(node, ast.Expression):
+            return ev(node.body)
+        if isinstance(node, ast.Name):
+            if node.id not in segmentos:
+                raise ValueError(f"Segmento desconhecido: {node.id}")
+            return segmentos[node.id]
+        if isinstance(node, ast.BinOp):
+            a, b = ev(node.left), ev(node.right)
+            if isinstance(node.op, ast.BitAnd):
+                return a & b
+            if isinstance(node.op, ast.BitOr):
+                return a | b
+            if isinstance(node.op, ast.Sub):
+                return a & ~b
+        raise ValueError("Expressão de segmentos inválida. Use nomes de segmento, &, | e -.")
+
+    try:
+        arvore = ast.parse(expr, mode="eval")
+    except SyntaxError:
+        raise ValueError(f"Expressão de segmentos inválida: {expr!r}")
+    return ev(arvore)
+
+
+_segmentos_em_fila = threading.Event()
+
+
+def _atualizar_segmentos_em_segundo_plano():
+    """Atualização incremental do índice numa thread (uma por vez por processo)."""
+    if DRIVER_MODO == "replay" or _segmentos_em_fila.is_set():
+        return
+    _segmentos_em_fila.set()
+
+    def rodar():
+        try:
+            atualizar_segmentos()
+        except Exception as e:
+            print(f"[segmentos] atualização em segundo plano falhou: {e}", file=sys.stderr)
+        finally:
+            _segmentos_em_fila.clear()
+
+    threading.Thread(target=rodar, daemon=True, name="segmentos").start()
+
+
+def _segmentos_para_uso(expr: str) -> dict[str, int] | None:
+    """
+    Bitmaps gravados para responder `expr`, sem atualizar na vaga da base. Velhos: usados assim
+    mesmo, com aviso, e a atualização vai para segundo plano. None (a base vai ao banco sem o
+    índice) se o índice não existe, não tem algum segmento de `expr` ou passou de
+    SEGMENTOS_MAX_IDADE_USO_MIN; a criação fica com --atualizar-segmentos.
+    """
+    idade = idade_segmentos_min()
+    if idade is None:
+        _avisar_andamento("[segmentos] índice ainda não foi criado; lendo do banco (rode --atualizar-segmentos)")
+        return None
+    if idade > SEGMENTOS_MAX_IDADE_MIN:
+        _atualizar_segmentos_em_segundo_plano()
+        if idade > SEGMENTOS_MAX_IDADE_USO_MIN:
+            _avisar_andamento(f"[segmentos] índice de {idade:.0f} min atrás; lendo do banco enquanto atualiza")
+            return None
+        _avisar_andamento(f"[segmentos] índice de {idade:.0f} min atrás; lendo assim mesmo e atualizando em segundo plano")
+    segmentos = carregar_segmentos()
+    faltam = sorted(set(re.findall(r"[A-Za-z_]\w*", expr)) - set(segmentos))
+    if faltam:
+        _avisar_andamento(f"[segmentos] índice sem {', '.join(faltam)}; lendo do banco (rode --atualizar-segmentos)")
+        return None
+    return segmentos
+
+
+def _buscar_detalhes_cad(conn, cod_cads: np.ndarray) -> pd.DataFrame:
+    partes = []
+    for i in range(0, len(cod_cads), SEGMENTOS_DETALHE_LOTE):
+        lote = [int(x) for x in cod_cads[i:i + SEGMENTOS_DETALHE_LOTE]]
+        sql = SQL_SEG_DETALHES.format(ids=", ".join(["%s"] * len(lote)))
+        partes.append(_ler_sql(conn, sql, lote))
+    if not partes:
+        return _ler_sql(conn, SQL_SEG_DETALHES.format(ids="NULL"))
+    return pd.concat(partes, ignore_index=True)
+
+
+def publico_por_segmentos(expr: str, segmentos: dict[str, int] | None = None) -> pd.DataFrame:
+    """Público de `expr` pelo índice gravado (sem segmentos: lê do disco; não atualiza)."""
+    if segmentos is None:
+        idade = idade_segmentos_min()
+        if idade is None:
+            raise ValueError("índice de segmentos ainda não foi criado; rode --atualizar-segmentos.")
+        if idade > SEGMENTOS_MAX_IDADE_MIN:
+            print(f"[segmentos] índice de {idade:.0f} min atrás (rode --atualizar-segmentos)", file=sys.stderr)
+        segmentos = carregar_segmentos()
+    bits = avaliar_segmentos(expr, segmentos)
+    conn = _abrir_conexao()
+    try:
+        return _buscar_detalhes_cad(conn, _bitmap_para_ids(bits))
+    finally:
+        conn.close()
+
+
+def _expr_segmentos_para(sql_template: str, carteiras: list[int]) -> str | None:
+    """Bases que o índice consegue responder sozinho (mesmas colunas do SQL original)."""
+    if sql_template == SQL_SEM_HIST_30D:
+        return "(" + " | ".join(f"ativos_{c}" for c in carteiras) + ") - contatados_30d"
+    return None
+
+
+def _expr_chaves_segmentos(sql_template: str, carteiras: list[int]) -> str | None:
+    """Bases compostas cujas chaves (cod_cad) o índice escolhe; o SQL só monta as colunas."""
+    ativos = "(" + " | ".join(f"ativos_{c}" for c in carteiras) + ")"
+    if sql_template == SQL_NUNCA:
+        # sem contato em 30 dias e fora dos acordos pagos/em andamento (acordos_pagos de `valores`)
+        return f"{ativos} - contatados_30d_nunca - (acordo_P | acordo_G | acordo_A)"
+    if sql_template == SQL_QUEBRAS_REJEITADAS:
+        return f"{ativos} & (acordo_Q | acordo_E)"
+    return None
+
+
+def _usa_indice_segmentos(sql_template: str) -> bool:
+    carteira = [CARTEIRAS[0][1]]
+    return bool(_expr_segmentos_para(sql_template, carteira) or _expr_chaves_segmentos(sql_template, carteira))
+
+
+def _carregar_tmp_segmento(conn, ids: np.ndarray):
+    cur = conn.cursor()
+    try:
+        cur.execute("DROP TEMPORARY TABLE IF EXISTS tmp_segmento")
+        cur.execute("CREATE TEMPORARY TABLE tmp_segmento (cod_cad BIGINT NOT NULL PRIMARY KEY)")
+        for i in range(0, len(ids), SEGMENTOS_LOTE_INSERT):
+            lote = [(int(x),) for x in ids[i:i + SEGMENTOS_LOTE_INSERT]]
+            cur.executemany("INSERT IGNORE INTO tmp_segmento (cod_cad) VALUES (%s)", lote)
+    finally:
+        cur.close()
+
+
+def _template_com_chaves_segmento(conn, sql_template: str, expr: str, segmentos: dict[str, int]) -> str:
+    """
+    Carrega as chaves do índice em tmp_segmento e restringe os escopos de cadastros_tb a elas.
+    O NOT IN de hist_tb (contatados 30 dias) sai: o índice já descontou contatados_30d_nunca.
+    """
+    _carregar_tmp_segmento(conn, _bitmap_para_ids(avaliar_segmentos(expr, segmentos)))
+    tpl = _remover_not_in_hist(sql_template, "") if _modo_antijoin(sql_template) else sql_template
+    masc = _mascarar_sql(tpl)
+    insercoes = []
+    for alias, ini in _escopos_dirigentes(tpl, "cadastros_tb"):
+        insercoes.extend(_inserir_no_where(masc, ini, f"{alias}.cod_cad IN (SELECT ts.cod_cad FROM tmp_segmento ts)"))
+    return _aplicar_insercoes(tpl, insercoes)
+
+
+# =========================
+# Rollup diário de CPC (local, incremental)
+# =========================
+# (cod_cad, dia, último CPC do dia) atualizado a partir da marca d'água em hist_tb.data_at.
+# "CPC por Periodo" para qualquer intervalo vira um MAX() no SQLite local; o banco só
+# é consultado para os atributos do cliente.
+ROLLUP_DB_PATH = os.path.join(LOCAL_DATA_DIR, "rollups.sqlite")
+ROLLUP_MAX_IDADE_MIN = 15
+ROLLUP_SOBREPOSICAO_MIN = 60  # relê a última hora para pegar gravações atrasadas
+ROLLUP_JANELA_DIAS = 31  # lê hist_tb em janelas (a carga inicial não varre tudo de uma vez)
+
+_ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cpc_diario (
+    cod_cad INTEGER NOT NULL,
+    dia TEXT NOT NULL,
+    ultimo_cpc TEXT NOT NULL,
+    PRIMARY KEY (cod_cad, dia)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_cpc_diario_dia ON cpc_diario (dia);
+"""
+
+
+def _rollup_gravar_cpc(loc: sqlite3.Connection, df: pd.DataFrame):
+    loc.executemany(
+        "INSERT INTO cpc_diario (cod_cad, dia, ultimo_cpc) VALUES (?, ?, ?) "
+        "ON CONFLICT(cod_cad, dia) DO UPDATE SET ultimo_cpc = MAX(ultimo_cpc, excluded.ultimo_cpc)",
+        [
+            (int(k), pd.Timestamp(d).strftime("%Y-%m-%d"), _fmt_ts(u))
+            for k, d, u in zip(df["cod_cad"], df["dia"], df["ultimo_cpc"])
+        ],
+    )
+
+
+def atualizar_rollup_cpc() -> int:
+    """Atualiza o rollup desde a marca d'água e devolve quantas linhas (cod_cad, dia) vieram."""
+    sql_incr = SQL_CPC_ROLLUP.format(hist_cad_ref_col=HIST_CAD_REF_COL)
+    total = 0
+
+    conn = _abrir_conexao()
+    try:
+        with closing(_abrir_local(ROLLUP_DB_PATH)) as loc:
+            loc.executescript(_ROLLUP_SCHEMA)
+            agora = pd.Timestamp(_ler_sql(conn, "SELECT NOW() AS agora").iloc[0, 0])
+
+            wm = _ler_watermark(loc, "cpc_diario")
+            if wm is None:
+                inicio = _ler_sql(conn, "SELECT MIN(data_at) AS ini FROM hist_tb").iloc[0, 0]
+                ini = pd.Timestamp(inicio).normalize() if inicio is not None else agora.normalize()
+            else:
+                ini = pd.Timestamp(wm) - pd.Timedelta(minutes=ROLLUP_SOBREPOSICAO_MIN)
+
+            while ini <= agora:
+                fim = min(ini + pd.Timedelta(days=ROLLUP_JANELA_DIAS), agora + pd.Timedelta(seconds=1))
+                df = _ler_sql(conn, sql_incr, [_fmt_ts(ini), _fmt_ts(fim)])
+                _rollup_gravar_cpc(loc, df)
+                total += len(df)
+                ini = fim
+
+            _gravar_watermark(loc, "cpc_diario", _fmt_ts(agora))
+            loc.commit()
+    finally:
+        conn.close()
+
+    return total
+
+
+def _rollup_cpc_idade_min() -> float | None:
+    with closing(_abrir_local(ROLLUP_DB_PATH)) as loc:
+        wm = _ler_watermark(loc, "cpc_diario")
+    if wm is None:
+        return None
+    return (pd.Timestamp.now() - pd.Timestamp(wm)).total_seconds() / 60.0
+
+
+def cpc_periodo_rollup(carteiras: list[int], dt_ini: str | None, dt_fim: str | None) -> pd.DataFrame:
+    """Mesmo resultado de SQL_CPC_PERIODO, com o MAX(data_at) vindo do rollup local."""
+    idade = _rollup_cpc_idade_min()
+    if idade is None or idade > ROLLUP_MAX_IDADE_MIN:
+        atualizar_rollup_cpc()
+
+    with closing(_abrir_local(ROLLUP_DB_PATH)) as loc:
+        loc.executescript(_ROLLUP_SCHEMA)
+        cpc = pd.read_sql_query(
+            "SELECT cod_cad, MAX(ultimo_cpc) AS dt_ultimo_cpc FROM cpc_diario "
+            "WHERE dia >= ? AND dia <= ? GROUP BY cod_cad",
+            loc,
+            params=(dt_ini or "0000-01-01", dt_fim or "9999-12-31"),
+        )
+    cpc["dt_ultimo_cpc"] = pd.to_datetime(cpc["dt_ultimo_cpc"])
+
+    sql, params = build_sql_and_params(SQL_CPC_ATRIBUTOS, carteiras)
+    conn = _abrir_conexao()
+    try:
+        cad = _ler_sql(conn, sql, params)
+    finally:
+        conn.close()
+
+    return cad.merge(cpc, on="cod_cad", how="inner")
+
+
+# =========================
+# Réplica analítica local (SQLite)
+# =========================
+# Cópia, por carteira, das colunas que os templates usam. Qualquer base de QUERIES roda
+# na réplica com o template traduzido do dialeto MariaDB para o SQLite, sem tocar na
+# produção. hist_tb é incremental pela marca d'água em data_at; as demais tabelas são
+# recarregadas por carteira (não têm coluna de alteração confiável).
+REPLICA_DB_PATH = os.path.join(LOCAL_DATA_DIR, "replica.sqlite")
+REPLICA_SOBREPOSICAO_MIN = 60
+REPLICA_JANELA_DIAS = 31
+REPLICA_LOTE = 50_000
+
+REPLICA_TABELAS_GLOBAIS = ("stcob_tb",)
+REPLICA_TABELAS_CARTEIRA = ("cadastros_tb", "fones_tb", "acordos_tb", "rec_comp_tb", "receber_tb", "bens_tb")
+
+_REPLICA_INDICES = [
+    ("cadastros_tb", ("cod_cli", "stcli")),
+    ("cadastros_tb", ("cod_cad",)),
+    ("cadastros_tb", ("nmcont",)),
+    ("fones_tb", ("cod_cad",)),
+    ("hist_tb", ("{hist_cad_ref_col}", "data_at")),
+    ("hist_tb", ("data_at",)),
+    ("stcob_tb", ("st",)),
+    ("acordos_tb", ("cod_cli", "nmcont")),
+    ("rec_comp_tb", ("nmcont", "cod_cli")),
+    ("receber_tb", ("nmcont", "cod_cli")),
+    ("bens_tb", ("nmcont", "cod_cli")),
+]
+
+_TIPOS_NUMERICOS_MARIADB = set(mysql.connector.FieldType.get_number_types())
+_TIPOS_DATAHORA_MARIADB = set(mysql.connector.FieldType.get_timestamp_types())
+_TIPOS_DECIMAIS_MARIADB = {mysql.connector.FieldType.DECIMAL, mysql.connector.FieldType.NEWDECIMAL}
+
+
+def _conversor_coluna(type_code):
+    """Converte o valor do conector para um tipo que o SQLite grava (e compara) igual ao MariaDB."""
+    if type_code in _TIPOS_DECIMAIS_MARIADB:
+        return lambda v: None if v is None else float(v)
+    if type_code in _TIPOS_DATAHORA_MARIADB:
+        return lambda v: None if v is None else v.strftime("%Y-%m-%d %H:%M:%S")
+    if type_code == mysql.connector.FieldType.DATE:
+        return lambda v: None if v is None else v.isoformat()
+    return None
+
+
+def _replica_copiar(conn, loc: sqlite3.Connection, tabela: str, sql: str, params: list, carteira: int | None) -> int:
+    """Copia o resultado de `sql` para `tabela` na réplica (cria a tabela na primeira vez)."""
+    cur = conn.cursor()
+    try:
+        cur.execute(sql, params)
+        cols = [d[0] for d in cur.description]
+        # Afinidade NUMERIC nas colunas numéricas: cod_usu <> '999' compara como no MariaDB
+        tipos = ["NUMERIC" if d[1] in _TIPOS_NUMERICOS_MARIADB else "TEXT" for d in cur.description]
+        conversores = [_conversor_coluna(d[1]) for d in cur.description]
+
+        defs = ", ".join(f'"{c}" {t}' for c, t in zip(cols, tipos))
+        nomes = ", ".join(f'"{c}"' for c in cols)
+        marcas = ", ".join(["?"] * (len(cols) + 1))
+        loc.execute(f'CREATE TABLE IF NOT EXISTS "{tabela}" ({defs}, _carteira INTEGER)')
+        insert = f'INSERT INTO "{tabela}" ({nomes}, _carteira) VALUES ({marcas})'
+
+        total = 0
+        while True:
+            rows = cur.fetchmany(REPLICA_LOTE)
+            if not rows:
+                break
+            if any(conversores):
+                rows = [
+                    tuple(f(v) if f else v for f, v in zip(conversores, row))
+                    for row in rows
+                ]
+            loc.executemany(insert, [(*row, carteira) for row in rows])
+            total += len(rows)
+    finally:
+        cur.close()
+    return total
+
+
+def _replica_apagar(loc: sqlite3.Connection, tabela: str, where: str = "", params: tuple = ()):
+    existe = loc.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (tabela,)).fetchone()
+    if existe:
+        loc.execute(f'DELETE FROM "{tabela}" {where}', params)
+
+
+def _replica_criar_indices(loc: sqlite3.Connection):
+    for tabela, cols in _REPLICA_INDICES + [(t, ("_carteira",)) for t in REPLICA_TABELAS_CARTEIRA + ("hist_tb",)]:
+        cols = [c.format(hist_cad_ref_col=HIST_CAD_REF_COL) for c in cols]
+        nome = f"ix_{tabela}_{'_'.join(cols)}"
+        existe = loc.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (tabela,)).fetchone()
+        if existe:
+            loc.execute(f'CREATE INDEX IF NOT EXISTS "{nome}" ON "{tabela}" ({", ".join(cols)})')
+
+
+def sincronizar_replica(carteiras: list[int] | None = None) -> dict[str, int]:
+    """Atualiza a réplica local das carteiras e devolve {tabela: linhas copiadas}."""
+    carteiras = carteiras or [c for _, c in CARTEIRAS]
+    sql_hist = SQL_REPLICA["hist_tb"].format(hist_cad_ref_col=HIST_CAD_REF_COL)
+    copiadas: dict[str, int] = {}
+
+    conn = _abrir_conexao()
+    try:
+        with closing(_abrir_local(REPLICA_DB_PATH)) as loc:
+            agora = pd.Timestamp(_ler_sql(conn, "SELECT NOW() AS agora").iloc[0, 0])
+
+            for tabela in REPLICA_TABELAS_GLOBAIS:
+                _replica_apagar(loc, tabela)
+                copiadas[tabela] = _replica_copiar(conn, loc, tabela, SQL_REPLICA[tabela], [], None)
+            loc.commit()
+
+            for c in carteiras:
+                for tabela in REPLICA_TABELAS_CARTEIRA:
+                    _replica_apagar(loc, tabela, "WHERE _carteira = ?", (c,))
+                    n = _replica_copiar(conn, loc, tabela, SQL_REPLICA[tabela], [c], c)
+                    copiadas[tabela] = copiadas.get(tabela, 0) + n
+
+                # hist_tb: apaga a partir da marca d'água (com sobreposição) e relê só esse trecho
+                wm = _ler_watermark(loc, f"replica_hist_{c}")
+                if wm is None:
+                    inicio = _ler_sql(conn, "SELECT MIN(data_at) AS ini FROM hist_tb").iloc[0, 0]
+                    ini = pd.Timestamp(inicio).normalize() if inicio is not None else agora.normalize()
+                else:
+                    ini = pd.Timestamp(wm) - pd.Timedelta(minutes=REPLICA_SOBREPOSICAO_MIN)
+                _replica_apagar(loc, "hist_tb", "WHERE _carteira = ? AND data_at >= ?", (c, _fmt_ts(ini)))
+
+                while ini <= agora:
+                    fim = min(ini + pd.Timedelta(days=REPLICA_JANELA_DIAS), agora + pd.Timedelta(seconds=1))
+                    n = _replica_copiar(conn, loc, "hist_tb", sql_hist, [c, _fmt_ts(ini), _fmt_ts(fim)], c)
+                    copiadas["hist_tb"] = copiadas.get("hist_tb", 0) + n
+                    ini = fim
+
+                _gravar_watermark(loc, f"replica_hist_{c}", _fmt_ts(agora))
+                _gravar_watermark(loc, f"replica_{c}", _fmt_ts(agora))
+                loc.commit()
+
+            _replica_criar_indices(loc)
+            loc.commit()
+    finally:
+        conn.close()
+
+    return copiadas
+
+
+def idade_replica_min(carteiras: list[int]) -> float | None:
+    """Idade (min) da carteira sincronizada há mais tempo; None se alguma nunca foi copiada."""
+    if not os.path.exists(REPLICA_DB_PATH):
+        return None
+    with closing(_abrir_local(REPLICA_DB_PATH)) as loc:
+        marcas = [_ler_watermark(loc, f"replica_{c}") for c in carteiras]
+    if not marcas or any(m is None for m in marcas):
+        return None
+    return (pd.Timestamp.now() - pd.Timestamp(min(marcas))).total_seconds() / 60.0
+
+
+# ---- Tradução MariaDB -> SQLite ----
+_RE_LITERAL_SQL = re.compile(r"'(?:[^'\\]|\\.|'')*'", re.DOTALL)
+_RE_FUNCOES_MARIADB = re.compile(r"\b(CONCAT|FIELD|DATE_FORMAT|GROUP_CONCAT)\s*\(", re.IGNORECASE)
+_RE_AGORA_INTERVALO = re.compile(
+    r"\b(NOW|CURDATE)\s*\(\s*\)(?:\s*([-+])\s*INTERVAL\s+(\d+)\s+(DAY|MONTH|YEAR|HOUR|MINUTE)\b)?",
+    re.IGNORECASE,
+)
+_RE_GROUP_CONCAT_ARGS = re.compile(
+    r"^\s*(DISTINCT\s+)?(.+?)(?:\s+ORDER\s+BY\s+.+?)?(?:\s+SEPARATOR\s+('(?:[^']|'')*'))?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_DATE_FORMAT_PARA_STRFTIME = {"%i": "%M", "%s": "%S", "%e": "%d", "%c": "%m"}
+
+
+def _literal_para_sqlite(lit: str) -> str:
+    """'...' do MariaDB (escapes com \\ e %% do conector) -> literal equivalente no SQLite."""
+    texto = lit[1:-1].replace("''", "'")
+    texto = re.sub(r"\\(.)", r"\1", texto, flags=re.DOTALL).replace("%%", "%")
+    return "'" + texto.replace("'", "''") + "'"
+
+
+def _dividir_args(s: str) -> list[str]:
+    """Separa os argumentos de uma chamada nas vírgulas de nível 0 (fora de parênteses e literais)."""
+    args, depth, ini, i = [], 0, 0, 0
+    while i < len(s):
+        ch = s[i]
+        if ch == "'":
+            m = _RE_LITERAL_SQL.match(s, i)
+            i = m.end() if m else i + 1
+            continue
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            args.append(s[ini:i].strip())
+            ini = i + 1
+        i += 1
+    args.append(s[ini:].strip())
+    return args
+
+
+def _reescrever_funcao(nome: str, interno: str) -> str:
+    if nome == "CONCAT":
+        return "(" + " || ".join(_dividir_args(interno)) + ")"
+    if nome == "FIELD":
+        alvo, *valores = _dividir_args(interno)
+        whens = " ".join(f"WHEN {v} THEN {i}" for i, v in enumerate(valores, start=1))
+        return f"(CASE {alvo} {whens} ELSE 0 END)"
+    if nome == "DATE_FORMAT":
+        expr, fmt = _dividir_args(interno)
+        for de, para in _DATE_FORMAT_PARA_STRFTIME.items():
+            fmt = fmt.replace(de, para)
+        return f"strftime({fmt}, {expr})"
+    # GROUP_CONCAT([DISTINCT] expr [ORDER BY ...] [SEPARATOR 'x']) -> agregados registrados em _abrir_replica
+    m = _RE_GROUP_CONCAT_ARGS.match(interno)
+    distinto, expr, sep = m.group(1), m.group(2), m.group(3) or "','"
+    return f"{'gc_distinto' if distinto else 'gc_ordenado'}({expr}, {sep})"
+
+
+def _traduzir_funcoes(sql: str) -> str:
+    literais = [m.span() for m in _RE_LITERAL_SQL.finditer(sql)]
+    partes, pos = [], 0
+    for m in _RE_FUNCOES_MARIADB.finditer(sql):
+        if m.start() < pos or any(a <= m.start() < b for a, b in literais):
+            continue
+        abre = m.end() - 1
+        fecha = _fecha_parenteses(sql, abre)
+        partes.append(sql[pos:m.start()])
+        partes.append(_reescrever_funcao(m.group(1).upper(), _traduzir_funcoes(sql[abre + 1:fecha])))
+        pos = fecha + 1
+    partes.append(sql[pos:])
+    return "".join(partes)
+
+
+def _agora_sqlite(m: re.Match) -> str:
+    func = "datetime" if m.group(1).upper() == "NOW" else "date"
+    args = ["'now'", "'localtime'"]
+    if m.group(2):
+        args.append(f"'{m.group(2)}{m.group(3)} {m.group(4).lower()}s'")
+    return f"{func}({', '.join(args)})"
+
+
+def traduzir_sql_para_sqlite(sql: str) -> str:
+    """
+    Traduz um SQL já montado (build_sql_and_params) do MariaDB para o SQLite da réplica:
+      - CONCAT -> ||, FIELD -> CASE, DATE_FORMAT -> strftime
+      - GROUP_CONCAT(DISTINCT x ORDER BY x SEPARATOR s) -> gc_distinto(x, s) / gc_ordenado(x, s)
+      - NOW()/CURDATE() [- INTERVAL n DAY|MONTH] -> datetime()/date('now', 'localtime', '-n days')
+      - REGEXP -> função regexp() registrada; literais sem escapes de \\ e %%; %s -> ?
+    """
+    partes, pos = [], 0
+    for m in _RE_LITERAL_SQL.finditer(sql):
+        codigo = sql[pos:m.start()].replace("%s", "?")
+        partes.append(_RE_AGORA_INTERVALO.sub(_agora_sqlite, codigo))
+        partes.append(_literal_para_sqlite(m.group(0)))
+        pos = m.end()
+    partes.append(_RE_AGORA_INTERVALO.sub(_agora_sqlite, sql[pos:].replace("%s", "?")))
+    return _traduzir_funcoes("".join(partes))
+
+
+def _sqlite_regexp(padrao, valor):
+    if padrao is None or valor is None:
+        return None
+    # REGEXP do MariaDB segue a collation (ci) da coluna
+    return re.search(padrao, str(valor), re.IGNORECASE) is not None
+
+
+class _GroupConcatOrdenado:
+    """GROUP_CONCAT(x ORDER BY x SEPARATOR s) no SQLite (ordena pelo próprio valor)."""
+
+    distinto = False
+
+    def __init__(self):
+        self.valores = []
+        self.sep = ","
+
+    def step(self, valor, sep):
+        if valor is not None:
+            self.valores.append(valor)
+            self.sep = sep
+
+    def finalize(self):
+        if not self.valores:
+            return None
+        valores = set(self.valores) if self.distinto else self.valores
+        return self.sep.join(str(v) for v in sorted(valores, key=lambda v: (isinstance(v, str), v)))
+
+
+class _GroupConcatDistinto(_GroupConcatOrdenado):
+    distinto = True
+
+
+def _sqlite_md5(valor):
+    return None if valor is None else hashlib.md5(str(valor).encode("utf-8")).hexdigest()
+
+
+def _abrir_replica() -> sqlite3.Connection:
+    loc = _abrir_local(REPLICA_DB_PATH)
+    loc.create_function("regexp", 2, _sqlite_regexp, deterministic=True)
+    loc.create_aggregate("gc_ordenado", 2, _GroupConcatOrdenado)
+    loc.create_aggregate("gc_distinto", 2, _GroupConcatDistinto)
+    loc.create_function("md5", 1, _sqlite_md5, deterministic=True)
+    return loc
+
+
+def _run_replica(sql_template: str, carteiras: list[int], extra: dict) -> pd.DataFrame:
+    with closing(_abrir_replica()) as loc:
+        faltando = [c for c in carteiras if _ler_watermark(loc, f"replica_{c}") is None]
+        if faltando:
+            raise ValueError(
+                f"Carteira(s) {', '.join(map(str, faltando))} ainda sem réplica local.\n"
+                f"Rode: python Gerador_base.py --sincronizar-replica --carteiras {' '.join(map(str, faltando))}"
+            )
+        sql, params = build_sql_and_params(_projetar(sql_template, extra), carteiras, extra=extra)
+        return pd.read_sql_query(traduzir_sql_para_sqlite(sql), loc, params=params)
 
 
 # =========================
-# Runner SQL (IN multi-carteiras)
+# Servidor local de jobs (pedidos iguais viram uma execução só)
 # =========================
-def build_sql_and_params(sql_template: str, carteiras: list[int], extra: dict | None = None) -> tuple[str, list]:
-    """
-    (Opção 2) Montagem determinística dos parâmetros:
-      - Para cada ocorrência de {cod_cli} no template, adiciona a lista completa de carteiras
-      - Depois adiciona os parâmetros de cauda (_tail_params)
-    """
-    if not carteiras:
-        raise ValueError("Nenhuma carteira selecionada.")
+# python Gerador_base.py --servidor 0.0.0.0:8765 numa máquina da mesa; as estações apontam
+# para ele (GERADOR_SERVIDOR=http://maquina:8765 ou --usar-servidor) e a tela vira só cliente:
+# manda o nome da base + carteiras + extra, recebe as linhas e grava o Excel localmente.
+# No servidor, pedidos iguais em andamento (mesma chave do cache de resultados) esperam a
+# mesma execução, e repetições saem do cache de resultados (_cache sempre ligado).
+# A resposta é um fluxo de linhas JSON: aceito, aguardando (pulso), colunas, linhas..., fim | erro.
+# As bases têm dados pessoais: servidor e estações compartilham um segredo (GERADOR_SERVIDOR_TOKEN),
+# mandado em SERVIDOR_CABECALHO_TOKEN; sem ele o servidor não sobe e pedidos sem o token levam 401.
+SERVIDOR_URL = os.environ.get("GERADOR_SERVIDOR", "")  # "" = executa localmente
+SERVIDOR_TOKEN = os.environ.get("GERADOR_SERVIDOR_TOKEN", "")
+SERVIDOR_CABECALHO_TOKEN = "X-Gerador-Token"
+SERVIDOR_PORTA_PADRAO = 8765
+SERVIDOR_PULSO_S = 15
+SERVIDOR_TIMEOUT_S = 120  # sem nenhuma linha do servidor nesse tempo, o cliente desiste
+SERVIDOR_LOTE_LINHAS = 5_000
+
+# Trechos de SQL que podem vir em extra (os que a tela monta); o resto é recusado
+_SERVIDOR_TRECHOS_ACEITOS = {
+    "dt_ini_filter": {"", "AND his.data_at >= %s"},
+    "dt_fim_filter": {"", "AND his.data_at <= %s"},
+    "having_filter": {"", "HAVING SUM(rec.vlrparc) >= %s"},
+    "infoad_filter": {""},
+    "vlrparc_having": {""},
+    "hist_cad_ref_col": {HIST_CAD_REF_COL},
+}
 
-    extra = extra or {}
 
-    # Quantas vezes o template usa {cod_cli}
-    cod_cli_occurrences = sql_template.count("{cod_cli}")
-    if cod_cli_occurrences <= 0:
-        raise ValueError("SQL template não contém {cod_cli}.")
+class _Voo:
+    """Uma execução no servidor e os pedidos que esperam por ela."""
 
-    in_placeholders = ", ".join(["%s"] * len(carteiras))
+    def __init__(self, consulta: str, carteiras: list[int], extra: dict):
+        self.consulta, self.carteiras, self.extra = consulta, carteiras, extra
+        self.pronto = threading.Event()
+        self.df = None
+        self.erro = None
+        self.clientes = 1
+        self.iniciado = time.monotonic()
+        self.fila = ""
 
-    sql = sql_template.format(
-        cod_cli=in_placeholders,
-        tel_limit=TEL_LIMIT_FIXO,
-        dt_ini_filter=extra.get("dt_ini_filter", ""),
-        dt_fim_filter=extra.get("dt_fim_filter", ""),
-        infoad_filter=extra.get("infoad_filter", ""),
-        vlrparc_having=extra.get("vlrparc_having", ""),
-        having_filter=extra.get("having_filter", ""),
-        hist_cad_ref_col=extra.get("hist_cad_ref_col", HIST_CAD_REF_COL),  # (Opção 1)
-    )
+    def executar(self, chave: str):
+        try:
+            if self.extra.get("_planejador"):
+                aplicar_plano(self.extra, planejar(QUERIES[self.consulta][0], self.carteiras, self.extra))
+            with _avisando_admissao(lambda texto: setattr(self, "fila", texto)):
+                self.df = run_query(QUERIES[self.consulta][0], self.carteiras, extra=self.extra)
+        except Exception as e:
+            self.erro = e
+        finally:
+            with _voos_lock:
+                _voos.pop(chave, None)
+            self.pronto.set()
 
-    tail_params = extra.get("_tail_params", None)
-    if tail_params is None:
-        tail_params = extra.get("_date_params", []) or []
-    else:
-        tail_params = tail_params or []
 
-    params: list = []
-    for _ in range(cod_cli_occurrences):
-        params.extend(carteiras)
-    params.extend(tail_params)
+_voos: dict[str, _Voo] = {}
+_voos_lock = threading.Lock()
 
-    return sql, params
 
+def _validar_pedido(pedido: dict) -> tuple[str, list[int], dict]:
+    consulta = pedido.get("consulta")
+    if consulta not in QUERIES:
+        raise ValueError(f"Base desconhecida: {consulta!r}")
+    carteiras = sorted({int(c) for c in pedido.get("carteiras") or []})
+    if not carteiras:
+        raise ValueError("Nenhuma carteira selecionada.")
+    extra = dict(pedido.get("extra") or {})
+    for chave, aceitos in _SERVIDOR_TRECHOS_ACEITOS.items():
+        if chave in extra and extra[chave] not in aceitos:
+            raise ValueError(f"Trecho de SQL não aceito em extra[{chave!r}].")
+    for campo in extra.get("_filtros") or {}:
+        if campo not in FILTROS_CAMPOS:
+            raise ValueError(f"Filtro desconhecido: {campo!r}")
+    extra.update(_nome_consulta=consulta, _cache=True)
+    return consulta, carteiras, extra
+
+
+def _entrar_no_voo(consulta: str, carteiras: list[int], extra: dict) -> tuple[_Voo, bool]:
+    """Voo em andamento com a mesma chave (coalescido=True) ou um novo, já disparado."""
+    chave = _chave_cache(QUERIES[consulta][0], carteiras, extra)
+    with _voos_lock:
+        voo = _voos.get(chave)
+        if voo is not None:
+            voo.clientes += 1
+            return voo, True
+        voo = _voos[chave] = _Voo(consulta, carteiras, extra)
+    threading.Thread(target=voo.executar, args=(chave,), daemon=True).start()
+    return voo, False
+
+
+def _codificar_para_servidor(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    return _codificar_valor(v)
+
+
+class _HandlerServidor(BaseHTTPRequestHandler):
+    def _linha(self, obj: dict):
+        self.wfile.write(json.dumps(obj, default=_codificar_para_servidor).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+    def _autorizado(self) -> bool:
+        token = self.headers.get(SERVIDOR_CABECALHO_TOKEN) or ""
+        if SERVIDOR_TOKEN and hmac.compare_digest(token.encode("utf-8"), SERVIDOR_TOKEN.encode("utf-8")):
+            return True
+        self.send_error(401, "Token ausente ou inválido")
+        return False
 
-def run_query(sql_template: str, carteiras: list[int], extra: dict | None = None) -> pd.DataFrame:
-    creds = parse_credentials_from_file(CRED_FILE_PATH)
-    sql, params = build_sql_and_params(sql_template, carteiras, extra=extra)
+    def do_GET(self):
+        if not self._autorizado():
+            return
+        if self.path != "/status":
+            self.send_error(404)
+            return
+        with _voos_lock:
+            voos = [
+                {"consulta": v.consulta, "carteiras": v.carteiras, "clientes": v.clientes,
+                 "segundos": round(time.monotonic() - v.iniciado, 1), "fila": v.fila}
+                for v in _voos.values()
+            ]
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self._linha({"em_andamento": voos})
+
+    def do_POST(self):
+        if not self._autorizado():
+            return
+        if self.path != "/executar":
+            self.send_error(404)
+            return
+        try:
+            pedido = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+            consulta, carteiras, extra = _validar_pedido(pedido)
+        except (ValueError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
 
-    conn = mysql.connector.connect(**creds)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        voo, coalescido = _entrar_no_voo(consulta, carteiras, extra)
+        self._linha({"evento": "aceito", "coalescido": coalescido})
+        while not voo.pronto.wait(SERVIDOR_PULSO_S):
+            self._linha({"evento": "aguardando", "segundos": round(time.monotonic() - voo.iniciado),
+                         "clientes": voo.clientes, "fila": voo.fila})
+
+        if voo.erro is not None:
+            self._linha({"evento": "erro", "tipo": type(voo.erro).__name__, "mensagem": _texto_erro(voo.erro)})
+            return
+        df = voo.df
+        self._linha({"evento": "colunas", "colunas": [str(c) for c in df.columns],
+                     "tipos": {str(c): str(t) for c, t in df.dtypes.items()}})
+        for ini in range(0, len(df), SERVIDOR_LOTE_LINHAS):
+            lote = df.iloc[ini:ini + SERVIDOR_LOTE_LINHAS]
+            self._linha({"evento": "linhas", "linhas": lote.astype(object).where(lote.notna(), None).values.tolist()})
+        self._linha({"evento": "fim", "linhas": len(df)})
+
+    def log_message(self, formato, *args):
+        print(f"[{_fmt_ts(pd.Timestamp.now())}] {self.client_address[0]} {formato % args}")
+
+
+def servir(endereco: str = ""):
+    """Sobe o servidor de jobs (bloqueia). endereco = "host:porta" (padrão 127.0.0.1:8765)."""
+    if not SERVIDOR_TOKEN:
+        raise ValueError("defina GERADOR_SERVIDOR_TOKEN (o mesmo segredo nas estações) antes de subir o servidor.")
+    host, _, porta = (endereco or "127.0.0.1").partition(":")
+    srv = ThreadingHTTPServer((host or "127.0.0.1", int(porta or SERVIDOR_PORTA_PADRAO)), _HandlerServidor)
+    srv.daemon_threads = True
+    print(f"Servidor de jobs em http://{srv.server_address[0]}:{srv.server_address[1]} (Ctrl+C para parar)")
     try:
-        return pd.read_sql(sql, conn, params=params)
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
     finally:
-        conn.close()
+        srv.server_close()
+
+
+def _frame_do_servidor(colunas: list[str], tipos: dict[str, str], linhas: list[list]) -> pd.DataFrame:
+    df = pd.DataFrame.from_records(linhas, columns=colunas, coerce_float=True)
+    for col, tipo in tipos.items():
+        if col in df.columns and str(df[col].dtype) != tipo:
+            try:
+                df[col] = df[col].astype(tipo)
+            except (TypeError, ValueError):
+                pass
+    return df
+
+
+def run_query_remoto(consulta: str, carteiras: list[int], extra: dict | None = None,
+                     ao_evento=None, url: str | None = None) -> pd.DataFrame:
+    """
+    Executa a base no servidor de jobs. ao_evento(evento: dict) recebe cada linha do fluxo
+    (menos os lotes de linhas), para a tela mostrar o andamento.
+    """
+    extra = extra or {}
+    corpo = json.dumps({"consulta": consulta, "carteiras": carteiras, "extra": extra},
+                       default=_codificar_para_servidor).encode("utf-8")
+    req = urllib.request.Request(
+        (url or SERVIDOR_URL).rstrip("/") + "/executar", data=corpo,
+        headers={"Content-Type": "application/json", SERVIDOR_CABECALHO_TOKEN: SERVIDOR_TOKEN}, method="POST",
+    )
+    with _registrando_execucao(consulta, carteiras, extra) as reg, _etapa("consulta"):
+        colunas, tipos, linhas = [], {}, []
+        try:
+            resp = urllib.request.urlopen(req, timeout=SERVIDOR_TIMEOUT_S)
+        except urllib.error.HTTPError as e:
+            if e.code == 401:
+                raise RuntimeError("Servidor de jobs recusou o pedido: confira GERADOR_SERVIDOR_TOKEN nesta estação.") from e
+            raise
+        with resp:
+            for bruto in resp:
+                ev = json.loads(bruto, object_hook=_decodificar_valor)
+                if ev["evento"] == "linhas":
+                    linhas.extend(ev["linhas"])
+                    continue
+                if ev["evento"] == "erro":
+                    raise RuntimeError(f"Servidor de jobs: {ev['tipo']}: {ev['mensagem']}")
+                if ev["evento"] == "colunas":
+                    colunas, tipos = ev["colunas"], ev["tipos"]
+                if ev["evento"] == "fim" and ev["linhas"] != len(linhas):
+                    raise RuntimeError(f"Servidor de jobs: {ev['linhas']} linhas anunciadas, {len(linhas)} recebidas.")
+                if ao_evento:
+                    ao_evento(ev)
+                if ev["evento"] == "fim":
+                    break
+            else:
+                raise RuntimeError("Servidor de jobs fechou a conexão antes do fim do resultado.")
+        df = _frame_do_servidor(colunas, tipos, linhas)
+        reg["linhas"] = len(df)
+        return df
 
 
 # =========================
@@ -835,25 +5703,256 @@ telefones_filtrados AS (
 ),
 telefones_final AS (
     SELECT
-        cod_cad, nome, cpf, nmcont, cod_cli, bindingid, datanascimento, portfolio,
+        cod_cad, nome, cpf, nmcont, cod_cli, bindingid, datanascimento, portfolio,
+        MAX(CASE WHEN num = 1 THEN telefones END) AS Telefone1,
+        MAX(CASE WHEN num = 2 THEN telefones END) AS Telefone2,
+        MAX(CASE WHEN num = 3 THEN telefones END) AS Telefone3,
+        MAX(CASE WHEN num = 4 THEN telefones END) AS Telefone4,
+        MAX(CASE WHEN num = 5 THEN telefones END) AS Telefone5,
+        MAX(CASE WHEN num = 6 THEN telefones END) AS Telefone6,
+        MAX(CASE WHEN num = 7 THEN telefones END) AS Telefone7
+    FROM telefones_filtrados
+    GROUP BY cod_cad, nome, cpf, nmcont, cod_cli, bindingid, datanascimento, portfolio
+)
+SELECT
+    t.cod_cad,
+    t.nome,
+    t.cpf,
+    t.bindingid,
+    t.datanascimento,
+    t.portfolio,
+    t.Telefone1, t.Telefone2, t.Telefone3, t.Telefone4, t.Telefone5, t.Telefone6, t.Telefone7,
+    b.MarcaModelo,
+    b.placa,
+    b.cor,
+    b.AnoFabModelo,
+    b.QtdGarantiasUnicas,
+    v.Contratos,
+    v.TipoProduto,
+    a.UltimoValorAcordado,
+    a.TipoAcordo,
+    a.DataCriacaoGecobi,
+    a.StatusUltimoAcordo
+FROM telefones_final t
+LEFT JOIN bens b
+    ON t.nmcont = b.nmcont AND t.cod_cli = b.cod_cli
+JOIN valores v
+    ON t.nmcont = v.nmcont AND t.cod_cli = v.cod_cli
+LEFT JOIN acordos_ultimos a
+    ON t.nmcont = a.nmcont
+JOIN acordos_ex ex
+    ON t.nmcont = ex.nmcont
+LEFT JOIN cpc_ultimo cpc
+    ON t.nmcont = cpc.nmcont
+WHERE t.cod_cli IN ({cod_cli});
+"""
+
+SQL_GARANTIAS_BENS = r"""
+SELECT
+    cad.cod_cad,
+    cad.nomecli AS nome,
+    cad.cpfcnpj AS cpf,
+    cad.nmcont,
+    cad.cod_cli,
+    COUNT(DISTINCT ben.chassi) AS QtdGarantiasUnicas,
+    GROUP_CONCAT(DISTINCT CONCAT(ben.marca,' - ',ben.modelo) ORDER BY ben.marca, ben.modelo SEPARATOR ' || ') AS MarcaModelo,
+    GROUP_CONCAT(DISTINCT ben.placa ORDER BY ben.placa SEPARATOR ' || ') AS Placas
+FROM cadastros_tb cad
+JOIN bens_tb ben
+    ON ben.nmcont = cad.nmcont
+   AND ben.cod_cli = cad.cod_cli
+WHERE cad.cod_cli IN ({cod_cli})
+  AND cad.stcli <> 'INA'
+GROUP BY cad.cod_cad, cad.nomecli, cad.cpfcnpj, cad.nmcont, cad.cod_cli
+ORDER BY QtdGarantiasUnicas DESC;
+"""
+
+SQL_MAIORES_DIVIDAS = r"""
+SELECT
+    cad.cod_cad,
+    cad.nomecli,
+    cad.cpfcnpj,
+    cad.nmcont,
+    cad.cod_cli,
+    COUNT(DISTINCT rec.fat_parc) AS QtdContratos,
+    SUM(rec.vlrparc) AS ValorTotalDivida
+FROM cadastros_tb cad
+JOIN receber_tb rec
+    ON rec.nmcont = cad.nmcont
+   AND rec.cod_cli = cad.cod_cli
+WHERE cad.cod_cli IN ({cod_cli})
+  AND cad.stcli <> 'INA'
+GROUP BY
+    cad.cod_cad,
+    cad.nomecli,
+    cad.cpfcnpj,
+    cad.nmcont,
+    cad.cod_cli
+{having_filter}
+ORDER BY ValorTotalDivida DESC
+LIMIT 50;
+"""
+
+# Super-base: superconjunto de Recentes / Nunca / Quebras com os predicados como flags.
+#   - Telefone1..7:   ranking de todos os telefones (como em Recentes)
+#   - TelefoneOk1..7: ranking só dos telefones válidos (status/obs/tamanho/X, como em Nunca/Quebras)
+#   - _flag_recente, _tem_tel_ok, _staco: insumos dos filtros aplicados no pandas
+SQL_SUPERBASE = r"""
+WITH
+acordos_ranked AS (
+    SELECT
+        a.nmcont,
+        a.cod_aco,
+        a.data_aco,
+        a.data_cad,
+        a.vlr_aco,
+        a.qtd_p_aco,
+        a.staco,
+        ROW_NUMBER() OVER (PARTITION BY a.nmcont ORDER BY a.cod_aco DESC) AS rn_aco
+    FROM acordos_tb a
+    WHERE a.cod_cli IN ({cod_cli})
+      AND a.data_cad >= '2025-07-01'
+),
+acordos_pagos AS (
+    SELECT nmcont
+    FROM acordos_ranked
+    WHERE rn_aco = 1
+      AND staco IN ('P','G','A')
+),
+acordos_ultimos AS (
+    SELECT
+        aco.nmcont,
+        aco.vlr_aco AS UltimoValorAcordado,
+        CASE
+            WHEN aco.qtd_p_aco = 1 THEN 'AVISTA'
+            WHEN aco.qtd_p_aco > 1 THEN 'PARCELADO'
+            ELSE NULL
+        END AS TipoAcordo,
+        DATE_FORMAT(aco.data_cad, '%d-%m-%Y') AS DataCriacaoGecobi,
+        CASE aco.staco
+            WHEN 'A' THEN 'Em Acordo'
+            WHEN 'E' THEN 'Exceção Rejeitada'
+            WHEN 'G' THEN 'Pago'
+            WHEN 'Q' THEN 'Quebrado'
+            WHEN 'P' THEN 'Em Promessa'
+            ELSE 'Sem Dados'
+        END AS StatusUltimoAcordo,
+        aco.staco
+    FROM acordos_ranked aco
+    WHERE aco.rn_aco = 1
+      AND aco.staco IN ('Q','E','P','G','A')
+),
+valores AS (
+    SELECT
+        recc.nmcont,
+        recc.cod_cli,
+        GROUP_CONCAT(DISTINCT rec.fat_parc ORDER BY rec.fat_parc SEPARATOR ' || ') AS Contratos,
+        GROUP_CONCAT(DISTINCT recc.char_5 ORDER BY recc.char_5 SEPARATOR ' || ') AS TipoProduto
+    FROM rec_comp_tb recc
+    LEFT JOIN receber_tb rec
+        ON rec.nmcont = recc.nmcont
+       AND rec.cod_cli = recc.cod_cli
+    WHERE recc.cod_cli IN ({cod_cli})
+      AND rec.fat_parc NOT LIKE '%ENTRADA%'
+      AND recc.nmcont NOT IN (SELECT nmcont FROM acordos_pagos)
+    GROUP BY recc.nmcont, recc.cod_cli
+    {vlrparc_having}
+),
+bens AS (
+    SELECT
+        ben.nmcont,
+        ben.cod_cli,
+        CONCAT(ben.marca, ' - ', ben.modelo) AS MarcaModelo,
+        ben.placa,
+        ben.cor,
+        CONCAT(ben.anofab, '/', ben.anomodelo) AS AnoFabModelo,
+        COUNT(DISTINCT ben.chassi) AS QtdGarantiasUnicas
+    FROM bens_tb ben
+    WHERE ben.cod_cli IN ({cod_cli})
+    GROUP BY ben.nmcont, ben.cod_cli
+),
+telefones_base AS (
+    SELECT
+        cad.cod_cad AS cod_cad,
+        cad.nomecli AS nome,
+        cad.cpfcnpj AS cpf,
+        cad.nmcont AS nmcont,
+        cad.cod_cli AS cod_cli,
+        MAX(recc.int_2) AS BindingID,
+        DATE_FORMAT(nascto, '%d-%m-%Y') AS DataNascimento,
+        cad.infoad AS Portfolio,
+        CONCAT(dddfone,telefone) AS telefones,
+        tel.status,
+        MAX(CASE
+            WHEN (tel.status IN (2, 4, 5, 6, 1)
+                  OR (tel.obs NOT LIKE '%Descon%' AND tel.obs NOT LIKE '%incorret%'))
+             AND LENGTH(CONCAT(dddfone, telefone)) >= 8
+             AND CONCAT(dddfone, telefone) NOT LIKE '%X%'
+            THEN 1 ELSE 0
+        END) AS tel_ok,
+        MAX(CASE
+            WHEN cad.data_cad = cad.data_arq
+             AND cad.data_cad >= (curdate() - interval 2 month)
+            THEN 1 ELSE 0
+        END) AS flag_recente
+    FROM cadastros_tb cad
+    JOIN fones_tb tel
+        ON tel.cod_cad = cad.cod_cad
+    LEFT JOIN rec_comp_tb recc
+        ON recc.nmcont = cad.nmcont
+       AND cad.cod_cli = recc.cod_cli
+    WHERE cad.cod_cli IN ({cod_cli})
+      AND CONCAT(dddfone, telefone) NOT REGEXP '([0-9])\\1{{5}}'
+      AND cad.stcli <> 'INA'
+      {infoad_filter}
+    GROUP BY cad.cod_cad, cad.nomecli, cad.cpfcnpj, cad.nmcont, cad.cod_cli,
+             nascto, cad.infoad, dddfone, telefone, tel.status
+),
+telefones AS (
+    SELECT
+        tb.*,
+        ROW_NUMBER() OVER (
+            PARTITION BY tb.cod_cad
+            ORDER BY FIELD(tb.status, 2, 4, 5, 6, 1, 0), tb.status
+        ) AS num,
+        ROW_NUMBER() OVER (
+            PARTITION BY tb.cod_cad, tb.tel_ok
+            ORDER BY FIELD(tb.status, 2, 4, 5, 6, 1, 0), tb.status
+        ) AS num_ok
+    FROM telefones_base tb
+),
+telefones_final AS (
+    SELECT
+        cod_cad, nome, cpf, nmcont, cod_cli, BindingID, DataNascimento, Portfolio,
+        MAX(flag_recente) AS flag_recente,
+        MAX(tel_ok) AS tem_tel_ok,
         MAX(CASE WHEN num = 1 THEN telefones END) AS Telefone1,
         MAX(CASE WHEN num = 2 THEN telefones END) AS Telefone2,
         MAX(CASE WHEN num = 3 THEN telefones END) AS Telefone3,
         MAX(CASE WHEN num = 4 THEN telefones END) AS Telefone4,
         MAX(CASE WHEN num = 5 THEN telefones END) AS Telefone5,
         MAX(CASE WHEN num = 6 THEN telefones END) AS Telefone6,
-        MAX(CASE WHEN num = 7 THEN telefones END) AS Telefone7
-    FROM telefones_filtrados
-    GROUP BY cod_cad, nome, cpf, nmcont, cod_cli, bindingid, datanascimento, portfolio
+        MAX(CASE WHEN num = 7 THEN telefones END) AS Telefone7,
+        MAX(CASE WHEN tel_ok = 1 AND num_ok = 1 THEN telefones END) AS TelefoneOk1,
+        MAX(CASE WHEN tel_ok = 1 AND num_ok = 2 THEN telefones END) AS TelefoneOk2,
+        MAX(CASE WHEN tel_ok = 1 AND num_ok = 3 THEN telefones END) AS TelefoneOk3,
+        MAX(CASE WHEN tel_ok = 1 AND num_ok = 4 THEN telefones END) AS TelefoneOk4,
+        MAX(CASE WHEN tel_ok = 1 AND num_ok = 5 THEN telefones END) AS TelefoneOk5,
+        MAX(CASE WHEN tel_ok = 1 AND num_ok = 6 THEN telefones END) AS TelefoneOk6,
+        MAX(CASE WHEN tel_ok = 1 AND num_ok = 7 THEN telefones END) AS TelefoneOk7
+    FROM telefones
+    WHERE num <= {tel_limit} OR (tel_ok = 1 AND num_ok <= {tel_limit})
+    GROUP BY cod_cad, nome, cpf, nmcont, cod_cli, BindingID, DataNascimento, Portfolio
 )
 SELECT
     t.cod_cad,
     t.nome,
     t.cpf,
-    t.bindingid,
-    t.datanascimento,
-    t.portfolio,
+    t.BindingID,
+    t.DataNascimento,
+    t.Portfolio,
     t.Telefone1, t.Telefone2, t.Telefone3, t.Telefone4, t.Telefone5, t.Telefone6, t.Telefone7,
+    t.TelefoneOk1, t.TelefoneOk2, t.TelefoneOk3, t.TelefoneOk4, t.TelefoneOk5, t.TelefoneOk6, t.TelefoneOk7,
     b.MarcaModelo,
     b.placa,
     b.cor,
@@ -864,7 +5963,10 @@ SELECT
     a.UltimoValorAcordado,
     a.TipoAcordo,
     a.DataCriacaoGecobi,
-    a.StatusUltimoAcordo
+    a.StatusUltimoAcordo,
+    a.staco AS _staco,
+    t.flag_recente AS _flag_recente,
+    t.tem_tel_ok AS _tem_tel_ok
 FROM telefones_final t
 LEFT JOIN bens b
     ON t.nmcont = b.nmcont AND t.cod_cli = b.cod_cli
@@ -872,57 +5974,432 @@ JOIN valores v
     ON t.nmcont = v.nmcont AND t.cod_cli = v.cod_cli
 LEFT JOIN acordos_ultimos a
     ON t.nmcont = a.nmcont
-JOIN acordos_ex ex
-    ON t.nmcont = ex.nmcont
-LEFT JOIN cpc_ultimo cpc
-    ON t.nmcont = cpc.nmcont
 WHERE t.cod_cli IN ({cod_cli});
 """
 
-SQL_GARANTIAS_BENS = r"""
+# Tuplas para agregar Contratos/TipoProduto no cliente (mesmos filtros da CTE `valores`),
+# só das chaves que a base devolveu (tmp_valores_chaves, carregada antes na mesma conexão)
+SQL_VALORES_TUPLAS = r"""
+WITH
+acordos_ranked AS (
+    SELECT
+        a.nmcont,
+        a.staco,
+        ROW_NUMBER() OVER (PARTITION BY a.nmcont ORDER BY a.cod_aco DESC) AS rn_aco
+    FROM acordos_tb a
+    WHERE a.cod_cli IN ({cod_cli})
+      AND a.data_cad >= '2025-07-01'
+),
+acordos_pagos AS (
+    SELECT nmcont
+    FROM acordos_ranked
+    WHERE rn_aco = 1
+      AND staco IN ('P','G','A')
+)
+SELECT
+    recc.nmcont,
+    recc.cod_cli,
+    rec.fat_parc,
+    recc.char_5
+FROM tmp_valores_chaves k
+JOIN rec_comp_tb recc
+    ON recc.nmcont = k.nmcont
+   AND recc.cod_cli = k.cod_cli
+LEFT JOIN receber_tb rec
+    ON rec.nmcont = recc.nmcont
+   AND rec.cod_cli = recc.cod_cli
+WHERE recc.cod_cli IN ({cod_cli})
+  AND rec.fat_parc NOT LIKE '%ENTRADA%'
+  AND recc.nmcont NOT IN (SELECT nmcont FROM acordos_pagos)
+ORDER BY recc.nmcont, recc.cod_cli;
+"""
+
+# Contatados nos últimos 30 dias (mesmos critérios do NOT IN de cada base)
+SQL_CONTATADOS_30D = {
+    "sem_hist": r"""
+SELECT DISTINCT h.{hist_cad_ref_col} AS cod_cli
+FROM hist_tb h
+WHERE h.data_at >= NOW() - INTERVAL 30 DAY
+  AND h.cod_usu <> '999';
+""",
+    "nunca": r"""
+SELECT DISTINCT h.{hist_cad_ref_col} AS cod_cli
+FROM hist_tb h
+LEFT JOIN stcob_tb s ON s.st = h.ocorr
+WHERE h.data_at >= CURDATE() - INTERVAL 30 DAY
+  AND (s.bsc NOT LIKE '%sistema%' OR s.bsc NOT LIKE '' OR s.bsc IS NOT NULL)
+  AND h.cod_usu <> '999';
+""",
+}
+
+# Rollup diário de CPC: carga incremental (janela [ini, fim)) + atributos do cliente
+SQL_CPC_ROLLUP = r"""
+SELECT
+    his.{hist_cad_ref_col} AS cod_cad,
+    DATE(his.data_at) AS dia,
+    MAX(his.data_at) AS ultimo_cpc
+FROM hist_tb his
+JOIN stcob_tb st
+    ON st.st = his.ocorr
+WHERE his.data_at >= %s
+  AND his.data_at < %s
+  AND st.bsc LIKE '%CPC%'
+GROUP BY his.{hist_cad_ref_col}, DATE(his.data_at);
+"""
+
+SQL_CPC_ATRIBUTOS = r"""
 SELECT
     cad.cod_cad,
     cad.nomecli AS nome,
     cad.cpfcnpj AS cpf,
+    cad.nmcont
+FROM cadastros_tb cad
+WHERE cad.cod_cli IN ({cod_cli})
+  AND cad.stcli <> 'INA';
+"""
+
+# Índice de segmentos: cargas (chaves apenas) + colunas de detalhe
+SQL_SEG_CADASTROS = r"""
+SELECT
+    cad.cod_cad,
     cad.nmcont,
     cad.cod_cli,
-    COUNT(DISTINCT ben.chassi) AS QtdGarantiasUnicas,
-    GROUP_CONCAT(DISTINCT CONCAT(ben.marca,' - ',ben.modelo) ORDER BY ben.marca, ben.modelo SEPARATOR ' || ') AS MarcaModelo,
-    GROUP_CONCAT(DISTINCT ben.placa ORDER BY ben.placa SEPARATOR ' || ') AS Placas
+    CASE WHEN cad.stcli <> 'INA' THEN 1 ELSE 0 END AS ativo
 FROM cadastros_tb cad
-JOIN bens_tb ben
-    ON ben.nmcont = cad.nmcont
-   AND ben.cod_cli = cad.cod_cli
-WHERE cad.cod_cli IN ({cod_cli})
-  AND cad.stcli <> 'INA'
-GROUP BY cad.cod_cad, cad.nomecli, cad.cpfcnpj, cad.nmcont, cad.cod_cli
-ORDER BY QtdGarantiasUnicas DESC;
+WHERE cad.cod_cli IN ({cod_cli});
 """
 
-SQL_MAIORES_DIVIDAS = r"""
+SQL_SEG_CONTATOS = r"""
+SELECT
+    h.{hist_cad_ref_col} AS cod_cad,
+    MAX(h.data_at) AS data_at
+FROM hist_tb h
+WHERE h.data_at >= %s
+  AND h.cod_usu <> '999'
+GROUP BY h.{hist_cad_ref_col};
+"""
+
+# Mesmo critério do NOT IN de SQL_NUNCA: o LEFT JOIN com s.bsc IS NOT NULL equivale ao JOIN
+SQL_SEG_CONTATOS_NUNCA = r"""
+SELECT
+    h.{hist_cad_ref_col} AS cod_cad,
+    MAX(h.data_at) AS data_at
+FROM hist_tb h
+JOIN stcob_tb s
+    ON s.st = h.ocorr
+WHERE h.data_at >= %s
+  AND s.bsc IS NOT NULL
+  AND h.cod_usu <> '999'
+GROUP BY h.{hist_cad_ref_col};
+"""
+
+SQL_SEG_CPC = r"""
+SELECT DISTINCT
+    h.{hist_cad_ref_col} AS cod_cad
+FROM hist_tb h
+JOIN stcob_tb st
+    ON st.st = h.ocorr
+WHERE h.data_at >= %s
+  AND st.bsc LIKE '%CPC%';
+"""
+
+SQL_SEG_ACORDOS = r"""
+WITH ranked AS (
+    SELECT
+        a.nmcont,
+        a.staco,
+        ROW_NUMBER() OVER (PARTITION BY a.nmcont ORDER BY a.cod_aco DESC) AS rn
+    FROM acordos_tb a
+    WHERE a.cod_cli IN ({cod_cli})
+      AND a.data_cad >= '2025-07-01'
+)
+SELECT nmcont, staco
+FROM ranked
+WHERE rn = 1
+  AND staco IN ('P','A','G','Q','E');
+"""
+
+SQL_SEG_GARANTIAS = r"""
+SELECT DISTINCT
+    ben.nmcont,
+    ben.cod_cli
+FROM bens_tb ben
+WHERE ben.cod_cli IN ({cod_cli});
+"""
+
+# Índice de segmentos, incremental: chaves alteradas desde a marca d'água (%s, parâmetro de cauda)
+SQL_SEG_CADASTROS_ALTERADOS = r"""
 SELECT
     cad.cod_cad,
-    cad.nomecli,
-    cad.cpfcnpj,
     cad.nmcont,
     cad.cod_cli,
-    COUNT(DISTINCT rec.fat_parc) AS QtdContratos,
-    SUM(rec.vlrparc) AS ValorTotalDivida
+    CASE WHEN cad.stcli <> 'INA' THEN 1 ELSE 0 END AS ativo
 FROM cadastros_tb cad
-JOIN receber_tb rec
-    ON rec.nmcont = cad.nmcont
-   AND rec.cod_cli = cad.cod_cli
 WHERE cad.cod_cli IN ({cod_cli})
-  AND cad.stcli <> 'INA'
-GROUP BY
+  AND cad.data_arq >= DATE(%s);
+"""
+
+SQL_SEG_ACORDOS_ALTERADOS = r"""
+WITH ranked AS (
+    SELECT
+        a.nmcont,
+        a.staco,
+        ROW_NUMBER() OVER (PARTITION BY a.nmcont ORDER BY a.cod_aco DESC) AS rn
+    FROM acordos_tb a
+    WHERE a.cod_cli IN ({cod_cli})
+      AND a.data_cad >= '2025-07-01'
+      AND a.nmcont IN (
+            SELECT n.nmcont
+            FROM acordos_tb n
+            WHERE n.cod_cli IN ({cod_cli})
+              AND n.data_cad >= DATE(%s)
+      )
+)
+SELECT nmcont, staco
+FROM ranked
+WHERE rn = 1;
+"""
+
+SQL_SEG_GARANTIAS_ALTERADAS = r"""
+SELECT DISTINCT
+    ben.nmcont,
+    ben.cod_cli
+FROM bens_tb ben
+JOIN cadastros_tb cad
+    ON cad.nmcont = ben.nmcont
+   AND cad.cod_cli = ben.cod_cli
+WHERE ben.cod_cli IN ({cod_cli})
+  AND cad.data_arq >= DATE(%s);
+"""
+
+SQL_SEG_DETALHES = r"""
+SELECT
     cad.cod_cad,
-    cad.nomecli,
-    cad.cpfcnpj,
+    cad.nomecli AS nome,
+    cad.cpfcnpj AS cpf,
     cad.nmcont,
-    cad.cod_cli
-{having_filter}
-ORDER BY ValorTotalDivida DESC
-LIMIT 50;
+    cad.cod_cli,
+    cad.infoad AS portfolio
+FROM cadastros_tb cad
+WHERE cad.cod_cad IN ({ids});
+"""
+
+# Extração em faixas: cod_cad das carteiras, em ordem, para cortar as faixas
+SQL_BLOCOS_COD_CAD = r"""
+SELECT cad.cod_cad
+FROM cadastros_tb cad
+WHERE cad.cod_cli IN ({cod_cli})
+ORDER BY cad.cod_cad;
+"""
+
+
+# Consultor de índices: índices das tabelas lidas pelos templates (na ordem das colunas)
+SQL_INDICES_EXISTENTES = r"""
+SELECT
+    TABLE_NAME AS tabela,
+    INDEX_NAME AS indice,
+    COLUMN_NAME AS coluna
+FROM information_schema.STATISTICS
+WHERE TABLE_SCHEMA = DATABASE()
+  AND TABLE_NAME IN ({tabelas})
+ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;
+"""
+
+# Réplica local: só as colunas que os templates usam. Por carteira: %s = cod_cli;
+# hist_tb ainda recebe a janela [%s, %s) de data_at.
+SQL_REPLICA = {
+    "stcob_tb": r"""
+SELECT st, bsc
+FROM stcob_tb;
+""",
+    "cadastros_tb": r"""
+SELECT cod_cad, nomecli, cpfcnpj, email, nmcont, cod_cli, infoad, stcli,
+       data_cad, data_arq, nascto
+FROM cadastros_tb
+WHERE cod_cli = %s;
+""",
+    "fones_tb": r"""
+SELECT tel.cod_cad, tel.dddfone, tel.telefone, tel.status, tel.obs
+FROM fones_tb tel
+JOIN cadastros_tb cad ON cad.cod_cad = tel.cod_cad
+WHERE cad.cod_cli = %s;
+""",
+    "acordos_tb": r"""
+SELECT nmcont, cod_cli, cod_aco, data_aco, data_cad, vlr_aco, qtd_p_aco, staco
+FROM acordos_tb
+WHERE cod_cli = %s;
+""",
+    "rec_comp_tb": r"""
+SELECT nmcont, cod_cli, char_5, int_2
+FROM rec_comp_tb
+WHERE cod_cli = %s;
+""",
+    "receber_tb": r"""
+SELECT nmcont, cod_cli, fat_parc, vlrparc
+FROM receber_tb
+WHERE cod_cli = %s;
+""",
+    "bens_tb": r"""
+SELECT nmcont, cod_cli, marca, modelo, placa, cor, anofab, anomodelo, chassi
+FROM bens_tb
+WHERE cod_cli = %s;
+""",
+    "hist_tb": r"""
+SELECT h.{hist_cad_ref_col}, h.data_at, h.ocorr, h.cod_usu
+FROM hist_tb h
+JOIN cadastros_tb cad ON cad.cod_cad = h.{hist_cad_ref_col}
+WHERE cad.cod_cli = %s
+  AND h.data_at >= %s
+  AND h.data_at < %s;
+""",
+}
+
+# Staging: tabelas-resumo mantidas pela ferramenta. {stg} = STAGING_SCHEMA.
+# Reconstrução completa: "CREATE TABLE ... (índices) <SELECT>" numa tabela _novo + RENAME.
+SQL_STG_CONTROLE = r"""
+CREATE TABLE IF NOT EXISTS {stg}.stg_controle (
+    tabela VARCHAR(64) NOT NULL PRIMARY KEY,
+    watermark DATETIME NULL,
+    atualizado_em DATETIME NOT NULL,
+    duracao_s DOUBLE NOT NULL
+);
+"""
+
+SQL_STG_REGISTRAR = r"""
+INSERT INTO {stg}.stg_controle (tabela, watermark, atualizado_em, duracao_s)
+VALUES (%s, %s, NOW(), %s)
+ON DUPLICATE KEY UPDATE
+    watermark = VALUES(watermark),
+    atualizado_em = VALUES(atualizado_em),
+    duracao_s = VALUES(duracao_s);
+"""
+
+SQL_STG_RECONSTRUCAO = {
+    # Último acordo (desde 2025-07-01) por nmcont + carteira: mesmas colunas de acordos_tb
+    "stg_ultimo_acordo": (
+        "INDEX ix_cli_nmcont (cod_cli, nmcont)",
+        r"""
+SELECT nmcont, cod_cli, cod_aco, data_aco, data_cad, vlr_aco, qtd_p_aco, staco
+FROM (
+    SELECT
+        a.nmcont, a.cod_cli, a.cod_aco, a.data_aco, a.data_cad, a.vlr_aco, a.qtd_p_aco, a.staco,
+        ROW_NUMBER() OVER (PARTITION BY a.nmcont, a.cod_cli ORDER BY a.cod_aco DESC) AS rn
+    FROM acordos_tb a
+    WHERE a.data_cad >= '2025-07-01'
+) x
+WHERE rn = 1
+""",
+    ),
+    # Dívida por nmcont + carteira. vlrparc = total (mesmo nome de receber_tb, para o
+    # HAVING SUM(rec.vlrparc) continuar valendo); Contratos/TipoProduto = CTE `valores`.
+    "stg_divida": (
+        "INDEX ix_nmcont_cli (nmcont, cod_cli), INDEX ix_cli (cod_cli)",
+        r"""
+SELECT
+    r.nmcont,
+    r.cod_cli,
+    r.qtd_contratos,
+    r.vlrparc,
+    r.Contratos,
+    c.TipoProduto,
+    (c.nmcont IS NOT NULL) AS tem_rec_comp
+FROM (
+    SELECT
+        nmcont,
+        cod_cli,
+        COUNT(DISTINCT fat_parc) AS qtd_contratos,
+        SUM(vlrparc) AS vlrparc,
+        GROUP_CONCAT(DISTINCT CASE WHEN fat_parc NOT LIKE '%ENTRADA%' THEN fat_parc END
+                     ORDER BY fat_parc SEPARATOR ' || ') AS Contratos
+    FROM receber_tb
+    GROUP BY nmcont, cod_cli
+) r
+LEFT JOIN (
+    SELECT
+        nmcont,
+        cod_cli,
+        GROUP_CONCAT(DISTINCT char_5 ORDER BY char_5 SEPARATOR ' || ') AS TipoProduto
+    FROM rec_comp_tb
+    GROUP BY nmcont, cod_cli
+) c
+    ON c.nmcont = r.nmcont
+   AND c.cod_cli = r.cod_cli
+""",
+    ),
+    # Telefones sem sequência repetida (o REGEXP mais caro das bases), mesmas colunas de fones_tb
+    "stg_fones_limpos": (
+        "INDEX ix_cod_cad (cod_cad)",
+        r"""
+SELECT tel.cod_cad, tel.dddfone, tel.telefone, tel.status, tel.obs
+FROM fones_tb tel
+WHERE CONCAT(tel.dddfone, tel.telefone) NOT REGEXP '([0-9])\\1{5}'
+""",
+    ),
+    # Garantias por nmcont + carteira = CTE `bens`
+    "stg_bens": (
+        "INDEX ix_nmcont_cli (nmcont, cod_cli), INDEX ix_cli (cod_cli)",
+        r"""
+SELECT
+    ben.nmcont,
+    ben.cod_cli,
+    CONCAT(ben.marca, ' - ', ben.modelo) AS MarcaModelo,
+    ben.placa,
+    ben.cor,
+    CONCAT(ben.anofab, '/', ben.anomodelo) AS AnoFabModelo,
+    COUNT(DISTINCT ben.chassi) AS QtdGarantiasUnicas
+FROM bens_tb ben
+GROUP BY ben.nmcont, ben.cod_cli
+""",
+    ),
+}
+
+# Chaves alteradas desde o watermark (%s): cadastros recarregados (data_arq = data do arquivo)
+# e acordos novos. Tabelas comuns em {stg}, recriadas a cada atualização incremental.
+SQL_STG_CHAVES_ALTERADAS = {
+    "stg_chaves_alteradas": r"""
+CREATE TABLE {stg}.stg_chaves_alteradas (PRIMARY KEY (nmcont, cod_cli))
+SELECT cad.nmcont, cad.cod_cli
+FROM cadastros_tb cad
+WHERE cad.data_arq >= DATE(%s)
+  AND cad.nmcont IS NOT NULL
+UNION
+SELECT a.nmcont, a.cod_cli
+FROM acordos_tb a
+WHERE a.data_cad >= DATE(%s)
+  AND a.nmcont IS NOT NULL
+""",
+    "stg_cad_alterados": r"""
+CREATE TABLE {stg}.stg_cad_alterados (PRIMARY KEY (cod_cad))
+SELECT cad.cod_cad
+FROM cadastros_tb cad
+WHERE cad.data_arq >= DATE(%s)
+""",
+}
+
+# Último CPC / último contato por nmcont + carteira (incremental por hist_tb.data_at)
+SQL_STG_ULTIMO_CPC_SELECT = r"""
+SELECT
+    cad.nmcont,
+    cad.cod_cli,
+    MAX(CASE WHEN st.bsc LIKE '%%CPC%%' THEN his.data_at END) AS dt_ultimo_cpc,
+    MAX(his.data_at) AS dt_ultimo_contato
+FROM hist_tb his
+JOIN cadastros_tb cad ON cad.cod_cad = his.{hist_cad_ref_col}
+JOIN stcob_tb st ON st.st = his.ocorr
+WHERE his.data_at >= %s
+  AND his.data_at < %s
+  AND cad.nmcont IS NOT NULL
+GROUP BY cad.nmcont, cad.cod_cli
+"""
+
+SQL_STG_ULTIMO_CPC_UPSERT = r"""
+INSERT INTO {stg}.stg_ultimo_cpc (nmcont, cod_cli, dt_ultimo_cpc, dt_ultimo_contato)
+{select}
+ON DUPLICATE KEY UPDATE
+    dt_ultimo_cpc = GREATEST(COALESCE(dt_ultimo_cpc, VALUES(dt_ultimo_cpc)),
+                             COALESCE(VALUES(dt_ultimo_cpc), dt_ultimo_cpc)),
+    dt_ultimo_contato = GREATEST(COALESCE(dt_ultimo_contato, VALUES(dt_ultimo_contato)),
+                                 COALESCE(VALUES(dt_ultimo_contato), dt_ultimo_contato));
 """
 
 
@@ -961,6 +6438,8 @@ class App(tk.Tk):
         self.rowconfigure(1, weight=1)
         self.rowconfigure(2, weight=0)
 
+        self._ultimos_caminhos: list[str] = []  # arquivos do último job (cópias para o destino)
+
         self._build_header()
         self._build_body()
 
@@ -1024,14 +6503,22 @@ class App(tk.Tk):
     # Body
     # -------------------------
     def _build_body(self):
-        body = ttk.Frame(self, style="App.TFrame", padding=(16, 14))
-        body.grid(row=1, column=0, sticky="nsew")
+        self.notebook = ttk.Notebook(self)
+        self.notebook.grid(row=1, column=0, sticky="nsew")
+
+        body = ttk.Frame(self.notebook, style="App.TFrame", padding=(16, 14))
         body.columnconfigure(0, weight=0)
         body.columnconfigure(1, weight=1)
+        self.notebook.add(body, text="Gerar")
 
         self._build_sidebar(body)
         self._build_content(body)
 
+        self.tab_historico = ttk.Frame(self.notebook, style="App.TFrame", padding=(16, 14))
+        self.notebook.add(self.tab_historico, text="Histórico")
+        self._build_historico(self.tab_historico)
+        self.notebook.bind("<<NotebookTabChanged>>", lambda _e: self._recarregar_historico_se_visivel())
+
         # Rodapé
         footer = ttk.Frame(self, style="App.TFrame", padding=(16, 6))
         footer.grid(row=2, column=0, sticky="ew")
@@ -1045,6 +6532,96 @@ class App(tk.Tk):
             background="#f6f7fb"
         ).grid(row=0, column=0, sticky="w")
 
+    # -------------------------
+    # Histórico de execuções
+    # -------------------------
+    def _build_historico(self, parent):
+        parent.columnconfigure(0, weight=1)
+        parent.rowconfigure(1, weight=1)
+        parent.rowconfigure(3, weight=2)
+
+        topo = ttk.Frame(parent, style="App.TFrame")
+        topo.grid(row=0, column=0, sticky="ew")
+        topo.columnconfigure(0, weight=1)
+        ttk.Label(
+            topo,
+            text=f"Tendência por base (p50/p95 das últimas {HISTORICO_BASELINE_N} execuções x "
+                 f"p50 das {HISTORICO_RECENTES_N} mais recentes; acertos de cache e erros ficam fora)",
+            style="Hint.TLabel",
+        ).grid(row=0, column=0, sticky="w")
+        ttk.Button(topo, text="Atualizar", style="Secondary.TButton",
+                   command=self._carregar_historico).grid(row=0, column=1, sticky="e")
+
+        colunas_tend = ("consulta", "execucoes", "p50_s", "p95_s", "recente_p50_s", "alerta")
+        self.tree_tendencias = ttk.Treeview(parent, columns=colunas_tend, show="headings", height=6)
+        for col, titulo, largura in zip(
+            colunas_tend,
+            ("Base", "Execuções", "p50 (s)", "p95 (s)", "p50 recente (s)", "Alerta"),
+            (220, 80, 80, 80, 110, 260),
+        ):
+            self.tree_tendencias.heading(col, text=titulo)
+            self.tree_tendencias.column(col, width=largura, anchor="w")
+        self.tree_tendencias.tag_configure("alerta", foreground="#b42318")
+        self.tree_tendencias.grid(row=1, column=0, sticky="nsew", pady=(8, 12))
+
+        ttk.Label(parent, text="Últimas execuções", style="Hint.TLabel").grid(row=2, column=0, sticky="w")
+        colunas_exec = ("iniciado_em", "consulta", "carteiras", "duracao_s", "linhas", "bytes",
+                        "rss_pico_mb", "cache", "etapas", "erro")
+        self.tree_execucoes = ttk.Treeview(parent, columns=colunas_exec, show="headings")
+        for col, titulo, largura in zip(
+            colunas_exec,
+            ("Início", "Base", "Carteiras", "Duração (s)", "Linhas", "Bytes", "RSS pico (MB)",
+             "Cache (hit/miss)", "Etapas (s)", "Erro"),
+            (140, 180, 90, 80, 70, 80, 90, 100, 200, 200),
+        ):
+            self.tree_execucoes.heading(col, text=titulo)
+            self.tree_execucoes.column(col, width=largura, anchor="w")
+        self.tree_execucoes.tag_configure("erro", foreground="#b42318")
+        self.tree_execucoes.grid(row=3, column=0, sticky="nsew", pady=(4, 0))
+
+        scroll = ttk.Scrollbar(parent, orient="vertical", command=self.tree_execucoes.yview)
+        scroll.grid(row=3, column=1, sticky="ns", pady=(4, 0))
+        self.tree_execucoes.configure(yscrollcommand=scroll.set)
+
+    def _recarregar_historico_se_visivel(self):
+        if self.notebook.select() == str(self.tab_historico):
+            self._carregar_historico()
+
+    def _carregar_historico(self):
+        try:
+            tend = tendencias_execucoes()
+            execs = ultimas_execucoes()
+        except Exception as e:
+            messagebox.showerror("Histórico", f"Falha ao ler o histórico:\n{e}")
+            return
+
+        def _num(v, fmt):
+            return "" if pd.isna(v) else format(v, fmt)
+
+        self.tree_tendencias.delete(*self.tree_tendencias.get_children())
+        for r in tend.itertuples(index=False):
+            self.tree_tendencias.insert(
+                "", "end",
+                values=(r.consulta, r.execucoes, _num(r.p50_s, ".1f"), _num(r.p95_s, ".1f"),
+                        _num(r.recente_p50_s, ".1f"), r.alerta),
+                tags=("alerta",) if r.alerta else (),
+            )
+
+        self.tree_execucoes.delete(*self.tree_execucoes.get_children())
+        for r in execs.itertuples(index=False):
+            etapas = json.loads(r.etapas) if r.etapas else {}
+            self.tree_execucoes.insert(
+                "", "end",
+                values=(
+                    r.iniciado_em, r.consulta, r.carteiras, _num(r.duracao_s, ".1f"),
+                    _num(r.linhas, ".0f"), _num(r.bytes, ",.0f"), _num(r.rss_pico_mb, ".0f"),
+                    f"{_num(r.cache_hits, '.0f')}/{_num(r.cache_misses, '.0f')}",
+                    " ".join(f"{k}={v:.1f}" for k, v in etapas.items()),
+                    r.erro or "",
+                ),
+                tags=("erro",) if r.erro else (),
+            )
+
     def _build_sidebar(self, parent):
         sidebar = ttk.Frame(parent, style="App.TFrame")
         sidebar.grid(row=0, column=0, sticky="nsw", padx=(0, 12))
@@ -1101,6 +6678,26 @@ class App(tk.Tk):
 
         self.query_listbox.bind("<<ListboxSelect>>", self._on_query_listbox_change)
 
+        # Colunas (projeção no SELECT final)
+        self.colunas_escolhidas = carregar_colunas_escolhidas()
+        colunas_row = ttk.Frame(inner, style="CardInner.TFrame")
+        colunas_row.grid(row=1, column=0, sticky="w")
+        self.btn_colunas = ttk.Button(
+            colunas_row, text="Colunas...", style="Secondary.TButton", command=self._escolher_colunas
+        )
+        self.btn_colunas.grid(row=0, column=0, sticky="w")
+        self.lbl_colunas = ttk.Label(colunas_row, text="", style="Hint.TLabel")
+        self.lbl_colunas.grid(row=0, column=1, sticky="w", padx=(10, 0))
+
+        # Filtros na origem (valem para todas as bases em que o campo existe)
+        self.filtros_texto: dict[str, str] = {}
+        self.btn_filtros = ttk.Button(
+            colunas_row, text="Filtros...", style="Secondary.TButton", command=self._escolher_filtros
+        )
+        self.btn_filtros.grid(row=1, column=0, sticky="w", pady=(6, 0))
+        self.lbl_filtros = ttk.Label(colunas_row, text="", style="Hint.TLabel")
+        self.lbl_filtros.grid(row=1, column=1, sticky="w", padx=(10, 0), pady=(6, 0))
+
         # Parâmetros
         self.lf_params = ttk.LabelFrame(content, text="Parâmetros", style="Card.TLabelframe")
         self.lf_params.grid(row=1, column=0, sticky="ew", pady=(12, 0))
@@ -1132,6 +6729,133 @@ class App(tk.Tk):
         self.lbl_min_hint = ttk.Label(params_row, text="Ex.: 10000 ou 10.000,00", style="Hint.TLabel")
         self.lbl_min_hint.grid(row=1, column=2, columnspan=3, sticky="w", pady=(10, 0))
 
+        # Execução
+        self.valores_cliente_var = tk.BooleanVar(value=False)
+        self.chk_valores_cliente = ttk.Checkbutton(
+            params_row,
+            text="Agregar Contratos/TipoProduto no app (sem GROUP_CONCAT no banco)",
+            variable=self.valores_cliente_var,
+        )
+        self.chk_valores_cliente.grid(row=2, column=0, columnspan=5, sticky="w", pady=(10, 0))
+
+        self.indice_segmentos_var = tk.BooleanVar(value=False)
+        self.chk_indice_segmentos = ttk.Checkbutton(
+            params_row,
+            text="Usar índice local de segmentos (chaves escolhidas em memória, só detalhes no banco)",
+            variable=self.indice_segmentos_var,
+        )
+        self.chk_indice_segmentos.grid(row=3, column=0, columnspan=5, sticky="w", pady=(4, 0))
+
+        ttk.Label(params_row, text="Filtro 'contatados 30 dias':").grid(row=4, column=0, sticky="w", pady=(8, 0))
+        self.antijoin_var = tk.StringVar(value=ANTIJOIN_OPCOES[0][0])
+        self.cmb_antijoin = ttk.Combobox(
+            params_row,
+            textvariable=self.antijoin_var,
+            values=[label for label, _ in ANTIJOIN_OPCOES],
+            state="readonly",
+            width=34,
+        )
+        self.cmb_antijoin.grid(row=4, column=1, columnspan=3, sticky="w", padx=(8, 18), pady=(8, 0))
+
+        self.superbase_var = tk.BooleanVar(value=False)
+        self.chk_superbase = ttk.Checkbutton(
+            params_row,
+            text="Super-base: Recentes/Nunca/Quebras de uma leitura só (em cache por 15 min)",
+            variable=self.superbase_var,
+        )
+        self.chk_superbase.grid(row=5, column=0, columnspan=5, sticky="w", pady=(8, 0))
+
+        self.cache_var = tk.BooleanVar(value=True)
+        self.chk_cache = ttk.Checkbutton(
+            params_row,
+            text=f"Usar cache de resultados (até {RESULT_CACHE_TTL_H}h; por carteira quando possível)",
+            variable=self.cache_var,
+        )
+        self.chk_cache.grid(row=6, column=0, columnspan=5, sticky="w", pady=(4, 0))
+
+        self.cpc_rollup_var = tk.BooleanVar(value=False)
+        self.chk_cpc_rollup = ttk.Checkbutton(
+            params_row,
+            text="CPC por período a partir do rollup diário local (incremental)",
+            variable=self.cpc_rollup_var,
+        )
+        self.chk_cpc_rollup.grid(row=7, column=0, columnspan=5, sticky="w", pady=(4, 0))
+
+        self.replica_var = tk.BooleanVar(value=False)
+        self.chk_replica = ttk.Checkbutton(
+            params_row,
+            text="Executar na réplica local (sem carga na produção)",
+            variable=self.replica_var,
+        )
+        self.chk_replica.grid(row=8, column=0, columnspan=5, sticky="w", pady=(4, 0))
+
+        self.staging_var = tk.BooleanVar(value=False)
+        self.chk_staging = ttk.Checkbutton(
+            params_row,
+            text=(f"Ler das tabelas-resumo do staging ({STAGING_SCHEMA}; atualiza em segundo plano se > "
+                  f"{STAGING_MAX_IDADE_MIN} min, lê das tabelas de origem se > {STAGING_MAX_IDADE_USO_MIN // 60} h)"),
+            variable=self.staging_var,
+        )
+        self.chk_staging.grid(row=9, column=0, columnspan=5, sticky="w", pady=(4, 0))
+
+        self.lbl_staging = ttk.Label(params_row, text="Staging: consultando...", style="Hint.TLabel")
+        self.lbl_staging.grid(row=10, column=0, columnspan=5, sticky="w", padx=(20, 0))
+        self._atualizar_status_staging()
+
+        ttk.Label(params_row, text="Plano de execução:").grid(row=11, column=0, sticky="w", pady=(8, 0))
+        self.planos_var = tk.StringVar(value=PLANOS_OPCOES[0][0])
+        self.cmb_planos = ttk.Combobox(
+            params_row,
+            textvariable=self.planos_var,
+            values=[label for label, _ in PLANOS_OPCOES],
+            state="readonly",
+            width=34,
+        )
+        self.cmb_planos.grid(row=11, column=1, columnspan=3, sticky="w", padx=(8, 18), pady=(8, 0))
+
+        ttk.Label(params_row, text="Exportação:").grid(row=12, column=0, sticky="w", pady=(8, 0))
+        self.exportacao_var = tk.StringVar(value=EXPORTACAO_OPCOES[0][0])
+        self.cmb_exportacao = ttk.Combobox(
+            params_row,
+            textvariable=self.exportacao_var,
+            values=[label for label, _ in EXPORTACAO_OPCOES],
+            state="readonly",
+            width=34,
+        )
+        self.cmb_exportacao.grid(row=12, column=1, columnspan=3, sticky="w", padx=(8, 18), pady=(8, 0))
+
+        self.blocos_var = tk.BooleanVar(value=False)
+        self.chk_blocos = ttk.Checkbutton(
+            params_row,
+            text="Ler em faixas de cod_cad com checkpoints (retoma de onde parou se a conexão cair)",
+            variable=self.blocos_var,
+        )
+        self.chk_blocos.grid(row=13, column=0, columnspan=5, sticky="w", pady=(8, 0))
+
+        # Amostra estratificada (piloto): N cadastros por carteira/portfolio
+        ttk.Label(params_row, text="Amostra por carteira/portfolio:").grid(row=14, column=0, sticky="w", pady=(8, 0))
+        self.amostra_var = tk.StringVar(value="")
+        self.amostra_entry = ttk.Entry(params_row, textvariable=self.amostra_var, width=16)
+        self.amostra_entry.grid(row=14, column=1, sticky="w", padx=(8, 18), pady=(8, 0))
+
+        ttk.Label(params_row, text="Semente:").grid(row=14, column=2, sticky="w", pady=(8, 0))
+        self.semente_var = tk.StringVar(value=AMOSTRA_SEMENTE_PADRAO)
+        self.semente_entry = ttk.Entry(params_row, textvariable=self.semente_var, width=16)
+        self.semente_entry.grid(row=14, column=3, sticky="w", padx=(8, 18), pady=(8, 0))
+
+        self.lbl_amostra_hint = ttk.Label(
+            params_row, text=f"(vazio = base inteira; ex.: {AMOSTRA_N_PADRAO})", style="Hint.TLabel"
+        )
+        self.lbl_amostra_hint.grid(row=14, column=4, sticky="w", pady=(8, 0))
+
+        self.planejador_var = tk.BooleanVar(value=False)
+        self.chk_planejador = ttk.Checkbutton(
+            params_row,
+            text="Escolher a estratégia automaticamente (única, por carteira, faixas, staging ou réplica; aprende com o histórico)",
+            variable=self.planejador_var,
+        )
+        self.chk_planejador.grid(row=15, column=0, columnspan=5, sticky="w", pady=(8, 0))
+
         # Ações + progresso
         actions = ttk.Frame(content, style="App.TFrame")
         actions.grid(row=2, column=0, sticky="ew", pady=(14, 0))
@@ -1143,6 +6867,9 @@ class App(tk.Tk):
         self.btn_clear = ttk.Button(actions, text="Limpar seleção", style="Secondary.TButton", command=self.limpar)
         self.btn_clear.grid(row=0, column=1, sticky="w", padx=(10, 0))
 
+        self.lbl_andamento = ttk.Label(actions, text="", style="Hint.TLabel")
+        self.lbl_andamento.grid(row=0, column=2, sticky="w", padx=(14, 0))
+
         self.progress = ttk.Progressbar(actions, mode="indeterminate")
         self.progress.grid(row=0, column=3, sticky="ew", padx=(14, 0))
 
@@ -1154,6 +6881,8 @@ class App(tk.Tk):
 
         self.btn_generate.configure(state=state)
         self.btn_clear.configure(state=state)
+        self.btn_colunas.configure(state=state)
+        self.btn_filtros.configure(state=state)
 
         if busy:
             self.query_listbox.configure(state="disabled")
@@ -1167,9 +6896,24 @@ class App(tk.Tk):
             self.dt_ini_entry.configure(state="disabled")
             self.dt_fim_entry.configure(state="disabled")
             self.min_div_entry.configure(state="disabled")
+            self.chk_valores_cliente.configure(state="disabled")
+            self.chk_indice_segmentos.configure(state="disabled")
+            self.cmb_antijoin.configure(state="disabled")
+            self.chk_superbase.configure(state="disabled")
+            self.chk_cache.configure(state="disabled")
+            self.chk_cpc_rollup.configure(state="disabled")
+            self.chk_replica.configure(state="disabled")
+            self.chk_staging.configure(state="disabled")
+            self.cmb_planos.configure(state="disabled")
+            self.cmb_exportacao.configure(state="disabled")
+            self.chk_blocos.configure(state="disabled")
+            self.amostra_entry.configure(state="disabled")
+            self.semente_entry.configure(state="disabled")
+            self.chk_planejador.configure(state="disabled")
             self.progress.start(12)
         else:
             self.progress.stop()
+            self.lbl_andamento.configure(text="")
             self._refresh_params_visibility()
 
     def _refresh_params_visibility(self):
@@ -1182,6 +6926,198 @@ class App(tk.Tk):
         self.dt_fim_entry.configure(state=("normal" if is_cpc else "disabled"))
         self.min_div_entry.configure(state=("normal" if is_maiores else "disabled"))
 
+        sql_template = QUERIES[q][0] if q in QUERIES else ""
+        self._atualizar_label_colunas()
+        self._atualizar_label_filtros()
+        self.chk_valores_cliente.configure(
+            state=("normal" if _suporta_valores_cliente(sql_template) else "disabled")
+        )
+        self.chk_indice_segmentos.configure(
+            state=("normal" if _usa_indice_segmentos(sql_template) else "disabled")
+        )
+        self.cmb_antijoin.configure(state=("readonly" if _modo_antijoin(sql_template) else "disabled"))
+        self.chk_superbase.configure(state=("normal" if _superbase_alvo(sql_template) else "disabled"))
+        self.chk_cache.configure(state="normal")
+        self.chk_cpc_rollup.configure(state=("normal" if is_cpc else "disabled"))
+
+        idade = idade_replica_min([c for _, c in CARTEIRAS])
+        self.chk_replica.configure(
+            state=("normal" if os.path.exists(REPLICA_DB_PATH) else "disabled"),
+            text=(
+                "Executar na réplica local (sem carga na produção)"
+                + (f" - sincronizada há {idade:.0f} min" if idade is not None else "")
+            ),
+        )
+
+        self.chk_staging.configure(state=("normal" if _usa_staging(sql_template) else "disabled"))
+        self.cmb_planos.configure(state="readonly")
+        self.cmb_exportacao.configure(state="readonly")
+        self.chk_blocos.configure(state=("normal" if _motivo_sem_blocos(sql_template) is None else "disabled"))
+        amostra_ok = amostra_aplicavel(sql_template)
+        self.amostra_entry.configure(state=("normal" if amostra_ok else "disabled"))
+        self.semente_entry.configure(state=("normal" if amostra_ok else "disabled"))
+        self.chk_planejador.configure(state="normal")
+
+    def _colunas_da_consulta(self, query_name: str) -> list[str]:
+        """Colunas escolhidas que a base ainda tem (vazio = todas)."""
+        disponiveis = colunas_da_base(QUERIES[query_name][0])
+        escolhidas = {c.lower() for c in self.colunas_escolhidas.get(query_name, [])}
+        return [c for c in disponiveis if c.lower() in escolhidas]
+
+    def _atualizar_label_colunas(self):
+        q = self.query_var.get()
+        if q not in QUERIES:
+            return
+        total = len(colunas_da_base(QUERIES[q][0]))
+        escolhidas = self._colunas_da_consulta(q)
+        if escolhidas and len(escolhidas) < total:
+            texto = f"{len(escolhidas)} de {total} colunas: {', '.join(escolhidas)}"
+            if len(texto) > 90:
+                texto = texto[:87] + "..."
+        else:
+            texto = f"Todas as {total} colunas"
+        self.lbl_colunas.configure(text=texto)
+
+    def _escolher_colunas(self):
+        q = self.query_var.get()
+        disponiveis = colunas_da_base(QUERIES[q][0])
+        marcadas = set(self._colunas_da_consulta(q)) or set(disponiveis)
+
+        win = tk.Toplevel(self)
+        win.title(f"Colunas - {q}")
+        win.transient(self)
+        win.grab_set()
+        win.configure(background="#f6f7fb")
+
+        frame = ttk.Frame(win, style="App.TFrame", padding=12)
+        frame.grid(row=0, column=0, sticky="nsew")
+        ttk.Label(
+            frame,
+            text="Só as colunas marcadas vêm do banco (junções e CTEs sem uso deixam de rodar).",
+            style="Hint.TLabel",
+        ).grid(row=0, column=0, columnspan=3, sticky="w", pady=(0, 8))
+
+        vars_ = []
+        for i, col in enumerate(disponiveis):
+            var = tk.BooleanVar(value=col in marcadas)
+            ttk.Checkbutton(frame, text=col, variable=var).grid(row=1 + i // 3, column=i % 3, sticky="w", padx=(0, 18))
+            vars_.append((col, var))
+
+        def marcar(valor: bool):
+            for _, var in vars_:
+                var.set(valor)
+
+        def confirmar():
+            escolhidas = [c for c, var in vars_ if var.get()]
+            if not escolhidas:
+                messagebox.showwarning("Atenção", "Marque ao menos uma coluna.", parent=win)
+                return
+            if len(escolhidas) == len(disponiveis):
+                self.colunas_escolhidas.pop(q, None)
+            else:
+                self.colunas_escolhidas[q] = escolhidas
+            salvar_colunas_escolhidas(self.colunas_escolhidas)
+            self._atualizar_label_colunas()
+            win.destroy()
+
+        botoes = ttk.Frame(frame, style="App.TFrame")
+        botoes.grid(row=2 + (len(disponiveis) - 1) // 3, column=0, columnspan=3, sticky="w", pady=(12, 0))
+        ttk.Button(botoes, text="Todas", style="Secondary.TButton", command=lambda: marcar(True)).grid(row=0, column=0)
+        ttk.Button(botoes, text="Nenhuma", style="Secondary.TButton", command=lambda: marcar(False)).grid(
+            row=0, column=1, padx=(8, 0)
+        )
+        ttk.Button(botoes, text="OK", style="Primary.TButton", command=confirmar).grid(row=0, column=2, padx=(8, 0))
+
+    def _filtros_da_consulta(self, sql_template: str) -> dict:
+        """Filtros digitados que a base aceita, já interpretados (ValueError se algum for inválido)."""
+        aplicaveis = filtros_aplicaveis(sql_template)
+        filtros = {}
+        for campo, texto in self.filtros_texto.items():
+            valor = interpretar_filtro(campo, texto)
+            if valor is not None and campo in aplicaveis:
+                filtros[campo] = valor
+        return filtros
+
+    def _atualizar_label_filtros(self):
+        q = self.query_var.get()
+        if q not in QUERIES:
+            return
+        try:
+            filtros = self._filtros_da_consulta(QUERIES[q][0])
+        except ValueError as e:
+            self.lbl_filtros.configure(text=str(e))
+            return
+        ignorados = [
+            FILTROS_CAMPOS[c][0] for c, t in self.filtros_texto.items() if t.strip() and c not in filtros
+        ]
+        texto = descrever_filtros(filtros) if filtros else "Sem filtros (a base vem inteira)"
+        if ignorados:
+            texto += f" | não se aplica: {', '.join(ignorados)}"
+        self.lbl_filtros.configure(text=texto if len(texto) <= 110 else texto[:107] + "...")
+
+    def _escolher_filtros(self):
+        win = tk.Toplevel(self)
+        win.title("Filtros na origem")
+        win.transient(self)
+        win.grab_set()
+        win.configure(background="#f6f7fb")
+
+        frame = ttk.Frame(win, style="App.TFrame", padding=12)
+        frame.grid(row=0, column=0, sticky="nsew")
+        ttk.Label(
+            frame,
+            text="As linhas são cortadas no banco. Campo vazio = sem filtro; faixas: início..fim.",
+            style="Hint.TLabel",
+        ).grid(row=0, column=0, columnspan=3, sticky="w", pady=(0, 8))
+
+        vars_ = {}
+        for i, (campo, (rotulo, _, _, tipo)) in enumerate(FILTROS_CAMPOS.items(), start=1):
+            ttk.Label(frame, text=f"{rotulo}:").grid(row=i, column=0, sticky="w", pady=(4, 0))
+            var = tk.StringVar(value=self.filtros_texto.get(campo, ""))
+            ttk.Entry(frame, textvariable=var, width=30).grid(row=i, column=1, sticky="w", padx=(8, 8), pady=(4, 0))
+            ttk.Label(frame, text=f"Ex.: {FILTROS_EXEMPLOS[tipo]}", style="Hint.TLabel").grid(
+                row=i, column=2, sticky="w", pady=(4, 0)
+            )
+            vars_[campo] = var
+
+        def confirmar():
+            try:
+                for campo, var in vars_.items():
+                    interpretar_filtro(campo, var.get())
+            except ValueError as e:
+                messagebox.showerror("Filtro inválido", str(e), parent=win)
+                return
+            self.filtros_texto = {c: v.get().strip() for c, v in vars_.items() if v.get().strip()}
+            self._atualizar_label_filtros()
+            win.destroy()
+
+        def limpar():
+            for var in vars_.values():
+                var.set("")
+
+        botoes = ttk.Frame(frame, style="App.TFrame")
+        botoes.grid(row=len(FILTROS_CAMPOS) + 1, column=0, columnspan=3, sticky="w", pady=(12, 0))
+        ttk.Button(botoes, text="Limpar", style="Secondary.TButton", command=limpar).grid(row=0, column=0)
+        ttk.Button(botoes, text="OK", style="Primary.TButton", command=confirmar).grid(row=0, column=1, padx=(8, 0))
+
+    def _atualizar_status_staging(self):
+        def job():
+            try:
+                st = status_staging()
+            except Exception:
+                texto = "Staging: indisponível"
+            else:
+                if st is None:
+                    texto = "Staging: ainda não criado (rode --atualizar-staging; até lá lê das tabelas de origem)"
+                else:
+                    texto = (
+                        f"Staging: atualizado há {float(st['idade_min'].max()):.0f} min "
+                        f"(último refresh levou {float(st['duracao_s'].sum()):.0f} s)"
+                    )
+            self.after(0, lambda: self.lbl_staging.configure(text=texto))
+
+        threading.Thread(target=job, daemon=True).start()
+
     # -------------------------
     # Actions
     # -------------------------
@@ -1193,6 +7129,20 @@ class App(tk.Tk):
         self.dt_ini_var.set("")
         self.dt_fim_var.set("")
         self.min_div_var.set("")
+        self.valores_cliente_var.set(False)
+        self.indice_segmentos_var.set(False)
+        self.antijoin_var.set(ANTIJOIN_OPCOES[0][0])
+        self.superbase_var.set(False)
+        self.cpc_rollup_var.set(False)
+        self.replica_var.set(False)
+        self.staging_var.set(False)
+        self.planos_var.set(PLANOS_OPCOES[0][0])
+        self.exportacao_var.set(EXPORTACAO_OPCOES[0][0])
+        self.blocos_var.set(False)
+        self.filtros_texto = {}
+        self.amostra_var.set("")
+        self.semente_var.set(AMOSTRA_SEMENTE_PADRAO)
+        self.planejador_var.set(False)
 
         self.query_listbox.selection_clear(0, tk.END)
         self.query_listbox.selection_set(0)
@@ -1207,7 +7157,7 @@ class App(tk.Tk):
             dt_ini = self.dt_ini_var.get().strip()
             dt_fim = self.dt_fim_var.get().strip()
 
-            extra = {"_tail_params": [], "hist_cad_ref_col": HIST_CAD_REF_COL}
+            extra = {"_tail_params": [], "hist_cad_ref_col": HIST_CAD_REF_COL, "_dt_ini": dt_ini, "_dt_fim": dt_fim}
 
             if dt_ini:
                 if not _is_valid_ymd(dt_ini):
@@ -1239,6 +7189,46 @@ class App(tk.Tk):
 
         return {}
 
+    def _aplicar_opcoes_execucao(self, sql_template: str, extra: dict):
+        if self.valores_cliente_var.get() and _suporta_valores_cliente(sql_template):
+            extra["_valores_cliente"] = True
+        if self.indice_segmentos_var.get() and _usa_indice_segmentos(sql_template):
+            extra["_indice_segmentos"] = True
+        antijoin = dict(ANTIJOIN_OPCOES).get(self.antijoin_var.get())
+        if antijoin and _modo_antijoin(sql_template):
+            extra["_antijoin"] = antijoin
+        if self.superbase_var.get() and _superbase_alvo(sql_template):
+            extra["_superbase"] = True
+        if self.cache_var.get():
+            extra["_cache"] = True
+        if self.cpc_rollup_var.get() and sql_template == SQL_CPC_PERIODO:
+            extra["_cpc_rollup"] = True
+        if self.replica_var.get():
+            extra["_replica"] = True
+        if self.staging_var.get() and _usa_staging(sql_template):
+            extra["_staging"] = True
+        planos = dict(PLANOS_OPCOES).get(self.planos_var.get())
+        if planos:
+            extra["_planos"] = planos
+        exportacao = dict(EXPORTACAO_OPCOES).get(self.exportacao_var.get())
+        if exportacao:
+            checar_exportacao(exportacao)
+            extra["_exportacao"] = exportacao
+        if self.blocos_var.get() and _motivo_sem_blocos(sql_template) is None:
+            extra["_blocos"] = True
+        colunas = self._colunas_da_consulta(self.query_var.get())
+        if colunas and len(colunas) < len(colunas_da_base(sql_template)):
+            extra["_colunas"] = colunas
+        filtros = self._filtros_da_consulta(sql_template)
+        if filtros:
+            extra["_filtros"] = filtros
+        if amostra_aplicavel(sql_template):
+            amostra = interpretar_amostra(self.amostra_var.get(), self.semente_var.get())
+            if amostra:
+                extra["_amostra"] = amostra
+        if self.planejador_var.get():
+            extra["_planejador"] = True
+
     def gerar_excel(self):
         carteiras = [c for v, c in self.carteira_vars if v.get()]
         if not carteiras:
@@ -1259,6 +7249,8 @@ class App(tk.Tk):
 
         try:
             extra = self._build_extra_for_selected_query(query_name)
+            self._aplicar_opcoes_execucao(sql_template, extra)
+            extra["_nome_consulta"] = query_name
         except Exception as e:
             messagebox.showerror("Erro", str(e))
             return
@@ -1266,41 +7258,379 @@ class App(tk.Tk):
         self._set_busy(True)
 
         t = threading.Thread(
-            target=self._job_gerar_excel,
+            target=self._job_preflight,
             args=(sql_template, carteiras, extra, path, sheet_name),
             daemon=True
         )
         t.start()
 
-    def _job_gerar_excel(self, sql_template, carteiras, extra, path, sheet_name):
+    def _job_preflight(self, sql_template, carteiras, extra, path, sheet_name):
+        plano = None
+        if extra.get("_planejador") and not SERVIDOR_URL:
+            try:
+                plano = planejar(sql_template, carteiras, extra)
+                aplicar_plano(extra, plano)
+            except Exception:
+                plano = None  # sem histórico legível: segue com as opções da tela
         try:
-            df = run_query(sql_template, carteiras, extra=extra)
+            # Com servidor de jobs a estação nem abre conexão com o banco
+            decisao = {"acao": None, "motivo": "", "linhas_est": None} if SERVIDOR_URL else preflight(sql_template, carteiras, extra)
+        except Exception as e:
+            # Pre-flight é só proteção: se o EXPLAIN falhar, segue como antes
+            decisao = {"acao": None, "motivo": f"Pre-flight indisponível: {e}", "linhas_est": None}
+        decisao["plano"] = plano
+        self.after(0, self._on_preflight, decisao, sql_template, carteiras, extra, path, sheet_name)
+
+    def _on_preflight(self, decisao, sql_template, carteiras, extra, path, sheet_name):
+        nota = ""
+        extra["_linhas_est"] = decisao.get("linhas_est")
+        if decisao.get("plano"):
+            nota = descrever_plano(decisao["plano"])
+            self.lbl_andamento.configure(text=nota)
+
+        if decisao["acao"] == "avisar":
+            if not messagebox.askyesno("Consulta pesada", f"{decisao['motivo']}\n\nExecutar mesmo assim?"):
+                self._set_busy(False)
+                return
+        elif decisao["acao"] == "fila":
+            enfileirar(extra["_nome_consulta"], carteiras, extra, path)
+            self._set_busy(False)
+            messagebox.showinfo(
+                "Enviada para a fila",
+                f"{decisao['motivo']}\n\nHorário de pico ({HORARIO_PICO[0]}h-{HORARIO_PICO[1]}h): o pedido "
+                f"foi para a fila e será gerado fora do pico em:\n{path}",
+            )
+            return
+        elif decisao["acao"] == "alternativa":
+            extra.update(decisao["alternativa"])
+            nota = "\n".join(filter(None, [
+                nota, f"{decisao['motivo']}\nEstratégia trocada automaticamente: {', '.join(decisao['alternativa'])}"
+            ]))
 
-            # (Opção 10) Excel bonitinho
-            _write_excel_pretty(df, path, sheet_name)
+        t = threading.Thread(
+            target=self._job_gerar_excel,
+            args=(sql_template, carteiras, extra, path, sheet_name, nota),
+            daemon=True
+        )
+        t.start()
 
-            self.after(0, self._on_job_success, path, len(df))
+    def _job_gerar_excel(self, sql_template, carteiras, extra, path, sheet_name, nota=""):
+        try:
+            with _registrando_execucao(extra.get("_nome_consulta") or _nome_consulta(sql_template), carteiras, extra) as reg:
+                if SERVIDOR_URL:
+                    df = run_query_remoto(extra["_nome_consulta"], carteiras, extra, ao_evento=self._andamento_servidor)
+                else:
+                    with _avisando_admissao(self._andamento_admissao):
+                        df = run_query(sql_template, carteiras, extra=extra)
+
+                # (Opção 10) Excel bonitinho
+                with _etapa("excel"):
+                    caminhos = exportar(df, path, sheet_name, extra.get("_exportacao"), ao_copiar=self._on_copia)
+                reg["bytes"] = sum(_tamanho_exportado(p) for p in caminhos)
+
+            if extra.get("_amostra"):
+                nota = "\n".join(filter(None, [nota, f"Amostra: {resumo_amostra(df, extra['_amostra']['n'])}"]))
+            self.after(0, self._on_job_success, caminhos, len(df), nota)
 
         except FileNotFoundError as e:
             self.after(0, self._on_job_error, "Credenciais não encontradas", str(e))
 
         except mysql.connector.Error as e:
-            self.after(0, self._on_job_error, "Erro no banco", f"Falha ao conectar/consultar:\n{e}")
+            self.after(0, self._on_job_error, "Erro no banco", f"Falha ao conectar/consultar:\n{_texto_erro(e)}")
 
         except Exception as e:
             self.after(0, self._on_job_error, "Erro", str(e))
 
-    def _on_job_success(self, path: str, n_rows: int):
+    def _andamento_servidor(self, ev: dict):
+        if ev["evento"] == "aceito":
+            texto = "Servidor: mesma base já em execução, aguardando" if ev["coalescido"] else "Servidor: executando"
+        elif ev["evento"] == "aguardando" and ev.get("fila"):
+            texto = f"Servidor: {ev['fila']}"
+        elif ev["evento"] == "aguardando":
+            texto = f"Servidor: {ev['segundos']} s ({ev['clientes']} pedido(s) nesta execução)"
+        elif ev["evento"] == "colunas":
+            texto = "Servidor: recebendo linhas"
+        else:
+            texto = f"Servidor: {ev.get('linhas', 0)} linhas recebidas"
+        self.after(0, lambda: self.lbl_andamento.configure(text=texto))
+
+    def _andamento_admissao(self, texto: str):
+        self.after(0, lambda: self.lbl_andamento.configure(text=texto))
+
+    def _on_copia(self, envio: dict):
+        self.after(0, self._mostrar_copia, envio)
+
+    def _mostrar_copia(self, envio: dict):
+        if envio["estado"] == "erro":
+            messagebox.showerror("Cópia para o destino", resumo_envios([envio["destino"]]))
+        self.lbl_andamento.configure(text=resumo_envios(self._ultimos_caminhos, descartar=True).split("\n")[0])
+
+    def _on_job_success(self, caminhos: list[str], n_rows: int, nota: str = ""):
         self._set_busy(False)
-        messagebox.showinfo("Sucesso", f"Excel gerado com sucesso!\n\nLinhas: {n_rows}\n\n{path}")
+        self._ultimos_caminhos = caminhos
+        copiando = envios_pendentes(caminhos)
+        self.lbl_andamento.configure(text=resumo_envios(caminhos, descartar=True).split("\n")[0])
+        self._atualizar_status_staging()
+        self._recarregar_historico_se_visivel()
+        msg = f"Excel gerado com sucesso!\n\nLinhas: {n_rows}\n\n" + "\n".join(caminhos)
+        if copiando:
+            msg += "\n\nO arquivo já está pronto localmente; a cópia para o destino segue em segundo plano."
+        messagebox.showinfo("Sucesso", f"{msg}\n\n{nota}" if nota else msg)
 
     def _on_job_error(self, title: str, msg: str):
         self._set_busy(False)
         messagebox.showerror(title, msg)
 
 
-if __name__ == "__main__":
+# =========================
+# Linha de comando (sem UI)
+# =========================
+def _relatar_envios(caminhos: list[str]) -> int:
+    """Espera as cópias para o destino e mostra o resultado; 1 se alguma falhou."""
+    if envios_pendentes(caminhos):
+        print("Copiando para o destino...")
+    envios = aguardar_envios(caminhos)
+    print(resumo_envios(caminhos, descartar=True))
+    return 1 if any(e["estado"] == "erro" for e in envios) else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Gerador de Bases - Itapeva")
+    parser.add_argument("--atualizar-segmentos", action="store_true",
+                        help="Atualiza o índice local de segmentos (bitmaps de cod_cad) e sai.")
+    parser.add_argument("--atualizar-rollup-cpc", action="store_true",
+                        help="Atualiza o rollup diário local de CPC (incremental) e sai.")
+    parser.add_argument("--sincronizar-replica", action="store_true",
+                        help="Atualiza a réplica local (SQLite) das carteiras e sai.")
+    parser.add_argument("--atualizar-staging", action="store_true",
+                        help=f"Atualiza as tabelas-resumo do schema {STAGING_SCHEMA} (incremental; para agendar) e sai.")
+    parser.add_argument("--completo", action="store_true",
+                        help="Com --atualizar-staging / --atualizar-segmentos: recarrega tudo do zero.")
+    parser.add_argument("--relatorio-planos", metavar="CONSULTA", nargs="?", const="",
+                        help="Mostra os planos capturados e o que mudou entre execuções (todas as bases ou só CONSULTA).")
+    parser.add_argument("--relatorio-historico", action="store_true",
+                        help="Mostra p50/p95 semanais da duração de cada base e alertas de regressão.")
+    parser.add_argument("--indices", action="store_true",
+                        help="Compara os índices que os templates pedem com os existentes (STATISTICS + EXPLAIN) e sai.")
+    parser.add_argument("--lint", metavar="SEVERIDADE", nargs="?", const="baixa", choices=LINT_SEVERIDADES,
+                        help=f"Verifica anti-padrões nos templates SQL (mostra a partir de SEVERIDADE); "
+                             f"sai com 1 se houver achado >= {LINT_SEVERIDADE_GATE} fora de LINT_ACEITOS.")
+    parser.add_argument("--preaquecer", action="store_true",
+                        help="Recalcula no cache de resultados as bases da manhã (PREAQUECER ou preaquecer.json) e sai.")
+    parser.add_argument("--preaquecer-as", metavar="HH:MM",
+                        help="Fica rodando e pré-aquece o cache todo dia útil às HH:MM.")
+    parser.add_argument("--processar-fila", action="store_true",
+                        help="Gera os pedidos que o pre-flight mandou para a fila (agendar fora do pico) e sai.")
+    parser.add_argument("--segmentos", metavar="EXPR",
+                        help='Gera um público por expressão de segmentos, ex.: "(ativos_517 | ativos_518) - contatados_30d"')
+    parser.add_argument("--saida", metavar="ARQUIVO.xlsx", help="Arquivo de saída para --segmentos/--consulta.")
+    parser.add_argument("--superbase", metavar="PASTA",
+                        help="Gera Recentes, Nunca e Quebras de uma leitura só da super-base, na pasta informada.")
+    parser.add_argument("--consulta", metavar="NOME",
+                        help="Gera uma base de QUERIES sem abrir a tela (exige --saida).")
+    parser.add_argument("--exportacao", choices=[m for _, m in EXPORTACAO_OPCOES if m],
+                        help="Com --consulta: um arquivo por carteira ou partes por faixa de linhas, em paralelo.")
+    parser.add_argument("--colunas", nargs="+", metavar="COLUNA",
+                        help="Com --consulta: só essas colunas (o SELECT final e as junções sem uso são podados).")
+    parser.add_argument("--filtro", action="append", default=[], metavar="CAMPO=VALOR",
+                        help=f"Com --consulta: filtro na origem, repetível. Campos: {', '.join(FILTROS_CAMPOS)}. "
+                             'Ex.: --filtro portfolio=A,B --filtro data_cad=2025-01-01.. --filtro "valor=10.000,00.."')
+    parser.add_argument("--amostra", type=int, metavar="N",
+                        help="Com --consulta: amostra de N cadastros por carteira/portfolio, sorteada no banco.")
+    parser.add_argument("--semente", default=AMOSTRA_SEMENTE_PADRAO,
+                        help="Semente da --amostra (a mesma semente devolve a mesma amostra).")
+    parser.add_argument("--planejar", action="store_true",
+                        help="Com --consulta: a estratégia (única, por carteira, faixas, staging, réplica) sai do histórico.")
+    parser.add_argument("--blocos", action="store_true",
+                        help="Com --consulta: lê em faixas de cod_cad com checkpoints (rodar de novo retoma de onde parou).")
+    parser.add_argument("--gravar", action="store_true",
+                        help=f"Grava os resultados do banco em {GRAVACAO_DIR} (dados pessoais com hash) para replay.")
+    parser.add_argument("--replay", metavar="RITMO", nargs="?", const="rapido", choices=REPLAY_RITMOS,
+                        help="Usa as gravações no lugar do banco (rapido ou no ritmo gravado).")
+    parser.add_argument("--replay-substituir", action="store_true",
+                        help="Com --replay: sem gravação para os parâmetros, usa a mais recente do mesmo SQL "
+                             "(avisa cada troca).")
+    parser.add_argument("--servidor", metavar="HOST:PORTA", nargs="?", const="",
+                        help=f"Sobe o servidor de jobs (padrão 127.0.0.1:{SERVIDOR_PORTA_PADRAO}); pedidos iguais "
+                             "em andamento viram uma execução só.")
+    parser.add_argument("--usar-servidor", metavar="URL",
+                        help="Executa as bases no servidor de jobs (tela e --consulta); o mesmo que GERADOR_SERVIDOR.")
+    parser.add_argument("--carteiras", type=int, nargs="+", default=[c for _, c in CARTEIRAS],
+                        help="Carteiras (padrão: todas).")
+    args = parser.parse_args(argv)
+
+    global DRIVER_MODO, REPLAY_RITMO, REPLAY_SUBSTITUIR, SERVIDOR_URL
+    if args.gravar and args.replay:
+        parser.error("--gravar e --replay são exclusivos.")
+    if args.gravar:
+        DRIVER_MODO = "gravar"
+    if args.replay_substituir and not args.replay:
+        parser.error("--replay-substituir só vale com --replay.")
+    if args.replay:
+        DRIVER_MODO, REPLAY_RITMO = "replay", args.replay
+        REPLAY_SUBSTITUIR = REPLAY_SUBSTITUIR or args.replay_substituir
+    if args.usar_servidor:
+        SERVIDOR_URL = args.usar_servidor
+
+    if args.servidor is not None:
+        try:
+            servir(args.servidor)
+        except ValueError as e:
+            parser.error(f"--servidor: {e}")
+        return 0
+
+    if args.completo and not (args.atualizar_staging or args.atualizar_segmentos):
+        parser.error("--completo só vale com --atualizar-staging ou --atualizar-segmentos.")
+    if args.atualizar_segmentos:
+        for nome, qtd in sorted(atualizar_segmentos(completo=args.completo).items()):
+            print(f"{nome:<20} {qtd:>10}")
+        return 0
+
+    if args.atualizar_rollup_cpc:
+        print(f"Linhas (cod_cad, dia) lidas: {atualizar_rollup_cpc()}")
+        return 0
+
+    if args.sincronizar_replica:
+        for tabela, qtd in sincronizar_replica(args.carteiras).items():
+            print(f"{tabela:<15} {qtd:>10}")
+        return 0
+
+    if args.atualizar_staging:
+        duracoes = atualizar_staging(completo=args.completo)
+        if duracoes is None:
+            print("Outra estação está atualizando o staging agora; nada feito.")
+            return 1
+        for tabela, seg in duracoes.items():
+            print(f"{tabela:<20} {seg:>8.1f} s")
+        return 0
+
+    if args.relatorio_planos is not None:
+        print(relatorio_planos(args.relatorio_planos or None))
+        return 0
+
+    if args.relatorio_historico:
+        print(relatorio_historico())
+        return 0
+
+    if args.indices:
+        print(relatorio_indices(args.carteiras))
+        return 0
+
+    if args.lint is not None:
+        texto, codigo = relatorio_lint(args.lint)
+        print(texto)
+        return codigo
+
+    if args.preaquecer_as:
+        try:
+            _proximo_horario(args.preaquecer_as)
+        except ValueError:
+            parser.error("--preaquecer-as: use HH:MM, ex.: 05:30")
+        try:
+            agendar_preaquecimento(args.preaquecer_as)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.preaquecer:
+        feitos = preaquecer()
+        for consulta, carteiras, resultado in feitos:
+            print(f"{consulta} {carteiras}: {resultado}")
+        return 1 if any(r.startswith("erro") for _, _, r in feitos) else 0
+
+    if args.processar_fila:
+        for pedido, resultado in processar_fila():
+            print(f"{pedido}: {resultado}")
+        return 0
+
+    if args.consulta:
+        if args.consulta not in QUERIES:
+            parser.error(f"--consulta: base desconhecida. Opções: {', '.join(QUERIES)}")
+        if not args.saida:
+            parser.error("--consulta exige --saida.")
+        sql_template, _, sheet_name = QUERIES[args.consulta]
+        extra = {**_extra_exemplo(args.consulta), "_nome_consulta": args.consulta, "_exportacao": args.exportacao}
+        try:
+            checar_exportacao(args.exportacao)
+        except ValueError as e:
+            parser.error(f"--exportacao: {e}")
+        if args.blocos:
+            motivo = _motivo_sem_blocos(sql_template)
+            if motivo:
+                parser.error(f"--blocos: {args.consulta} não pode ser lida em faixas ({motivo}).")
+            extra["_blocos"] = True
+        if args.colunas:
+            disponiveis = {c.lower() for c in colunas_da_base(sql_template)}
+            desconhecidas = [c for c in args.colunas if c.lower() not in disponiveis]
+            if desconhecidas:
+                parser.error(f"--colunas: {args.consulta} não tem {', '.join(desconhecidas)}. "
+                             f"Opções: {', '.join(colunas_da_base(sql_template))}")
+            extra["_colunas"] = args.colunas
+        for item in args.filtro:
+            campo, _, texto = item.partition("=")
+            if campo not in FILTROS_CAMPOS:
+                parser.error(f"--filtro: campo desconhecido {campo!r}. Campos: {', '.join(FILTROS_CAMPOS)}")
+            if campo not in filtros_aplicaveis(sql_template):
+                parser.error(f"--filtro: {campo} não se aplica a {args.consulta}.")
+            try:
+                valor = interpretar_filtro(campo, texto)
+            except ValueError as e:
+                parser.error(f"--filtro: {e}")
+            if valor is not None:
+                extra.setdefault("_filtros", {})[campo] = valor
+        if args.amostra is not None:
+            if not amostra_aplicavel(sql_template):
+                parser.error(f"--amostra: {args.consulta} não parte de cadastros_tb.")
+            try:
+                extra["_amostra"] = interpretar_amostra(str(args.amostra), args.semente)
+            except ValueError as e:
+                parser.error(f"--amostra: {e}")
+        if args.planejar:
+            extra["_planejador"] = True
+            if not SERVIDOR_URL:
+                plano = planejar(sql_template, args.carteiras, extra)
+                aplicar_plano(extra, plano)
+                print(descrever_plano(plano))
+        with _registrando_execucao(args.consulta, args.carteiras, extra) as reg:
+            if SERVIDOR_URL:
+                df = run_query_remoto(args.consulta, args.carteiras, extra)
+            else:
+                with _avisando_admissao(lambda texto: texto and print(texto)):
+                    df = run_query(sql_template, args.carteiras, extra=extra)
+            with _etapa("excel"):
+                caminhos = exportar(df, args.saida, sheet_name, args.exportacao)
+            reg["bytes"] = sum(_tamanho_exportado(p) for p in caminhos)
+        if extra.get("_amostra"):
+            print(f"Amostra: {resumo_amostra(df, extra['_amostra']['n'])}")
+        print(f"Linhas: {len(df)} -> {', '.join(caminhos)}")
+        return _relatar_envios(caminhos)
+
+    if args.segmentos:
+        if not args.saida:
+            parser.error("--segmentos exige --saida.")
+        try:
+            df = publico_por_segmentos(args.segmentos)
+        except ValueError as e:
+            parser.error(f"--segmentos: {e}")
+        caminhos = exportar(df, args.saida, "Segmentos")
+        print(f"Linhas: {len(df)} -> {args.saida}")
+        return _relatar_envios(caminhos)
+
+    if args.superbase:
+        os.makedirs(args.superbase, exist_ok=True)
+        caminhos = []
+        for alvo, df in gerar_superbase_todas(args.carteiras).items():
+            path = os.path.join(args.superbase, f"base_{alvo}.xlsx")
+            caminhos += exportar(df, path, alvo.capitalize())
+            print(f"{alvo:<10} linhas: {len(df)} -> {path}")
+        return _relatar_envios(caminhos)
+
     print("ARQUIVO RODANDO:", os.path.abspath(__file__))
     print("TOTAL QUERIES:", len(QUERIES))
     print("LISTA QUERIES:", list(QUERIES.keys()))
     App().mainloop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,160 @@
+"""
+Benchmark dos backends de exportação Excel (EXCEL_WRITERS do Gerador_base).
+
+Gera DataFrames com as colunas do SELECT final de cada base de QUERIES (tipos e tamanhos
+de texto deduzidos pelo nome da coluna, com uma fração de nulos) e mede, por backend:
+tempo, linhas/s, MB/s do arquivo gerado e pico de memória (tracemalloc, em uma segunda
+rodada para não distorcer o tempo). Os resultados vão para BENCH_CSV_PATH e cada linha
+é comparada com a medição anterior do mesmo backend/base/tamanho.
+
+    python bench_excel.py
+    python bench_excel.py --linhas 10000 100000 --consultas "Nunca Contatados" --writers openpyxl
+"""
+import argparse
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import Gerador_base as gb
+
+
+BENCH_LINHAS = (10_000, 100_000, 1_000_000)
+BENCH_NULOS = 0.1
+BENCH_SEMENTE = 42
+BENCH_CSV_PATH = os.path.join(gb.LOCAL_DATA_DIR, "bench_excel.csv")
+
+# Tamanho típico dos textos, pelo nome da coluna (primeiro padrão que casar)
+_TAMANHOS_TEXTO = [
+    (r"cpf|cnpj", 14),
+    (r"email", 28),
+    (r"fone|telefone", 11),
+    (r"obs", 40),
+    (r"nome", 32),
+    (r"contratos|tipoproduto|marcamodelo|garantia", 60),
+    (r"placa", 7),
+    (r"portfolio|infoad", 12),
+]
+_RE_DATA = re.compile(r"^(data|dt_)|nascimento|nascto", re.IGNORECASE)
+_RE_INTEIRO = re.compile(r"^(cod_|qtd|num|status|tel_ok|_flag|_tem)|^n$", re.IGNORECASE)
+_RE_DINHEIRO = re.compile(r"valor|vlr|divida|parc", re.IGNORECASE)
+
+
+def _tipo_coluna(nome: str):
+    if _RE_DATA.search(nome):
+        return "data", None
+    if _RE_DINHEIRO.search(nome):
+        return "dinheiro", None
+    if _RE_INTEIRO.search(nome):
+        return "inteiro", None
+    for padrao, tamanho in _TAMANHOS_TEXTO:
+        if re.search(padrao, nome, re.IGNORECASE):
+            return "texto", tamanho
+    return "texto", 16
+
+
+def gerar_dataframe(colunas: list[str], linhas: int, nulos: float, semente: int) -> pd.DataFrame:
+    rng = np.random.default_rng(semente)
+    dados = {}
+    for nome in colunas:
+        tipo, tamanho = _tipo_coluna(nome)
+        if tipo == "inteiro":
+            serie = pd.Series(rng.integers(0, 10_000_000, linhas), dtype="Int64")
+        elif tipo == "dinheiro":
+            serie = pd.Series(np.round(rng.gamma(2.0, 2_500.0, linhas), 2))
+        elif tipo == "data":
+            base = np.datetime64("2015-01-01")
+            serie = pd.Series(base + rng.integers(0, 3_650, linhas).astype("timedelta64[D]"))
+        else:
+            # Pool de textos com tamanho variando em torno do típico: barato mesmo com 1M linhas
+            letras = np.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ abcdefghijklmnopqrstuvwxyz0123456789"))
+            tamanhos = np.clip(rng.normal(tamanho, tamanho / 4, 5_000).astype(int), 1, None)
+            pool = np.array(["".join(rng.choice(letras, t)) for t in tamanhos], dtype=object)
+            serie = pd.Series(pool[rng.integers(0, len(pool), linhas)], dtype=object)
+        if nulos > 0:
+            serie = serie.mask(rng.random(linhas) < nulos)
+        dados[nome] = serie
+    return pd.DataFrame(dados)
+
+
+def medir(writer, df: pd.DataFrame, sheet_name: str, memoria: bool) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.xlsx")
+        t0 = time.perf_counter()
+        writer(df, path, sheet_name)
+        segundos = time.perf_counter() - t0
+        tamanho = os.path.getsize(path)
+
+        pico_mb = None
+        if memoria:
+            os.remove(path)
+            tracemalloc.start()
+            try:
+                writer(df, path, sheet_name)
+                pico_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            finally:
+                tracemalloc.stop()
+
+    return {
+        "segundos": segundos,
+        "linhas_s": len(df) / segundos if segundos else None,
+        "mb_s": tamanho / (1024 * 1024) / segundos if segundos else None,
+        "bytes": tamanho,
+        "pico_mb": pico_mb,
+    }
+
+
+def _anterior(historico: pd.DataFrame, writer: str, consulta: str, linhas: int) -> pd.Series | None:
+    if historico.empty:
+        return None
+    sel = historico[(historico["writer"] == writer) & (historico["consulta"] == consulta) & (historico["linhas"] == linhas)]
+    return None if sel.empty else sel.iloc[-1]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark dos backends de exportação Excel")
+    parser.add_argument("--linhas", type=int, nargs="+", default=list(BENCH_LINHAS))
+    parser.add_argument("--consultas", nargs="+", default=list(gb.QUERIES), metavar="NOME")
+    parser.add_argument("--writers", nargs="+", default=list(gb.EXCEL_WRITERS), choices=list(gb.EXCEL_WRITERS))
+    parser.add_argument("--nulos", type=float, default=BENCH_NULOS, help="Fração de nulos por coluna.")
+    parser.add_argument("--semente", type=int, default=BENCH_SEMENTE)
+    parser.add_argument("--sem-memoria", action="store_true", help="Não faz a rodada com tracemalloc.")
+    args = parser.parse_args(argv)
+
+    historico = pd.read_csv(BENCH_CSV_PATH) if os.path.exists(BENCH_CSV_PATH) else pd.DataFrame()
+    resultados = []
+    for consulta in args.consultas:
+        sql_template, _, sheet_name = gb.QUERIES[consulta]
+        colunas = gb.colunas_da_base(sql_template)
+        for linhas in args.linhas:
+            df = gerar_dataframe(colunas, linhas, args.nulos, args.semente)
+            for nome in args.writers:
+                r = medir(gb.EXCEL_WRITERS[nome], df, sheet_name, memoria=not args.sem_memoria)
+                r.update(
+                    quando=gb._fmt_ts(pd.Timestamp.now()), writer=nome, consulta=consulta,
+                    linhas=linhas, colunas=len(colunas), nulos=args.nulos,
+                )
+                resultados.append(r)
+
+                ant = _anterior(historico, nome, consulta, linhas)
+                comp = f"  ({r['segundos'] / ant['segundos']:.2f}x o anterior)" if ant is not None else ""
+                pico = "-" if r["pico_mb"] is None else f"{r['pico_mb']:.0f} MB"
+                print(
+                    f"{nome:<10} {consulta[:34]:<34} {linhas:>9} x {len(colunas):<3} "
+                    f"{r['segundos']:>8.2f} s  {r['linhas_s']:>10,.0f} lin/s  {r['mb_s']:>6.2f} MB/s  pico {pico}{comp}"
+                )
+
+    os.makedirs(os.path.dirname(BENCH_CSV_PATH), exist_ok=True)
+    pd.DataFrame(resultados).to_csv(
+        BENCH_CSV_PATH, mode="a", header=not os.path.exists(BENCH_CSV_PATH), index=False
+    )
+    print(f"Resultados em {BENCH_CSV_PATH}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,74 @@
+"""
+Linter de SQL como porteira: os templates do repositório passam no gate (--lint sai com 0), e um
+template novo com anti-padrão de severidade >= LINT_SEVERIDADE_GATE fora de LINT_ACEITOS faz sair com 1.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Gerador_base as gb  # noqa: E402
+
+BLOQUEANTES = {
+    "funcao_em_filtro": """
+SELECT cad.cod_cad
+FROM cadastros_tb cad
+JOIN fones_tb tel ON tel.cod_cad = cad.cod_cad
+WHERE cad.cod_cli IN ({cod_cli})
+  AND CONCAT(tel.dddfone, tel.telefone) NOT REGEXP '(.)\\\\1{7}';
+""",
+    "not_in_correlacionado": """
+SELECT cad.cod_cad
+FROM cadastros_tb cad
+WHERE cad.cod_cli IN ({cod_cli})
+  AND cad.cod_cad NOT IN (SELECT h.cod_cli FROM hist_tb h WHERE h.cod_cli = cad.cod_cad);
+""",
+    "left_join_anulado": """
+SELECT cad.cod_cad
+FROM cadastros_tb cad
+LEFT JOIN acordos_tb a ON a.nmcont = cad.nmcont
+WHERE cad.cod_cli IN ({cod_cli})
+  AND a.staco = 'P';
+""",
+}
+
+
+def test_templates_passam_no_gate():
+    texto, codigo = gb.relatorio_lint(gb.LINT_SEVERIDADE_GATE)
+    assert codigo == 0, texto
+
+
+@pytest.mark.parametrize("regra", sorted(BLOQUEANTES))
+def test_template_novo_com_anti_padrao_bloqueia(monkeypatch, regra):
+    assert gb.LINT_REGRAS[regra][0] == gb.LINT_SEVERIDADE_GATE
+    monkeypatch.setattr(gb, "SQL_TESTE_LINT", BLOQUEANTES[regra], raising=False)
+    texto, codigo = gb.relatorio_lint(gb.LINT_SEVERIDADE_GATE)
+    assert codigo == 1
+    assert f"{regra} em SQL_TESTE_LINT" in texto
+    assert "1 bloqueante(s)" in texto
+
+
+def test_achado_aceito_nao_bloqueia(monkeypatch):
+    monkeypatch.setattr(gb, "SQL_TESTE_LINT", BLOQUEANTES["left_join_anulado"], raising=False)
+    monkeypatch.setitem(gb.LINT_ACEITOS, ("SQL_TESTE_LINT", "left_join_anulado"), "teste")
+    assert gb.relatorio_lint(gb.LINT_SEVERIDADE_GATE)[1] == 0
+
+
+def test_severidade_abaixo_do_gate_nao_bloqueia(monkeypatch):
+    sql = "SELECT cod_cad FROM cadastros_tb WHERE cod_cli IN ({cod_cli}) AND nomecli LIKE '%%SILVA%%';"
+    monkeypatch.setattr(gb, "SQL_TESTE_LINT", sql, raising=False)
+    texto, codigo = gb.relatorio_lint("baixa")
+    assert "like_curinga_inicial em SQL_TESTE_LINT" in texto
+    assert codigo == 0
+
+
+def test_anti_padrao_em_literal_ou_comentario_nao_conta():
+    sql = """
+SELECT 'CONCAT(a, b) REGEXP x' AS texto
+FROM cadastros_tb cad
+-- AND cad.cod_cad NOT IN (SELECT h.cod_cli FROM hist_tb h WHERE h.cod_cli = cad.cod_cad)
+WHERE cad.cod_cli IN ({cod_cli});
+"""
+    assert gb.lint_sql(sql) == []
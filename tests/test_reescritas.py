@@ -0,0 +1,152 @@
+"""
+Reescritas de template (projeção de colunas, faixas de cod_cad, filtros na origem e amostra)
+rodadas sobre todas as bases de QUERIES: o SQL sai balanceado, monta com build_sql_and_params
+(um parâmetro por %s), mantém as colunas e os predicados da base e não muda sem opção.
+"""
+import difflib
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Gerador_base as gb  # noqa: E402
+
+CARTEIRAS = [517, 518]
+BASES = sorted(gb.QUERIES)
+
+
+def _template(nome: str) -> str:
+    return gb.QUERIES[nome][0]
+
+
+def _montar(sql_template: str, extra: dict) -> tuple[str, list]:
+    sql, params = gb.build_sql_and_params(sql_template, CARTEIRAS, extra)
+    masc = gb._mascarar_sql(sql)
+    assert masc.count("(") == masc.count(")")
+    assert masc.count("%s") == len(params)
+    assert not re.search(r"\{\w+\}", masc), "placeholder sem valor"
+    return sql, params
+
+
+def _so_insercoes(original: str, reescrito: str):
+    """Nada do template some: o reescrito só acrescenta texto."""
+    for op, i1, i2, _, _ in difflib.SequenceMatcher(None, original, reescrito, autojunk=False).get_opcodes():
+        assert op in ("equal", "insert"), f"{op} de {original[i1:i2]!r}"
+
+
+def _where_final(sql: str) -> str:
+    """Condições do WHERE do SELECT final (texto mascarado, sem espaços repetidos)."""
+    final = gb._ultima_instrucao_select(sql)
+    masc = gb._mascarar_sql(final)
+    ini = gb._fim_do_nivel(masc, 0, ("WHERE",))
+    if not re.match(r"WHERE\b", masc[ini:], re.IGNORECASE):
+        return ""
+    fim = gb._fim_do_nivel(masc, ini + 5, gb._BLOCOS_PARADAS_WHERE[1:])
+    return " ".join(masc[ini:fim].split())
+
+
+# =========================
+# Projeção (_projetar / poda de junções e CTEs)
+# =========================
+@pytest.mark.parametrize("nome", BASES)
+def test_projetar_sem_colunas_nao_muda(nome):
+    assert gb._projetar(_template(nome), {}) == _template(nome)
+
+
+@pytest.mark.parametrize("nome", BASES)
+def test_projetar_todas_as_colunas(nome):
+    tpl = _template(nome)
+    colunas = gb.colunas_da_base(tpl)
+    sql = gb._projetar(tpl, {"_colunas": colunas})
+    assert gb.colunas_da_base(sql) == colunas
+    assert _where_final(sql) == _where_final(tpl)
+    _montar(sql, gb._extra_exemplo(nome))
+
+
+@pytest.mark.parametrize("nome", BASES)
+def test_projetar_cada_coluna(nome):
+    tpl = _template(nome)
+    ordem = gb._colunas_order_by_final(tpl)
+    for coluna in gb.colunas_da_base(tpl):
+        sql = gb._projetar(tpl, {"_colunas": [coluna]})
+        restantes = [c.lower() for c in gb.colunas_da_base(sql)]
+        assert coluna.lower() in restantes
+        assert set(restantes) <= {coluna.lower()} | ordem
+        assert _where_final(sql) == _where_final(tpl)
+        _montar(sql, gb._extra_exemplo(nome))
+
+
+# =========================
+# Faixas de cod_cad (_template_em_faixa)
+# =========================
+FAIXAS = [n for n in BASES if gb._motivo_sem_blocos(_template(n)) is None]
+
+
+@pytest.mark.parametrize("nome", FAIXAS)
+def test_template_em_faixa(nome):
+    tpl = _template(nome)
+    sql = gb._template_em_faixa(tpl, 1000, 1999)
+    assert "BETWEEN 1000 AND 1999" in sql
+    assert gb.colunas_da_base(sql) == gb.colunas_da_base(tpl)
+    _so_insercoes(tpl, sql)
+    # só literais: os parâmetros são os mesmos do template original
+    assert _montar(sql, gb._extra_exemplo(nome))[1] == _montar(tpl, gb._extra_exemplo(nome))[1]
+
+
+# =========================
+# Filtros na origem e amostra (_template_com_filtros)
+# =========================
+def _filtros_exemplo(nome: str) -> list[tuple[str, object]]:
+    return [
+        (campo, gb.interpretar_filtro(campo, gb.FILTROS_EXEMPLOS[gb.FILTROS_CAMPOS[campo][3]]))
+        for campo in gb.filtros_aplicaveis(_template(nome))
+    ]
+
+
+@pytest.mark.parametrize("nome", BASES)
+def test_filtros_sem_opcao_nao_muda(nome):
+    assert gb._template_com_filtros(_template(nome), {}) == (_template(nome), {})
+    assert gb.build_sql_and_params(_template(nome), CARTEIRAS, {**gb._extra_exemplo(nome), "_filtros": {}}) == \
+        gb.build_sql_and_params(_template(nome), CARTEIRAS, gb._extra_exemplo(nome))
+
+
+@pytest.mark.parametrize("nome", BASES)
+def test_cada_filtro(nome):
+    tpl = _template(nome)
+    for campo, valor in _filtros_exemplo(nome):
+        extra = {**gb._extra_exemplo(nome), "_filtros": {campo: valor}}
+        reescrito, valores = gb._template_com_filtros(tpl, extra)
+        assert valores
+        if campo == "portfolio":  # o gancho é preenchido, não acrescentado
+            _so_insercoes(tpl.replace("{infoad_filter}", "AND cad.infoad IN ({_v_portfolio})"), reescrito)
+        else:
+            _so_insercoes(tpl, reescrito)
+        assert gb.colunas_da_base(reescrito) == gb.colunas_da_base(tpl)
+        _montar(tpl, extra)
+
+
+@pytest.mark.parametrize("nome", [n for n in BASES if "{infoad_filter}" in _template(n)])
+def test_portfolio_uma_vez_por_escopo(nome):
+    extra = {**gb._extra_exemplo(nome), "_filtros": {"portfolio": ["A"]}}
+    reescrito, _ = gb._template_com_filtros(_template(nome), extra)
+    masc = gb._mascarar_sql(reescrito)
+    for m in re.finditer(r"\bWHERE\b", masc, re.IGNORECASE):
+        fim = gb._fim_do_nivel(masc, m.end(), gb._BLOCOS_PARADAS_WHERE[1:])
+        assert len(re.findall(r"\.infoad IN", gb._texto_no_nivel(masc[m.end():fim]))) <= 1
+
+
+@pytest.mark.parametrize("nome", [n for n in BASES if gb.amostra_aplicavel(_template(n))])
+def test_amostra(nome):
+    tpl = _template(nome)
+    extra = {**gb._extra_exemplo(nome), "_amostra": {"n": 100, "semente": "teste"}}
+    reescrito, valores = gb._template_com_filtros(tpl, extra)
+    assert valores["_v_amostra_n"] == [100]
+    assert "rn_amostra" in reescrito
+    _so_insercoes(tpl, reescrito)
+    assert gb.colunas_da_base(reescrito) == gb.colunas_da_base(tpl)
+    _montar(tpl, extra)
+    todos = {**extra, "_filtros": dict(_filtros_exemplo(nome))}
+    _montar(tpl, todos)
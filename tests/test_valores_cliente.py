@@ -0,0 +1,69 @@
+"""
+Contratos/TipoProduto agregados no cliente (_valores_cliente): com blocos pequenos, uma chave
+que atravessa blocos sai numa linha só, igual a GROUP_CONCAT(DISTINCT ... ORDER BY ...).
+"""
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Gerador_base as gb  # noqa: E402
+
+# (nmcont, cod_cli, fat_parc, char_5), na ordem do ORDER BY de SQL_VALORES_TUPLAS
+TUPLAS = [
+    ("A1", 517, 30, "CARTAO"),
+    ("A1", 517, 10, "CARTAO"),
+    ("B2", 517, 20, "EMPRESTIMO"),
+    ("B2", 517, 20, "CARTAO"),
+    ("B2", 517, 5, None),
+    ("B2", 517, 40, "EMPRESTIMO"),
+    ("B2", 517, 5, "CHEQUE"),
+    ("B2", 518, 7, "CARTAO"),
+    ("C3", 518, None, "CARTAO"),
+]
+
+
+def _group_concat(valores) -> str | None:
+    distintos = sorted({v for v in valores if v is not None})
+    return gb.VALORES_SEPARADOR.join(str(v) for v in distintos) if distintos else None
+
+
+def _esperado() -> dict:
+    grupos = {}
+    for nmcont, cod_cli, fat_parc, char_5 in TUPLAS:
+        fat, tipo = grupos.setdefault((nmcont, cod_cli), ([], []))
+        fat.append(fat_parc)
+        tipo.append(char_5)
+    return {k: (_group_concat(f), _group_concat(t)) for k, (f, t) in grupos.items()}
+
+
+@pytest.mark.parametrize("linhas_por_bloco", [1, 2, 3, 4, len(TUPLAS)])
+def test_chave_que_atravessa_blocos(monkeypatch, linhas_por_bloco):
+    df = pd.DataFrame(TUPLAS, columns=["nmcont", "cod_cli", "fat_parc", "char_5"])
+    df["fat_parc"] = df["fat_parc"].astype("Int64")
+
+    def _ler_blocos(conn, sql, params=None, chunksize=50_000):
+        assert chunksize == linhas_por_bloco
+        for i in range(0, len(df), chunksize):
+            yield df.iloc[i:i + chunksize].reset_index(drop=True)
+
+    monkeypatch.setattr(gb, "VALORES_CHUNK_ROWS", linhas_por_bloco)
+    monkeypatch.setattr(gb, "_ler_sql_blocos", _ler_blocos)
+    out = gb._valores_cliente(None, [517, 518])
+
+    assert not out.duplicated(["nmcont", "cod_cli"]).any()
+    obtido = {
+        (r.nmcont, r.cod_cli): tuple(None if pd.isna(v) else v for v in (r.Contratos, r.TipoProduto))
+        for r in out.itertuples()
+    }
+    assert obtido == _esperado()
+
+
+def test_sem_tuplas(monkeypatch):
+    monkeypatch.setattr(gb, "_ler_sql_blocos", lambda *a, **k: iter(()))
+    out = gb._valores_cliente(None, [517])
+    assert out.empty
+    assert list(out.columns) == ["nmcont", "cod_cli", "Contratos", "TipoProduto"]